@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""blastn with an on-disk cache of per-sequence results
+
+Extracted cluster regions are dominated by repeats, and re-extracting with
+new cluster parameters mostly yields sequences that were searched before.
+Each sequence is reduced to a canonical orientation (the smaller of itself
+and its reverse complement, uppercase) and hashed. Results are cached per
+(sequence hash, database fingerprint, BLAST parameters), so identical
+sequences within a run, across the bk and qv sets and across runs are
+searched once. Only cache misses go to blastn, split over a pool of
+workers.
+
+Cached rows are stored for the canonical orientation; for a sequence that
+is the reverse complement of its canonical form, query and subject
+coordinates are flipped back when its rows are written.
+
+Usage:
+    blast_cache.py clusters/bk_sequences.filtered.fasta clusters/qv_sequences.filtered.fasta \
+        --db /path/to/nt --cache-dir kmer_analysis/blast_cache [--workers 4]
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from compressed_io import available_cpus
+from dedup_sequences import iter_fasta, write_fasta_record
+
+COMPLEMENT = str.maketrans('ACGTRYKMBDHVN', 'TGCAYRMKVHDBN')
+
+
+def canonical_sequence(sequence):
+    """(canonical sequence, True if it is the reverse complement of sequence)"""
+    forward = ''.join(sequence.split()).upper()
+    reverse = forward.translate(COMPLEMENT)[::-1]
+    if reverse < forward:
+        return reverse, True
+    return forward, False
+
+
+def sequence_key(canonical):
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def db_fingerprint(db):
+    """Identify a BLAST database by the names, sizes and mtimes of its files"""
+    files = sorted(glob.glob(db + '.*'))
+    if not files:
+        raise ValueError("No BLAST database files found for {}".format(db))
+    sha1 = hashlib.sha1()
+    for path in files:
+        stat = os.stat(path)
+        sha1.update('{}\t{}\t{}\n'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+    return sha1.hexdigest()
+
+
+def cache_namespace(cache_dir, db, params):
+    """Directory of the entries for one database and parameter set"""
+    key = {'db': os.path.abspath(db), 'fingerprint': db_fingerprint(db), 'params': params}
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    namespace = os.path.join(cache_dir, digest)
+    os.makedirs(namespace, exist_ok=True)
+    key_file = os.path.join(namespace, 'key.json')
+    if not os.path.exists(key_file):
+        with open(key_file, 'w') as f:
+            json.dump(key, f, indent=1)
+    return namespace
+
+
+def _entry_path(namespace, key):
+    return os.path.join(namespace, key[:2], key + '.tsv')
+
+
+def read_entry(namespace, key):
+    """Cached rows (without the query column) for a canonical sequence, or None"""
+    try:
+        with open(_entry_path(namespace, key), 'r') as f:
+            return [line.rstrip('\n').split('\t') for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+
+
+def write_entry(namespace, key, rows):
+    path = _entry_path(namespace, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = '{}.tmp{}'.format(path, os.getpid())
+    try:
+        with open(tmp_file, 'w') as f:
+            for row in rows:
+                f.write('\t'.join(row) + '\n')
+        os.replace(tmp_file, path)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def flip_row(row, length):
+    """outfmt 6 row (without the query column) for the reverse complement of the query"""
+    row = list(row)
+    qstart, qend = int(row[5]), int(row[6])
+    row[5], row[6] = str(length + 1 - qend), str(length + 1 - qstart)
+    row[7], row[8] = row[8], row[7]
+    return row
+
+
+def _run_shard(blastn, shard_fasta, db, output, params, threads):
+    command = [blastn, '-query', shard_fasta, '-db', db, '-out', output, '-outfmt', '6',
+               '-evalue', params['evalue'], '-max_target_seqs', params['max_target_seqs'],
+               '-num_threads', str(threads)] + params['extra_args']
+    subprocess.run(command, check=True)
+    return output
+
+
+def search_misses(misses, db, namespace, params, workers=None, threads=None, blastn='blastn', tmp_dir=None):
+    """blastn the canonical sequences in misses ({key: sequence}) and cache their rows"""
+    if not misses:
+        return
+    cpus = available_cpus()
+    workers = max(1, min(workers or max(1, cpus // 4), len(misses)))
+    threads = threads or max(1, cpus // workers)
+    work_dir = tempfile.mkdtemp(prefix='blast_cache_', dir=tmp_dir)
+    try:
+        # Longest first to the shard with the fewest bases keeps the shards even
+        shards = [[] for _ in range(workers)]
+        loads = [0] * workers
+        for key, sequence in sorted(misses.items(), key=lambda item: -len(item[1])):
+            i = loads.index(min(loads))
+            shards[i].append(key)
+            loads[i] += len(sequence)
+        jobs = []
+        for i, keys in enumerate(shards):
+            shard_fasta = os.path.join(work_dir, 'shard_{}.fasta'.format(i))
+            with open(shard_fasta, 'w') as f:
+                for key in keys:
+                    write_fasta_record(f, key, misses[key], 60)
+            jobs.append((shard_fasta, os.path.join(work_dir, 'shard_{}.out'.format(i))))
+        print("BLASTing {} uncached sequences in {} shards ({} threads each)".format(
+            len(misses), workers, threads))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            outputs = list(pool.map(lambda job: _run_shard(blastn, job[0], db, job[1], params, threads), jobs))
+
+        rows = {key: [] for key in misses}
+        for output in outputs:
+            with open(output, 'r') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) >= 12 and fields[0] in rows:
+                        rows[fields[0]].append(fields[1:])
+        # Sequences without hits get an empty entry, so they are not searched again either
+        for key, key_rows in rows.items():
+            write_entry(namespace, key, key_rows)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def cached_blast(jobs, db, cache_dir, evalue='1e-5', max_target_seqs=10, extra_args=None, workers=None,
+                 threads=None, blastn='blastn', tmp_dir=None):
+    """BLAST each (fasta_file, output_file) job through the cache
+
+    Misses from all jobs are searched together before any output is written.
+    Returns (sequences, distinct canonical sequences, cache misses).
+    """
+    params = {'evalue': str(evalue), 'max_target_seqs': str(max_target_seqs),
+              'extra_args': list(extra_args or [])}
+    namespace = cache_namespace(cache_dir, db, params)
+
+    records = []
+    canonical = {}
+    for fasta_file, _ in jobs:
+        job_records = []
+        for header, sequence in iter_fasta(fasta_file):
+            sequence, flipped = canonical_sequence(sequence)
+            key = sequence_key(sequence)
+            canonical.setdefault(key, sequence)
+            job_records.append((header.split(None, 1)[0], key, flipped, len(sequence)))
+        records.append(job_records)
+
+    misses = {key: sequence for key, sequence in canonical.items() if read_entry(namespace, key) is None}
+    search_misses(misses, db, namespace, params, workers, threads, blastn, tmp_dir)
+
+    for (_, output_file), job_records in zip(jobs, records):
+        tmp_file = '{}.tmp{}'.format(output_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as out:
+                for query_id, key, flipped, length in job_records:
+                    for row in read_entry(namespace, key):
+                        if flipped:
+                            row = flip_row(row, length)
+                        out.write(query_id + '\t' + '\t'.join(row) + '\n')
+            os.replace(tmp_file, output_file)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+    return sum(len(job_records) for job_records in records), len(canonical), len(misses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='blastn nucleotide FASTA files through a result cache')
+    parser.add_argument('fasta', nargs='+', help='Query FASTA file(s); each gets <name>_blast_results.txt')
+    parser.add_argument('--db', required=True, help='blastn database prefix')
+    parser.add_argument('--cache-dir', required=True, help='Cache directory (shared between runs)')
+    parser.add_argument('--evalue', default='1e-5', help='blastn -evalue (default: 1e-5)')
+    parser.add_argument('--max-target-seqs', default='10', help='blastn -max_target_seqs (default: 10)')
+    parser.add_argument('--blast-args', default='', help='Extra blastn arguments')
+    parser.add_argument('--workers', type=int, help='blastn processes at once (default: available CPUs / 4)')
+    parser.add_argument('--threads', type=int, help='blastn -num_threads (default: available CPUs / workers)')
+    parser.add_argument('--blastn', default='blastn', help='blastn executable')
+    args = parser.parse_args()
+
+    jobs = [(fasta, os.path.splitext(fasta)[0] + '_blast_results.txt') for fasta in args.fasta]
+    try:
+        n_sequences, n_distinct, n_misses = cached_blast(
+            jobs, args.db, args.cache_dir, args.evalue, args.max_target_seqs, args.blast_args.split(),
+            args.workers, args.threads, args.blastn)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("{} sequences, {} distinct, {} searched; {} from the cache".format(
+        n_sequences, n_distinct, n_misses, n_distinct - n_misses))
+    for _, output_file in jobs:
+        print("BLAST results saved to {}".format(output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""Columnar (NumPy) engine for the filter_* scripts
+
+Loads the query, subject and identity columns of BLAST tabular output into
+typed arrays, reduces them to the best hit per (query, category) with
+unbuffered ufunc reductions, and applies the HGT thresholds as array masks. Produces the same
+candidates, in the same order, as the streaming reader in blast_hits.
+
+Parsed columns are cached next to the BLAST output so re-filtering the same
+file with different thresholds skips the text parse.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+from compressed_io import available_cpus, open_file
+
+CACHE_SUFFIX = '.cols'
+CACHE_VERSION = 1
+CACHE_COLUMNS = ('query', 'queries', 'subject', 'subjects', 'identity')
+
+
+def _read_columns_pandas(blast_file, min_fields):
+    """Read query, subject and identity columns with the pandas C parser"""
+    usecols = sorted({0, 1, 2, min_fields - 1})
+    with open_file(blast_file, 'r') as f:
+        try:
+            table = pd.read_csv(
+                f, sep='\t', header=None, usecols=usecols,
+                # 'high' precision parses every %.3f identity BLAST can write (0.000-100.000)
+                # to the same double as float()
+                dtype={0: str, 1: str}, float_precision='high',
+                keep_default_na=False, na_values=[''], engine='c'
+            )
+        except pd.errors.EmptyDataError:
+            return _read_columns_python(blast_file, min_fields)
+    # Short lines come back with missing trailing fields; skip them like the streaming reader
+    table = table.dropna()
+    query_codes, queries = pd.factorize(table[0], sort=False)
+    subject_codes, subjects = pd.factorize(table[1], sort=False)
+    return (query_codes, list(queries), subject_codes, list(subjects),
+            table[2].to_numpy(dtype=np.float64))
+
+
+def _read_columns_python(blast_file, min_fields):
+    """Read query, subject and identity columns, dictionary-encoding the IDs"""
+    query_index = {}
+    subject_index = {}
+    query_codes = []
+    subject_codes = []
+    identities = []
+
+    with open_file(blast_file, 'r') as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            if len(fields) < min_fields:
+                continue
+            query_codes.append(query_index.setdefault(fields[0], len(query_index)))
+            subject_codes.append(subject_index.setdefault(fields[1], len(subject_index)))
+            identities.append(float(fields[2]))
+
+    return (np.array(query_codes, dtype=np.int64), list(query_index),
+            np.array(subject_codes, dtype=np.int64), list(subject_index),
+            np.array(identities, dtype=np.float64))
+
+
+def _cache_fingerprint(blast_file, min_fields):
+    """Identify a BLAST file by size, mtime and a hash of its first and last 64 KB"""
+    stat = os.stat(blast_file)
+    sha1 = hashlib.sha1()
+    with open(blast_file, 'rb') as f:
+        sha1.update(f.read(65536))
+        if stat.st_size > 65536:
+            f.seek(max(stat.st_size - 65536, 65536))
+            sha1.update(f.read())
+    return {
+        'version': CACHE_VERSION,
+        'min_fields': min_fields,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha1': sha1.hexdigest(),
+    }
+
+
+def _read_columns_cache(cache_dir, fingerprint):
+    """Memory-map cached columns, or return None if the cache is missing or stale"""
+    try:
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            if json.load(f) != fingerprint:
+                return None
+        arrays = {
+            name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+            for name in CACHE_COLUMNS
+        }
+        # IDs were written as UTF-8; a cache that does not decode is rebuilt
+        queries = np.char.decode(arrays['queries'], 'utf-8').tolist()
+        subjects = np.char.decode(arrays['subjects'], 'utf-8').tolist()
+    except (OSError, ValueError):
+        return None
+    return (arrays['query'], queries, arrays['subject'], subjects, arrays['identity'])
+
+
+def _write_columns_cache(cache_dir, fingerprint, columns):
+    """Write parsed columns as .npy files, swapping the directory in atomically"""
+    query_codes, queries, subject_codes, subjects, identity = columns
+    arrays = {
+        'query': np.asarray(query_codes, dtype=np.int64),
+        'queries': np.array([q.encode() for q in queries], dtype=bytes),
+        'subject': np.asarray(subject_codes, dtype=np.int64),
+        'subjects': np.array([s.encode() for s in subjects], dtype=bytes),
+        'identity': np.asarray(identity, dtype=np.float64),
+    }
+    tmp_dir = '{}.tmp{}'.format(cache_dir, os.getpid())
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(fingerprint, f)
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+    except OSError as e:
+        print("Warning: could not write column cache {}: {}".format(cache_dir, e))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_blast_columns(blast_file, min_fields=3, cache=True):
+    """Parse query, subject and identity columns, reusing the binary cache if current
+
+    The cache is a directory of .npy files next to the BLAST output
+    (<blast_file>.cols), keyed by file size, mtime and a partial content hash.
+    It holds the raw parsed columns, so it stays valid when categories or
+    thresholds change.
+    """
+    cache_dir = str(blast_file) + CACHE_SUFFIX
+    if cache:
+        fingerprint = _cache_fingerprint(blast_file, min_fields)
+        columns = _read_columns_cache(cache_dir, fingerprint)
+        if columns is not None:
+            print("Using cached columns from {}".format(cache_dir))
+            return columns
+
+    if pd is not None:
+        columns = _read_columns_pandas(blast_file, min_fields)
+    else:
+        columns = _read_columns_python(blast_file, min_fields)
+
+    if cache:
+        _write_columns_cache(cache_dir, fingerprint, columns)
+    return columns
+
+
+def _merge_columns(parts):
+    """Concatenate per-file columns, re-encoding IDs into shared code tables
+
+    A query found in several files gets one code, so its hits are reduced
+    together just as the streaming reader merges them.
+    """
+    query_index = {}
+    subject_index = {}
+    query_codes = []
+    subject_codes = []
+    identities = []
+    for part_query, part_queries, part_subject, part_subjects, part_identity in parts:
+        query_map = np.array([query_index.setdefault(q, len(query_index)) for q in part_queries],
+                             dtype=np.int64)
+        subject_map = np.array([subject_index.setdefault(s, len(subject_index)) for s in part_subjects],
+                               dtype=np.int64)
+        query_codes.append(query_map[np.asarray(part_query)])
+        subject_codes.append(subject_map[np.asarray(part_subject)])
+        identities.append(np.asarray(part_identity, dtype=np.float64))
+
+    return (np.concatenate(query_codes), list(query_index),
+            np.concatenate(subject_codes), list(subject_index),
+            np.concatenate(identities))
+
+
+def load_blast_columns(blast_files, categorize, min_fields=3, cache=True, workers=None):
+    """Load one or more BLAST files into dictionary-encoded column arrays
+
+    Each distinct subject ID is categorized once; hits whose category is None
+    are dropped. A query's hits need not be contiguous or in one file. Query
+    codes are numbered in order of first categorized hit, which is the order
+    the streaming reader reports queries in.
+
+    Returns a dict with 'queries', 'subjects' and 'categories' (code -> name
+    lists) and per-hit 'query', 'subject', 'category' and 'identity' arrays.
+    """
+    if isinstance(blast_files, str):
+        blast_files = [blast_files]
+    if len(blast_files) == 1:
+        columns = read_blast_columns(blast_files[0], min_fields, cache)
+    else:
+        # Parse (or memory-map the cache of) each chunk file in its own process
+        workers = min(workers or available_cpus(), len(blast_files))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(read_blast_columns, blast_files, repeat(min_fields), repeat(cache)))
+        columns = _merge_columns(parts)
+    query_codes, queries, subject_codes, subjects, identity = columns
+
+    category_index = {}
+    subject_category = np.empty(len(subjects), dtype=np.int16)
+    for i, subject_id in enumerate(subjects):
+        category = categorize(subject_id)
+        if category is None:
+            subject_category[i] = -1
+        else:
+            subject_category[i] = category_index.setdefault(category, len(category_index))
+    categories = list(category_index)
+
+    category_codes = subject_category[subject_codes]
+    keep = category_codes >= 0
+
+    # Renumber queries by first categorized hit
+    kept_queries, first_seen, inverse = np.unique(
+        np.asarray(query_codes)[keep], return_index=True, return_inverse=True)
+    order = np.argsort(first_seen, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    return {
+        'queries': [queries[i] for i in kept_queries[order]],
+        'subjects': subjects,
+        'categories': categories,
+        'query': rank[inverse.ravel()],
+        'subject': np.asarray(subject_codes)[keep],
+        'category': category_codes[keep],
+        'identity': np.asarray(identity, dtype=np.float64)[keep],
+    }
+
+
+def best_hit_table(columns, donor, native):
+    """Reduce hit columns to the best donor and native hit for each query
+
+    The maximum identity per (query, category) group is found with
+    np.maximum.at, then the first row reaching it, so ties keep the first hit
+    in file order just as max() did. Queries without a hit in one of the
+    categories get subject -1 and a NaN identity for it.
+    """
+    n_queries = len(columns['queries'])
+    n_categories = max(len(columns['categories']), 1)
+    n_hits = len(columns['identity'])
+    identity = columns['identity']
+    group = columns['query'] * n_categories + columns['category']
+
+    best_identity = np.full(n_queries * n_categories, -np.inf)
+    np.maximum.at(best_identity, group, identity)
+    rows = np.flatnonzero(identity == best_identity[group])
+    best_row = np.full(n_queries * n_categories, n_hits, dtype=np.int64)
+    np.minimum.at(best_row, group[rows], rows)
+
+    table = {
+        'queries': columns['queries'],
+        'subjects': columns['subjects'],
+        'n_queries': n_queries,
+    }
+    for role, category in (('donor', donor), ('native', native)):
+        subject = np.full(n_queries, -1, dtype=np.int64)
+        role_identity = np.full(n_queries, np.nan)
+        if category in columns['categories']:
+            row = best_row[np.arange(n_queries) * n_categories + columns['categories'].index(category)]
+            present = row < n_hits
+            subject[present] = columns['subject'][row[present]]
+            role_identity[present] = identity[row[present]]
+        table[role + '_subject'] = subject
+        table[role + '_identity'] = role_identity
+
+    return table
+
+
+def hgt_mask(table, min_difference=20, max_conserved=90, min_donor=75, max_native=50):
+    """Boolean mask of queries passing the HGT criteria"""
+    donor_id = table['donor_identity']
+    native_id = table['native_identity']
+    difference = donor_id - native_id
+    # NaN identities (missing category) compare False, so they never pass
+    return ((difference >= min_difference) &
+            (donor_id <= max_conserved) &
+            (donor_id >= min_donor) &
+            (native_id <= max_native))
+
+
+def select_candidates(table, min_difference=20, max_conserved=90, min_donor=75, max_native=50):
+    """Yield (query_id, donor_hit, native_hit, difference) for passing queries in query order"""
+    mask = hgt_mask(table, min_difference, max_conserved, min_donor, max_native)
+    for i in np.flatnonzero(mask):
+        donor_id = float(table['donor_identity'][i])
+        native_id = float(table['native_identity'][i])
+        yield (
+            table['queries'][i],
+            {'subject': table['subjects'][table['donor_subject'][i]], 'identity': donor_id},
+            {'subject': table['subjects'][table['native_subject'][i]], 'identity': native_id},
+            donor_id - native_id
+        )
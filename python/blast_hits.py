@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Shared readers for BLAST tabular (-outfmt 6) results used by the filter_* scripts"""
+
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from compressed_io import available_cpus, open_file
+
+
+def merge_best(best, other):
+    """Fold the per-category best hits in other into best (ties keep the hit already in best)"""
+    for category, hit in other.items():
+        current = best.get(category)
+        if current is None or hit['identity'] > current['identity']:
+            best[category] = hit
+    return best
+
+
+def iter_best_hits(blast_file, categorize, min_fields=3):
+    """Reduce BLAST results to the best hit per category for each query
+
+    Only the best hit for each (query, category) is kept in memory, not the
+    hits themselves. blastp writes each query's hits as one block, but
+    concatenated or re-sorted output may split a query over several blocks;
+    these are merged, as the original dictionary of all hits did.
+    Yields (query_id, best) where best maps category -> {'subject', 'identity'},
+    in order of each query's first categorized hit. Ties keep the first hit
+    seen, matching max() over the hits in file order.
+    gzip/bgzip/zstd-compressed files are read transparently.
+
+    Args:
+        blast_file: BLAST output in tabular format
+        categorize: Function mapping a subject ID to a category name, or None
+            to ignore the hit
+        min_fields: Lines with fewer tab-separated fields are skipped
+    """
+    best_hits = {}
+
+    with open_file(blast_file, 'r') as f:
+        for line in f:
+            fields = line.strip().split('\t')
+            if len(fields) < min_fields:
+                continue
+
+            category = categorize(fields[1])
+            if category is None:
+                continue
+
+            identity = float(fields[2])
+            best = best_hits.setdefault(fields[0], {})
+            current_best = best.get(category)
+            if current_best is None or identity > current_best['identity']:
+                best[category] = {
+                    'subject': fields[1],
+                    'identity': identity
+                }
+
+    yield from best_hits.items()
+
+
+def query_blocks(blast_file):
+    """Byte offset and length of each query's block of rows in a grouped BLAST file"""
+    blocks = {}
+    current = None
+    start = offset = 0
+    with open(blast_file, 'rb') as f:
+        for line in f:
+            query_id = line.split(b'\t', 1)[0]
+            if query_id != current:
+                if current is not None:
+                    blocks[current] = (start, offset - start)
+                current = query_id
+                start = offset
+            offset += len(line)
+    if current is not None:
+        blocks[current] = (start, offset - start)
+    return blocks
+
+
+def expand_blast_files(patterns):
+    """Expand file names and quoted globs (e.g. blast_results/results_oak_bact_*.out)
+
+    Matches are sorted like the shell sorts `cat results_*.out`, so hits come
+    out in the same order as from the concatenated file.
+    """
+    blast_files = []
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise FileNotFoundError("No BLAST files match {}".format(pattern))
+            blast_files.extend(matches)
+        else:
+            blast_files.append(pattern)
+    return blast_files
+
+
+def add_filter_arguments(parser, hit_label=None):
+    """Engine, sweep, annotation and --watch options shared by the filter_* scripts
+
+    hit_label (e.g. 'bacterial') adds --members and --protein-store, which
+    annotate the best hit of that category.
+    """
+    parser.add_argument('--engine', choices=['stream', 'columnar'], default='stream',
+                       help='Hit reduction engine: streaming reader or NumPy columns (default: stream)')
+    parser.add_argument('--workers', type=int,
+                       help='Processes used to reduce per-chunk BLAST files (default: all available CPUs)')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Do not read or write the parsed-column cache used by the columnar engine')
+    parser.add_argument('--sweep', nargs='+', metavar='NAME=V1,V2',
+                       help='Evaluate a grid of thresholds (min_difference, max_conserved, min_donor, '
+                            'max_native) in one pass instead of a single setting')
+    parser.add_argument('--sweep-output', help='Output prefix for sweep tables (default: <first blast file>.sweep)')
+    parser.add_argument('--taxon-index',
+                       help='Taxon index built by lineage.py; places unprefixed RefSeq subjects by lineage')
+    if hit_label:
+        parser.add_argument('--members',
+                           help='Members table from dedup_sequences.py collapse; adds a column listing the '
+                                'database sequences identical to each best {} hit'.format(hit_label))
+        parser.add_argument('--protein-store',
+                           help='Protein store built by protein_store.py; adds the description, organism, '
+                                'length and sequence of each best {} hit'.format(hit_label))
+    parser.add_argument('--watch', metavar='TABLE',
+                       help='Process chunks as their array tasks finish (<chunk>.done markers) and keep '
+                            'a running candidate table in TABLE, checkpointed in TABLE.checkpoint.json')
+    parser.add_argument('--expected-chunks', type=int,
+                       help='With --watch, stop once this many chunks are processed (default: run until interrupted)')
+    parser.add_argument('--interval', type=float, default=300,
+                       help='With --watch, seconds between checks for finished chunks (default: 300)')
+    parser.add_argument('--settle', type=float,
+                       help='With --watch, also accept chunks without a .done marker once idle this many seconds')
+
+
+def reduce_blast_file(blast_file, categorize, min_fields=3):
+    """Reduce one BLAST file (e.g. an array-task chunk) to a list of (query_id, best)"""
+    return list(iter_best_hits(blast_file, categorize, min_fields))
+
+
+def iter_best_hits_files(blast_files, categorize, min_fields=3, workers=None):
+    """Yield (query_id, best) for one or more BLAST files
+
+    A single file is read directly. Several files (per-chunk outputs of the
+    Slurm array jobs) are reduced in parallel in a process pool and merged in
+    file order, so the result is the same as for the concatenated file.
+    """
+    if isinstance(blast_files, str):
+        blast_files = [blast_files]
+    if len(blast_files) == 1:
+        yield from iter_best_hits(blast_files[0], categorize, min_fields)
+        return
+
+    workers = min(workers or available_cpus(), len(blast_files))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        reductions = pool.map(reduce_blast_file, blast_files, repeat(categorize), repeat(min_fields))
+        yield from merge_reductions(zip(blast_files, reductions))
+
+
+def merge_reductions(reductions):
+    """Yield (query_id, best) from (blast_file, reduction) pairs taken in order
+
+    A query found in several files gets the best hit per category over all of
+    them; ties keep the hit from the earlier file.
+    """
+    best_hits = {}
+    for _, reduction in reductions:
+        for query_id, best in reduction:
+            merge_best(best_hits.setdefault(query_id, {}), best)
+    yield from best_hits.items()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Incremental filtering of BLAST array-job chunks as they finish
+
+The blastp array scripts write each chunk to blast_results/ and touch
+<chunk>.done once blastp has exited successfully. watch_blast_chunks polls
+for chunks with a marker, reduces each one exactly once to its best hit per
+query and category, and records the reduction in a JSON checkpoint, so a
+restarted watcher only processes chunks it has not seen. After every new
+chunk the caller gets all reductions so far (in `cat` order) to refresh its
+running candidate table.
+"""
+
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from blast_hits import merge_reductions, reduce_blast_file
+from compressed_io import available_cpus
+
+CHECKPOINT_VERSION = 1
+DONE_SUFFIX = '.done'
+
+
+def _chunk_files(patterns):
+    """Current matches of the chunk patterns, sorted like the shell sorts them"""
+    chunk_files = set()
+    for pattern in patterns:
+        if any(c in pattern for c in '*?['):
+            chunk_files.update(glob.glob(pattern))
+        elif os.path.exists(pattern):
+            chunk_files.add(pattern)
+    return sorted(chunk_files)
+
+
+def _chunk_state(chunk_file):
+    stat = os.stat(chunk_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def chunk_is_complete(chunk_file, settle=None):
+    """True once blastp has finished writing chunk_file
+
+    A <chunk>.done marker at least as new as the chunk is the reliable signal. With settle (seconds), a
+    chunk without a marker also counts as complete once it has not been
+    modified for that long and ends in a full line; blastp can go quiet for
+    hours between flushes, so use a generous value.
+    """
+    stat = os.stat(chunk_file)
+    try:
+        # A marker older than the chunk belongs to an earlier run of the task
+        if os.stat(chunk_file + DONE_SUFFIX).st_mtime_ns >= stat.st_mtime_ns:
+            return True
+    except FileNotFoundError:
+        pass
+    if settle is None:
+        return False
+    if time.time() - stat.st_mtime < settle or stat.st_size == 0:
+        return False
+    with open(chunk_file, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def load_checkpoint(checkpoint_file, key):
+    """Chunk reductions saved by a previous run, or an empty checkpoint
+
+    key identifies the categorization and parsing settings; reductions made
+    with different settings are discarded.
+    """
+    empty = {'version': CHECKPOINT_VERSION, 'key': key, 'chunks': {}}
+    try:
+        with open(checkpoint_file, 'r') as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return empty
+    if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint.get('key') != key:
+        print("Checkpoint {} was made with different settings; starting over".format(checkpoint_file))
+        return empty
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    """Write the checkpoint atomically so a crash never leaves half a file"""
+    tmp_file = '{}.tmp{}'.format(checkpoint_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def write_candidate_table(table_file, lines):
+    """Replace the running candidate table atomically, so readers never see half of it"""
+    tmp_file = '{}.tmp{}'.format(table_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_file, table_file)
+
+
+def watch_blast_chunks(patterns, categorize, checkpoint_file, update, min_fields=3,
+                       expected=None, interval=300, settle=None, once=False, workers=None):
+    """Reduce BLAST chunks as they complete and call update(hits) after each batch
+
+    Args:
+        patterns: Chunk file names or globs (e.g. blast_results/results_oak_bact_*.out)
+        categorize: Subject classifier, as for iter_best_hits
+        checkpoint_file: JSON file holding the per-chunk reductions
+        update: Called with an iterator of (query_id, best) over all processed
+            chunks whenever new chunks have been added
+        expected: Stop once this many chunks are processed (default: run until
+            interrupted)
+        interval: Seconds between polls
+        settle: Also accept chunks without a .done marker after this many idle
+            seconds (see chunk_is_complete)
+        once: Process whatever is complete now and return
+    """
+    checkpoint = load_checkpoint(checkpoint_file, '{!r}/{}'.format(categorize, min_fields))
+    chunks = checkpoint['chunks']
+    if chunks:
+        print("Resuming from {} ({} chunks already processed)".format(checkpoint_file, len(chunks)))
+        update(merge_reductions((name, chunks[name]['hits']) for name in sorted(chunks)))
+
+    workers = workers or available_cpus()
+    try:
+        while True:
+            new_files = []
+            for chunk_file in _chunk_files(patterns):
+                done = chunks.get(chunk_file)
+                # A chunk rewritten by a re-run array task is processed again
+                if done is not None and done['state'] == _chunk_state(chunk_file):
+                    continue
+                if chunk_is_complete(chunk_file, settle):
+                    new_files.append(chunk_file)
+
+            if new_files:
+                states = [_chunk_state(chunk_file) for chunk_file in new_files]
+                with ProcessPoolExecutor(max_workers=min(workers, len(new_files))) as pool:
+                    for chunk_file, state, reduction in zip(
+                            new_files, states,
+                            pool.map(reduce_blast_file, new_files, repeat(categorize), repeat(min_fields))):
+                        chunks[chunk_file] = {'state': state, 'hits': reduction}
+                        save_checkpoint(checkpoint_file, checkpoint)
+                        print("Processed {} ({} query proteins with hits)".format(chunk_file, len(reduction)))
+                update(merge_reductions((name, chunks[name]['hits']) for name in sorted(chunks)))
+
+            if once or (expected is not None and len(chunks) >= expected):
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching; {} chunks processed".format(len(chunks)))
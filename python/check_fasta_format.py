@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
+"""
+Check genome FASTA files for formatting issues before k-merizing them
 
-import sys
-from pathlib import Path
+The default engine works on bytes: a plain file is memory-mapped and
+scanned in large blocks, with newlines found and characters counted by
+NumPy, optionally over several byte ranges in parallel. Compressed files
+are streamed through the same block scan. Files with carriage returns or
+non-ASCII bytes go to the line-by-line engine, whose universal-newline and
+UTF-8 handling defines the reported statistics.
+
+Usage:
+    check_fasta_format.py [genome.fa ...] [--workers N] [--engine bytes|lines]
+"""
+
+import argparse
+import mmap
+import os
 import re
+import string
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from compressed_io import available_cpus, detect_compression, open_file
+
+CHUNK_BYTES = 64 * 1024 * 1024
+HISTOGRAM_BYTES = 8 * 1024 * 1024
+
 
-def check_fasta(filepath):
+def _byte_table(chars):
+    table = np.zeros(256, dtype=bool)
+    table[list(chars)] = True
+    return table
+
+
+# Bytes matched by \s in a str regex, and the characters each check accepts
+WHITESPACE = bytes(range(9, 14)) + bytes(range(28, 33))
+SEQUENCE_CHARS = _byte_table(b'ACGTNacgtn' + WHITESPACE)
+HEADER_CHARS = _byte_table((string.ascii_letters + string.digits + '._|-').encode())
+UPPERCASE = _byte_table(string.ascii_uppercase.encode())
+LOWERCASE = _byte_table(string.ascii_lowercase.encode())
+
+def check_fasta_lines(filepath):
     """
-    Check a FASTA file for potential formatting issues
+    Check a FASTA file (plain, gzip/bgzip or zstd) for potential formatting issues
     """
-    print(f"\nChecking {filepath}...")
-    
     stats = {
         'total_seqs': 0,
         'total_bases': 0,
@@ -25,7 +61,7 @@ def check_fasta(filepath):
     sequence_lines = 0
     
     try:
-        with open(filepath, 'r') as f:
+        with open_file(filepath, 'r') as f:
             for line_num, line in enumerate(f, 1):
                 line = line.rstrip('\n')
                 
@@ -68,6 +104,213 @@ def check_fasta(filepath):
         
     return stats
 
+def _histogram(values):
+    counts = np.zeros(256, dtype=np.int64)
+    for i in range(0, len(values), HISTOGRAM_BYTES):
+        counts += np.bincount(values[i:i + HISTOGRAM_BYTES], minlength=256)
+    return counts
+
+
+def new_scan():
+    return {
+        'lines': 0,
+        'empty_lines': [],
+        'total_seqs': 0,
+        'total_bases': 0,
+        'line_lengths': set(),
+        'header_lengths': [],
+        'sequence_counts': np.zeros(256, dtype=np.int64),
+        'header_counts': np.zeros(256, dtype=np.int64),
+        'first_seen': {}
+    }
+
+
+def scan_block(scan, block, offset):
+    """Add the lines in block (uint8 array starting at file offset offset) to scan
+
+    block must start at a line start and end after a newline, or at the end of the file.
+    """
+    newlines = np.flatnonzero(block == 10)
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(block)]))
+    if starts[-1] == len(block):
+        starts, ends = starts[:-1], ends[:-1]
+    lengths = ends - starts
+
+    scan['empty_lines'].extend((np.flatnonzero(lengths == 0) + scan['lines'] + 1).tolist())
+    scan['lines'] += len(starts)
+    nonempty = lengths > 0
+    is_header = np.zeros(len(starts), dtype=bool)
+    is_header[nonempty] = block[starts[nonempty]] == ord('>')
+    is_sequence = nonempty & ~is_header
+
+    scan['total_seqs'] += int(np.count_nonzero(is_header))
+    scan['header_lengths'].extend(lengths[is_header].tolist())
+    sequence_lengths = lengths[is_sequence]
+    scan['total_bases'] += int(sequence_lengths.sum())
+    scan['line_lengths'].update(np.unique(sequence_lengths).tolist())
+
+    # Header text after each '>', gathered with one index array
+    text_starts = starts[is_header] + 1
+    text_lengths = lengths[is_header] - 1
+    header_index = (np.repeat(text_starts - np.cumsum(text_lengths) + text_lengths, text_lengths)
+                    + np.arange(text_lengths.sum()))
+    header_bytes = block[header_index]
+    header_counts = _histogram(header_bytes)
+    # Whatever is not header text, a '>' or a newline is sequence
+    sequence_counts = _histogram(block) - header_counts
+    sequence_counts[ord('>')] -= len(text_starts)
+    sequence_counts[10] -= len(newlines)
+    scan['sequence_counts'] += sequence_counts
+    scan['header_counts'] += header_counts
+
+    # Unusual characters are reported in order of first appearance
+    in_sequence = set(np.flatnonzero((sequence_counts > 0) & ~SEQUENCE_CHARS).tolist())
+    in_header = set(np.flatnonzero((header_counts > 0) & ~HEADER_CHARS).tolist())
+    for value in (in_sequence | in_header) - set(scan['first_seen']):
+        positions = []
+        if value in in_sequence:
+            hits = np.flatnonzero(block == value)
+            hits = hits[is_sequence[np.searchsorted(starts, hits, 'right') - 1]]
+            positions.append(int(hits[0]))
+        if value in in_header:
+            positions.append(int(header_index[np.argmax(header_bytes == value)]))
+        scan['first_seen'][value] = offset + min(positions)
+
+
+def _scan_range(filepath, start, end):
+    """Scan bytes start:end of a plain file; both must be line starts (or the file end)"""
+    scan = new_scan()
+    if start == end:
+        return scan
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = start
+        while position < end:
+            stop = mm.find(b'\n', position + CHUNK_BYTES, end) + 1 if end - position > CHUNK_BYTES else 0
+            stop = stop or end
+            scan_block(scan, np.frombuffer(mm, dtype=np.uint8, count=stop - position, offset=position),
+                        position)
+            position = stop
+    return scan
+
+
+def _scan_stream(filepath):
+    """Scan a compressed file block by block as it is decompressed"""
+    scan = new_scan()
+    offset = 0
+    carry = b''
+    with open_file(filepath, 'rb') as f:
+        while True:
+            block = f.read(CHUNK_BYTES)
+            if not block:
+                break
+            data = carry + block
+            cut = data.rfind(b'\n') + 1
+            if cut:
+                scan_block(scan, np.frombuffer(data, dtype=np.uint8, count=cut), offset)
+                offset += cut
+            carry = data[cut:]
+    if carry:
+        scan_block(scan, np.frombuffer(carry, dtype=np.uint8), offset)
+    return scan
+
+
+def split_ranges(filepath, n_ranges):
+    """Split a plain file into up to n_ranges byte ranges that start at line starts"""
+    size = os.path.getsize(filepath)
+    if size == 0:
+        return [(0, 0)]
+    bounds = [0]
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, n_ranges):
+            cut = mm.find(b'\n', max(bounds[-1], size * i // n_ranges)) + 1
+            if cut == 0 or cut >= size:
+                break
+            if cut > bounds[-1]:
+                bounds.append(cut)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _merge_scans(scans):
+    merged = new_scan()
+    for scan in scans:
+        merged['empty_lines'].extend(line + merged['lines'] for line in scan['empty_lines'])
+        merged['lines'] += scan['lines']
+        merged['total_seqs'] += scan['total_seqs']
+        merged['total_bases'] += scan['total_bases']
+        merged['line_lengths'] |= scan['line_lengths']
+        merged['header_lengths'].extend(scan['header_lengths'])
+        merged['sequence_counts'] += scan['sequence_counts']
+        merged['header_counts'] += scan['header_counts']
+        for value, position in scan['first_seen'].items():
+            merged['first_seen'].setdefault(value, position)
+    return merged
+
+
+def check_fasta_bytes(filepath, workers=1):
+    """
+    Same statistics as check_fasta_lines from a block-wise byte scan.
+
+    Returns None if the file needs the line-by-line engine (carriage returns
+    or non-ASCII bytes).
+    """
+    if detect_compression(filepath) is None:
+        ranges = split_ranges(filepath, workers)
+        if len(ranges) > 1:
+            with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+                scans = list(pool.map(_scan_range, [filepath] * len(ranges), *zip(*ranges)))
+        else:
+            scans = [_scan_range(filepath, *ranges[0])]
+    else:
+        scans = [_scan_stream(filepath)]
+    scan = _merge_scans(scans)
+    stats = scan_stats(scan)
+    if stats is not None:
+        for line_num in scan['empty_lines']:
+            print(f"Warning: Empty line at line {line_num}")
+    return stats
+
+
+def scan_stats(scan):
+    """
+    check_fasta statistics from a finished scan, or None if the file needs
+    the line-by-line engine (carriage returns or non-ASCII bytes).
+    """
+    counts = scan['sequence_counts'] + scan['header_counts']
+    if counts[13] or counts[128:].any():
+        return None
+
+    unusual_chars = defaultdict(int)
+    for value in sorted(scan['first_seen'], key=scan['first_seen'].get):
+        count = 0
+        if not SEQUENCE_CHARS[value]:
+            count += scan['sequence_counts'][value]
+        if not HEADER_CHARS[value]:
+            count += scan['header_counts'][value]
+        unusual_chars[chr(value)] = int(count)
+    return {
+        'total_seqs': scan['total_seqs'],
+        'total_bases': scan['total_bases'],
+        'line_lengths': scan['line_lengths'],
+        'header_lengths': scan['header_lengths'],
+        'unusual_chars': unusual_chars,
+        'lowercase_count': int(scan['sequence_counts'][LOWERCASE].sum()),
+        'uppercase_count': int(scan['sequence_counts'][UPPERCASE].sum())
+    }
+
+
+def check_fasta(filepath, workers=1, engine='bytes'):
+    """
+    Check a FASTA file (plain, gzip/bgzip or zstd) for potential formatting issues
+    """
+    print(f"\nChecking {filepath}...")
+    if engine == 'bytes':
+        stats = check_fasta_bytes(filepath, workers)
+        if stats is not None:
+            return stats
+    return check_fasta_lines(filepath)
+
 def print_stats(stats):
     """Print formatted statistics"""
     if not stats:
@@ -95,20 +338,30 @@ def print_stats(stats):
         print("\nWarning: Mixed case detected")
 
 def main():
+    parser = argparse.ArgumentParser(description='Check genome FASTA files for formatting issues')
+    parser.add_argument('genomes', nargs='*',
+                        help='FASTA files (default: the three genomes in /export/martinsons/adam/input_sequences)')
+    parser.add_argument('--workers', type=int, default=available_cpus(),
+                        help='Byte ranges of a plain file scanned in parallel (default: all available CPUs)')
+    parser.add_argument('--engine', choices=['bytes', 'lines'], default='bytes',
+                        help='bytes: block-wise scan (default); lines: the original line-by-line check')
+    args = parser.parse_args()
+
     genome_files = [
         "B_kinseyi_genome.fna",
         "Q_virginiana_genome.genome.fa",
         "D_quercuslanigerum_genome.fna"
     ]
+    paths = [Path(genome) for genome in args.genomes] or \
+        [Path("/export/martinsons/adam/input_sequences") / genome for genome in genome_files]
     
-    for genome in genome_files:
-        filepath = Path("/export/martinsons/adam/input_sequences") / genome
+    for filepath in paths:
         if filepath.exists():
-            stats = check_fasta(filepath)
+            stats = check_fasta(filepath, args.workers, args.engine)
             if stats:
                 print_stats(stats)
         else:
-            print(f"\nError: Could not find {genome}")
+            print(f"\nError: Could not find {filepath.name}")
 
 if __name__ == "__main__":
     main()
@@ -3,12 +3,21 @@
 import sys
 from pathlib import Path
 import argparse
-from Bio import SeqIO
-from Bio.SeqIO import FastaIO
-from Bio.Seq import Seq
+import contextlib
+import io
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
+
+from check_fasta_format import check_fasta_lines, new_scan, print_stats, scan_block, scan_stats
+from compressed_io import available_cpus, open_file, output_compression
+
+BLOCK_BYTES = 16 * 1024 * 1024
+WHITESPACE = b' \t\n\r\v\f'
+UPPERCASE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
 def setup_logging(output_dir):
     """Setup logging to both file and console"""
     log_file = output_dir / f"genome_cleaner_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
@@ -38,76 +47,235 @@ def clean_header(header, aggressive=True):
         cleaned = header.strip()
     return cleaned
 
-def process_genome(input_file, output_file, line_length=80):
-    """Process genome file and clean up formatting issues"""
+class WrappedFastaWriter:
+    """Write FASTA records in fixed-width lines, streaming each sequence in pieces
+
+    Keeps only the unfinished last line of the current record. index collects
+    the samtools faidx fields of every record written: name, length, offset of
+    the first base, bases and bytes per line.
+    """
+
+    def __init__(self, handle, line_length=80):
+        self.handle = handle
+        self.line_length = line_length
+        self.index = []
+        self.position = 0
+        self.name = None
+
+    def _write(self, data):
+        self.handle.write(data)
+        self.position += len(data)
+
+    def start_record(self, name):
+        self.end_record()
+        self._write(b'>' + name + b'\n')
+        self.name = name
+        self.offset = self.position
+        self.length = 0
+        self.pending = b''
+
+    def write_sequence(self, sequence):
+        """Add bases to the current record"""
+        width = self.line_length
+        data = self.pending + sequence
+        n_lines = len(data) // width
+        if n_lines:
+            # Full lines get their newlines in one array operation
+            lines = np.empty((n_lines, width + 1), dtype=np.uint8)
+            lines[:, :width] = np.frombuffer(data, dtype=np.uint8, count=n_lines * width).reshape(n_lines, width)
+            lines[:, width] = ord('\n')
+            self._write(lines.tobytes())
+        self.pending = data[n_lines * width:]
+        self.length += len(sequence)
+
+    def end_record(self):
+        if self.name is None:
+            return
+        if self.pending:
+            self._write(self.pending + b'\n')
+        # Like samtools, skip empty records and give single-line records their own line length
+        if self.length:
+            bases = min(self.length, self.line_length)
+            self.index.append((self.name.decode(), self.length, self.offset, bases, bases + 1))
+        self.name = None
+
+
+def write_fai(fai_file, index):
+    with open(fai_file, 'w') as f:
+        for fields in index:
+            f.write('\t'.join(str(field) for field in fields) + '\n')
+
+
+def iter_fasta_blocks(handle, block_bytes=BLOCK_BYTES, scan=None):
+    """Yield (header, None) for each header line and (None, bases) for the sequence after it
+
+    Reads handle (binary) in large blocks; bases are uppercase with all
+    whitespace removed, in pieces of at most about block_bytes, so no
+    sequence is ever held in memory whole. Lines before the first header are
+    skipped. With scan (check_fasta_format.new_scan()), the raw blocks are
+    also added to the format check.
+    """
+    carry = b''
+    offset = 0
+    in_record = False
+    while True:
+        block = handle.read(block_bytes)
+        data = carry + block
+        if not block:
+            cut = len(data)
+        else:
+            cut = data.rfind(b'\n') + 1
+            if not cut:
+                carry = data
+                continue
+        carry = data[cut:]
+        if scan is not None and cut:
+            scan_block(scan, np.frombuffer(data, dtype=np.uint8, count=cut), offset)
+            offset += cut
+        position = 0
+        while position < cut:
+            if data.startswith(b'>', position):
+                end = data.find(b'\n', position, cut)
+                end = cut if end < 0 else end
+                yield data[position + 1:end], None
+                in_record = True
+                position = end + 1
+                continue
+            header = data.find(b'\n>', position, cut)
+            end = cut if header < 0 else header + 1
+            if in_record:
+                bases = data[position:end].translate(UPPERCASE, WHITESPACE)
+                if bases:
+                    yield None, bases
+            position = end
+        if not block:
+            return
+
+
+def process_genome(input_file, output_file, line_length=80, scan=None):
+    """Process genome file and clean up formatting issues
+
+    Input may be gzip/bgzip/zstd-compressed; output is compressed when its
+    name ends in .gz, .bgz or .zst. The input is streamed as raw bytes, so
+    memory use does not depend on contig size. For uncompressed output a
+    samtools-compatible index (output_file + '.fai') is written in the same
+    pass, and with scan the input is format-checked in it too.
+    """
     total_sequences = 0
     total_bases = 0
     
     logging.info(f"Processing {input_file}")
     
+    fai_file = None if output_compression(output_file) else Path(f"{output_file}.fai")
     try:
-        with open(output_file, 'w') as out_handle:
-            fasta_writer = FastaIO.FastaWriter(out_handle, wrap=line_length)
-            fasta_writer.write_header()
+        with open_file(input_file, 'rb') as in_handle, open_file(output_file, 'wb') as out_handle:
+            writer = WrappedFastaWriter(out_handle, line_length)
             
-            for record in SeqIO.parse(input_file, "fasta"):
-                total_sequences += 1
-                total_bases += len(record.seq)
-                
-                # Clean header
-                record.id = clean_header(record.id)
-                record.description = record.id
+            for header, bases in iter_fasta_blocks(in_handle, scan=scan):
+                if bases is not None:
+                    writer.write_sequence(bases)
+                    total_bases += len(bases)
+                    continue
                 
-                # Convert sequence to uppercase
-                record.seq = record.seq.upper()
-                
-                # Write the record
-                fasta_writer.write_record(record)
+                # Clean header: only the ID is kept
+                title = header.decode().strip()
+                record_id = title.split(None, 1)[0] if title else ''
+                writer.start_record(clean_header(record_id).encode())
+                total_sequences += 1
                 
                 if total_sequences % 1000 == 0:
                     logging.info(f"Processed {total_sequences:,} sequences")
             
-            fasta_writer.write_footer()
+            writer.end_record()
+        if fai_file:
+            write_fai(fai_file, writer.index)
     
     except Exception as e:
         logging.error(f"Error processing file: {str(e)}")
         raise
     
+    if fai_file:
+        logging.info(f"Index written to {fai_file}")
     logging.info(f"Completed processing {total_sequences:,} sequences with {total_bases:,} bases")
     return total_sequences, total_bases
 
+def clean_and_check(input_file, output_file, line_length=80, check=False):
+    """Clean one genome, optionally format-checking it in the same read
+
+    Returns (total sequences, total bases, check report text or None).
+    """
+    scan = new_scan() if check else None
+    total_seqs, total_bases = process_genome(input_file, output_file, line_length, scan)
+    if not check:
+        return total_seqs, total_bases, None
+    
+    report = io.StringIO()
+    with contextlib.redirect_stdout(report):
+        print(f"\nChecking {input_file}...")
+        stats = scan_stats(scan)
+        if stats is None:
+            # Carriage returns or non-ASCII bytes: only the line-by-line check reports these exactly
+            stats = check_fasta_lines(input_file)
+        else:
+            for line_num in scan['empty_lines']:
+                print(f"Warning: Empty line at line {line_num}")
+        if stats:
+            print_stats(stats)
+    return total_seqs, total_bases, report.getvalue()
+
 def main():
     parser = argparse.ArgumentParser(description='Clean and standardize genome FASTA files')
-    parser.add_argument('input', type=str, help='Input FASTA file')
-    parser.add_argument('--output', type=str, help='Output FASTA file (default: input.cleaned.fa)')
+    parser.add_argument('input', type=str, nargs='+', help='Input FASTA file(s)')
+    parser.add_argument('--output', type=str, nargs='+', help='Output FASTA file(s), one per input, compressed if it ends in .gz/.bgz/.zst (default: input.cleaned.fa)')
     parser.add_argument('--line-length', type=int, default=80, help='Line length for output sequences (default: 80)')
     parser.add_argument('--aggressive-clean', action='store_true', help='Aggressively clean headers (remove all special characters)')
     parser.add_argument('--standardize-case', action='store_true', help='Convert all sequences to uppercase')
+    parser.add_argument('--check', action='store_true', help='Also print the check_fasta_format.py report for each input, from the same read')
+    parser.add_argument('--workers', type=int, help='Genomes processed at once (default: one per input, up to the available CPUs)')
     args = parser.parse_args()
     
-    input_path = Path(args.input)
+    input_paths = [Path(path) for path in args.input]
     if not args.output:
-        output_path = input_path.parent / f"{input_path.stem}.cleaned{input_path.suffix}"
+        output_paths = [path.parent / f"{path.stem}.cleaned{path.suffix}" for path in input_paths]
+    elif len(args.output) != len(input_paths):
+        parser.error(f"--output needs one file per input ({len(input_paths)}), got {len(args.output)}")
     else:
-        output_path = Path(args.output)
+        output_paths = [Path(path) for path in args.output]
     
-    # Create output directory if it doesn't exist
-    output_path.parent.mkdir(parents=True, exist_ok=True)
+    # Create output directories if they don't exist
+    for output_path in output_paths:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
     
     # Setup logging
-    setup_logging(output_path.parent)
+    setup_logging(output_paths[0].parent)
     
     logging.info(f"Starting genome cleaning process")
-    logging.info(f"Input file: {input_path}")
-    logging.info(f"Output file: {output_path}")
+    for input_path, output_path in zip(input_paths, output_paths):
+        logging.info(f"Input file: {input_path}")
+        logging.info(f"Output file: {output_path}")
     
-    try:
-        total_seqs, total_bases = process_genome(input_path, output_path, args.line_length)
-        logging.info(f"Successfully cleaned genome file:")
+    workers = max(1, min(args.workers or available_cpus(), len(input_paths)))
+    jobs = [(input_path, output_path, args.line_length, args.check)
+            for input_path, output_path in zip(input_paths, output_paths)]
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    futures = [pool.submit(clean_and_check, *job) if pool else None for job in jobs]
+    
+    failed = False
+    for job, future in zip(jobs, futures):
+        try:
+            total_seqs, total_bases, report = future.result() if future else clean_and_check(*job)
+        except Exception as e:
+            logging.error(f"Failed to process genome {job[0]}: {str(e)}")
+            failed = True
+            continue
+        logging.info(f"Successfully cleaned genome file {job[0]}:")
         logging.info(f"Total sequences processed: {total_seqs:,}")
         logging.info(f"Total bases processed: {total_bases:,}")
-    except Exception as e:
-        logging.error(f"Failed to process genome: {str(e)}")
+        if report:
+            print(report, end='')
+    if pool:
+        pool.shutdown()
+    if failed:
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Transparent gzip/bgzip/zstd reading and writing for FASTA and BLAST tables
+
+Compressed input is recognised by its magic bytes, compressed output by the
+file extension (.gz, .bgz, .zst). When pigz, bgzip or zstd are on the PATH
+they do the (de)compression in a separate multithreaded process; otherwise
+the gzip module or the optional zstandard package is used.
+"""
+
+import gzip
+import io
+import os
+import shutil
+import subprocess
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def available_cpus():
+    """Number of CPUs this process may use (respects Slurm/cgroup CPU affinity)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def detect_compression(path):
+    """Return 'bgzip', 'gzip', 'zstd' or None from the first bytes of a file"""
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    if header.startswith(GZIP_MAGIC):
+        # BGZF blocks are gzip members with a 'BC' extra subfield
+        if header[3] & 4 and header[12:14] == b'BC':
+            return 'bgzip'
+        return 'gzip'
+    if header.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def output_compression(path):
+    """Return the compression implied by an output file name"""
+    path = str(path)
+    if path.endswith('.bgz'):
+        return 'bgzip'
+    if path.endswith('.gz'):
+        return 'gzip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def _decompress_command(compression, threads):
+    # bgzip decompresses BGZF blocks in parallel; pigz only offloads I/O and checksums
+    if compression == 'bgzip' and shutil.which('bgzip'):
+        return ['bgzip', '-dc', '-@', str(threads)]
+    if compression in ('gzip', 'bgzip') and shutil.which('pigz'):
+        return ['pigz', '-dc', '-p', str(threads)]
+    if compression == 'zstd' and shutil.which('zstd'):
+        return ['zstd', '-dcq', '-T{}'.format(threads)]
+    return None
+
+
+def _compress_command(compression, threads):
+    if compression == 'bgzip' and shutil.which('bgzip'):
+        return ['bgzip', '-c', '-@', str(threads)]
+    # Without bgzip, .bgz output is plain gzip: still readable, but not indexable
+    if compression in ('gzip', 'bgzip') and shutil.which('pigz'):
+        return ['pigz', '-c', '-p', str(threads)]
+    if compression == 'zstd' and shutil.which('zstd'):
+        return ['zstd', '-cq', '-T{}'.format(threads)]
+    return None
+
+
+class _PipeFile:
+    """File object backed by a (de)compression subprocess"""
+
+    def __init__(self, command, path, mode):
+        self._output = None
+        if 'r' in mode:
+            self._proc = subprocess.Popen(command + [str(path)], stdout=subprocess.PIPE)
+            stream = self._proc.stdout
+        else:
+            self._output = open(path, 'wb')
+            self._proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=self._output)
+            stream = self._proc.stdin
+        self._file = stream if 'b' in mode else io.TextIOWrapper(stream)
+        self._command = command[0]
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        returncode = self._proc.wait()
+        if self._output is not None:
+            self._output.close()
+        # A reader closed early makes the decompressor die of SIGPIPE, which is fine
+        if returncode not in (0, -13):
+            raise OSError("{} exited with status {}".format(self._command, returncode))
+
+
+def open_file(path, mode='rt', threads=None):
+    """Open a plain, gzip/bgzip or zstd file for reading or writing
+
+    Modes are 'rt', 'rb', 'wt' and 'wb' ('r' and 'w' mean text).
+    """
+    if mode in ('r', 'w'):
+        mode += 't'
+    threads = threads or available_cpus()
+
+    if 'r' in mode:
+        compression = detect_compression(path)
+        command = _decompress_command(compression, threads)
+    else:
+        compression = output_compression(path)
+        command = _compress_command(compression, threads)
+
+    if compression is None:
+        return open(path, mode)
+    if command is not None:
+        return _PipeFile(command, path, mode)
+    if compression in ('gzip', 'bgzip'):
+        return gzip.open(path, mode)
+    if zstandard is None:
+        raise OSError("{} is zstd-compressed; install the zstd command or the zstandard package".format(path))
+    return zstandard.open(path, mode)
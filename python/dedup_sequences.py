@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Collapse identical protein sequences to one representative each
+
+RefSeq releases repeat the same protein under many accessions (one per
+strain), and makeblastdb indexes every copy. collapse writes one
+representative per distinct sequence (the first one seen) plus a members
+table, representative -> the other IDs with the identical sequence, so a
+best hit against a representative can be expanded when reporting.
+
+Memory stays bounded whatever the input size: records are first spread
+over partition files on disk by a hash of their sequence, then each
+partition is deduplicated on its own. Representatives are written in input
+order within each partition.
+
+Only collapse a donor database (bacterial or fungal proteins) on its own,
+before the prefixed lineage references are added: an identical sequence
+shared by a plant and a bacterial entry must keep both.
+
+The same works on the query side: proteomes list identical isoforms under
+several accessions. BLAST the collapsed queries, then expand rewrites every
+representative's rows once per member query ID, so the filter scripts see
+the table they would have got from BLASTing every query.
+
+Usage:
+    dedup_sequences.py collapse bacterial_proteins.faa --output bacterial_proteins.dedup.faa \
+        --members bacterial_proteins.members.tsv.gz
+    dedup_sequences.py expand unique_vs_bacterial.out --members query.members.tsv \
+        --query query.faa --output query_vs_bacterial.out
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+from blast_hits import query_blocks
+from compressed_io import detect_compression, open_file
+
+PARTITION_BYTES = 256 * 1024 * 1024
+MAX_PARTITIONS = 512
+
+
+def normalize_sequence(sequence):
+    """Uppercase residues without whitespace or the trailing stop"""
+    return ''.join(sequence.split()).upper().rstrip('*')
+
+
+def iter_fasta(fasta_file):
+    """Yield (header, sequence) pairs; header excludes the '>'"""
+    header = None
+    parts = []
+    with open_file(fasta_file, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(parts)
+                header = line[1:].rstrip('\n')
+                parts = []
+            elif header is not None:
+                parts.append(line.strip())
+    if header is not None:
+        yield header, ''.join(parts)
+
+
+def write_fasta_record(f, header, sequence, width=80):
+    f.write('>{}\n'.format(header))
+    for i in range(0, len(sequence), width):
+        f.write(sequence[i:i + width] + '\n')
+
+
+def default_partitions(fasta_files):
+    """Enough partitions that each one fits comfortably in memory"""
+    total = 0
+    for fasta_file in fasta_files:
+        size = os.path.getsize(fasta_file)
+        # Compressed protein FASTA expands roughly 4x
+        total += size * 4 if detect_compression(fasta_file) else size
+    return max(1, min(MAX_PARTITIONS, -(-total // PARTITION_BYTES)))
+
+
+def _partition_of(sequence, n_partitions):
+    digest = hashlib.blake2b(sequence.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % n_partitions
+
+
+def collapse_fasta(fasta_files, output_fasta, members_file, n_partitions=None, tmp_dir=None):
+    """Write one representative per distinct sequence and the representative -> members table
+
+    Returns (n_sequences, n_representatives).
+    """
+    n_partitions = n_partitions or default_partitions(fasta_files)
+    work_dir = tempfile.mkdtemp(prefix='dedup_', dir=tmp_dir)
+    try:
+        # Pass 1: spread records over partitions by sequence hash
+        partitions = [open(os.path.join(work_dir, 'part{}.tsv'.format(i)), 'w') for i in range(n_partitions)]
+        n_sequences = 0
+        try:
+            for fasta_file in fasta_files:
+                for header, sequence in iter_fasta(fasta_file):
+                    sequence = normalize_sequence(sequence)
+                    partitions[_partition_of(sequence, n_partitions)].write(
+                        '{}\t{}\t{}\n'.format(n_sequences, header.replace('\t', ' '), sequence))
+                    n_sequences += 1
+        finally:
+            for partition in partitions:
+                partition.close()
+
+        # Pass 2: deduplicate one partition at a time
+        n_representatives = 0
+        with open_file(output_fasta, 'w') as out, open_file(members_file, 'w') as members_out:
+            members_out.write('representative\tmembers\n')
+            for i in range(n_partitions):
+                path = os.path.join(work_dir, 'part{}.tsv'.format(i))
+                groups = {}
+                with open(path, 'r') as f:
+                    for line in f:
+                        _, rest = line.rstrip('\n').split('\t', 1)
+                        header, sequence = rest.rsplit('\t', 1)
+                        group = groups.get(sequence)
+                        if group is None:
+                            groups[sequence] = [header]
+                        else:
+                            group.append(header.split(None, 1)[0])
+                os.remove(path)
+                # Dicts keep insertion order, which is input order within the partition
+                for sequence, group in groups.items():
+                    write_fasta_record(out, group[0], sequence)
+                    if len(group) > 1:
+                        members_out.write('{}\t{}\n'.format(group[0].split(None, 1)[0], ','.join(group[1:])))
+                n_representatives += len(groups)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return n_sequences, n_representatives
+
+
+def load_members(members_file, representatives=None):
+    """Read representative -> [member IDs], optionally only for the given representatives"""
+    members = {}
+    with open_file(members_file, 'r') as f:
+        next(f, None)
+        for line in f:
+            representative, _, rest = line.rstrip('\n').partition('\t')
+            if representatives is None or representative in representatives:
+                members[representative] = rest.split(',') if rest else []
+    return members
+
+
+def format_members(members, representative):
+    """Table cell listing the sequences identical to a reported hit"""
+    return ','.join(members.get(representative, ())) or '-'
+
+
+def expand_blast_rows(blast_file, members_file, output_file, query_fasta=None):
+    """Repeat each representative's BLAST rows for its members, with their query IDs
+
+    With query_fasta (the FASTA before collapsing), queries are written in its
+    order, exactly as a BLAST of the full FASTA would order them; the
+    representative rows are then copied by seeking, so blast_file must be an
+    uncompressed, grouped table. Without it, each member's rows follow its
+    representative's. Returns the number of rows written.
+    """
+    members = load_members(members_file)
+    n_rows = 0
+    tmp_file = '{}.tmp{}'.format(output_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as out:
+            def write_block(rows, query_ids):
+                written = 0
+                for query_id in query_ids:
+                    prefix = query_id.encode()
+                    for row in rows:
+                        out.write(prefix + row[row.index(b'\t'):])
+                        written += 1
+                return written
+
+            if query_fasta is None:
+                current = None
+                rows = []
+                with open_file(blast_file, 'rb') as f:
+                    for line in f:
+                        if b'\t' not in line:
+                            continue
+                        query_id = line.split(b'\t', 1)[0]
+                        if query_id != current:
+                            if current is not None:
+                                rep = current.decode()
+                                n_rows += write_block(rows, [rep] + members.get(rep, []))
+                            current = query_id
+                            rows = []
+                        rows.append(line)
+                    if current is not None:
+                        rep = current.decode()
+                        n_rows += write_block(rows, [rep] + members.get(rep, []))
+            else:
+                representative_of = {}
+                for rep, group in members.items():
+                    for member in group:
+                        representative_of[member] = rep
+                blocks = query_blocks(blast_file)
+                with open(blast_file, 'rb') as f:
+                    def read_rows(rep):
+                        start, length = blocks[rep]
+                        f.seek(start)
+                        return [row for row in f.read(length).splitlines(True) if b'\t' in row]
+
+                    used = set()
+                    for header, _ in iter_fasta(query_fasta):
+                        fields = header.split(None, 1)
+                        if not fields:
+                            continue
+                        rep = representative_of.get(fields[0], fields[0]).encode()
+                        if rep in blocks:
+                            used.add(rep)
+                            n_rows += write_block(read_rows(rep), [fields[0]])
+                    # Representatives missing from query_fasta: keep their hits rather than drop them
+                    for rep in sorted(set(blocks) - used, key=lambda rep: blocks[rep][0]):
+                        name = rep.decode()
+                        n_rows += write_block(read_rows(rep), [name] + members.get(name, []))
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collapse identical protein sequences')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    collapse = subparsers.add_parser('collapse', help='Write one representative per distinct sequence')
+    collapse.add_argument('fasta', nargs='+', help='Protein FASTA file(s), optionally compressed')
+    collapse.add_argument('--output', required=True, help='Deduplicated FASTA')
+    collapse.add_argument('--members', required=True,
+                          help='Representative -> identical members table (TSV, .gz/.zst to compress)')
+    collapse.add_argument('--partitions', type=int,
+                          help='On-disk hash partitions (default: one per ~256 MB of sequence)')
+    collapse.add_argument('--tmp-dir', help='Directory for partition files (default: system temp)')
+
+    expand = subparsers.add_parser('expand',
+                                   help='Rewrite BLAST rows of collapsed queries for every member query')
+    expand.add_argument('blast', help='BLAST tabular output of the collapsed queries')
+    expand.add_argument('--members', required=True, help='Members table written by collapse')
+    expand.add_argument('--output', required=True, help='Expanded BLAST table')
+    expand.add_argument('--query',
+                        help='Query FASTA before collapsing; writes queries in its order (recommended)')
+
+    args = parser.parse_args()
+
+    if args.command == 'expand':
+        try:
+            n_rows = expand_blast_rows(args.blast, args.members, args.output, args.query)
+        except OSError as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+        print("Wrote {} rows to {}".format(n_rows, args.output))
+        return
+
+    try:
+        n_sequences, n_representatives = collapse_fasta(
+            args.fasta, args.output, args.members, args.partitions, args.tmp_dir)
+    except OSError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("{} sequences collapsed to {} distinct sequences ({} duplicates removed)".format(
+        n_sequences, n_representatives, n_sequences - n_representatives))
+    print("Deduplicated FASTA written to {}".format(args.output))
+    print("Members table written to {}".format(args.members))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,91 @@
+import argparse
 import os
 from subprocess import run
 
-def extract_sequences(genome_file, cluster_file, output_fasta):
+import pysam
+
+from blast_cache import cached_blast
+from low_complexity import filter_fasta
+
+
+def read_cluster_regions(cluster_file):
+    """(ref, start, end) of each cluster in a find_clusters.py detailed or BED file"""
+    regions = []
+    with open(cluster_file, 'r') as infile:
+        for line in infile:
+            fields = line.strip().split()
+            # Skip the header and anything without integer coordinates
+            if len(fields) >= 3 and fields[1].isdigit() and fields[2].isdigit():
+                regions.append((fields[0], int(fields[1]), int(fields[2])))
+    return regions
+
+
+def merge_regions(regions, lengths, flank=0):
+    """
+    Pad regions by flank (clipped to the reference) and merge any that overlap
+    or touch, sorted by reference and start.
+    """
+    merged = []
+    for ref, start, end in sorted(regions):
+        start = max(0, start - flank)
+        end = min(lengths[ref], end + flank)
+        if merged and merged[-1][0] == ref and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([ref, start, end])
+    return [tuple(region) for region in merged]
+
+
+def extract_sequences(genome_file, cluster_file, output_fasta, flank=0, batch_size=1000):
     """
     Extract sequences from a genome based on cluster coordinates.
+
+    Reads only the needed bases through the FASTA index (genome.fai, built on
+    first use; the genome must be plain or bgzip-compressed). Records are
+    named ref:start-end like bedtools getfasta and written in batches.
     """
-    # Create a BED file from the cluster file
-    bed_file = cluster_file.replace(".txt", ".bed")
-    with open(cluster_file, 'r') as infile, open(bed_file, 'w') as outfile:
-        for line_number, line in enumerate(infile):
-            # Skip header
-            if line_number == 0:
-                continue
-            # Extract ref, start, and end fields
-            fields = line.strip().split()
-            if len(fields) >= 3:
-                ref, start, end = fields[0], fields[1], fields[2]
-                outfile.write(f"{ref}\t{start}\t{end}\n")
+    with pysam.FastaFile(genome_file) as genome:
+        lengths = dict(zip(genome.references, genome.lengths))
+        regions = read_cluster_regions(cluster_file)
+        missing = {ref for ref, _, _ in regions} - set(lengths)
+        if missing:
+            raise ValueError(f"{len(missing)} cluster references are not in {genome_file} "
+                             f"(e.g. {sorted(missing)[0]})")
+        regions = merge_regions(regions, lengths, flank)
 
-    # Use bedtools to extract the sequences
-    fasta_output = output_fasta
-    run([
-        "bedtools", "getfasta", 
-        "-fi", genome_file, 
-        "-bed", bed_file, 
-        "-fo", fasta_output
-    ])
+        tmp_file = f"{output_fasta}.tmp{os.getpid()}"
+        try:
+            with open(tmp_file, 'w') as outfile:
+                batch = []
+                for ref, start, end in regions:
+                    batch.append(f">{ref}:{start}-{end}\n{genome.fetch(ref, start, end)}\n")
+                    if len(batch) >= batch_size:
+                        outfile.write(''.join(batch))
+                        batch = []
+                outfile.write(''.join(batch))
+            os.replace(tmp_file, output_fasta)
+        except Exception:
+            # Don't leave a partial temp file behind (fetch errors, full disk)
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
 
-    print(f"Sequences extracted to {fasta_output}")
+    print(f"{len(regions)} regions extracted to {output_fasta}")
+    return len(regions)
 
 
-def run_blast(fasta_file, db, output_file):
+def run_blast(fasta_file, db, output_file, cache_dir=None):
     """
     Run BLAST on the extracted sequences against a specified database.
+
+    With cache_dir, sequences already searched against this database (in
+    either orientation) are served from the cache and only the rest are
+    BLASTed; see blast_cache.py.
     """
+    if cache_dir is not None:
+        cached_blast([(fasta_file, output_file)], db, cache_dir)
+        print(f"BLAST results saved to {output_file}")
+        return
     run([
         "blastn", 
         "-query", fasta_file, 
@@ -48,10 +100,15 @@ def run_blast(fasta_file, db, output_file):
 
 # Main workflow
 if __name__ == "__main__":
-    # Define paths
+    parser = argparse.ArgumentParser(description='Extract cluster sequences and optionally BLAST them')
+    parser.add_argument('--flank', type=int, default=0,
+                        help='Bases added on each side of every cluster before merging (default: 0)')
+    args = parser.parse_args()
+
+    # Define paths; the cluster coordinates come from the cleaned genomes
     genomes = {
-        "bk": "/export/martinsons/adam/input_sequences/B_kinseyi_genome.fna",
-        "qv": "/export/martinsons/adam/input_sequences/Q_virginiana_genome.genome.fa"
+        "bk": "/export/martinsons/adam/input_sequences/cleaned/B_kinseyi_genome.cleaned.fna",
+        "qv": "/export/martinsons/adam/input_sequences/cleaned/Q_virginiana_genome.cleaned.fa"
     }
     cluster_files = {
         "bk": "/export/martinsons/adam/kmer_analysis/clusters/bk_clusters.detailed.txt",
@@ -64,10 +121,20 @@ if __name__ == "__main__":
 
     # Extract sequences for each genome
     for key in genomes:
-        extract_sequences(genomes[key], cluster_files[key], output_fastas[key])
+        extract_sequences(genomes[key], cluster_files[key], output_fastas[key], flank=args.flank)
+
+    # Drop regions that are mostly low complexity (DUST); they cannot be BLASTed usefully
+    filtered_fastas = {}
+    for key in output_fastas:
+        filtered_fastas[key] = output_fastas[key].replace(".fasta", ".filtered.fasta")
+        kept, dropped = filter_fasta(output_fastas[key], filtered_fastas[key], max_masked=0.5)
+        print(f"{key}: kept {kept} regions, dropped {dropped} low-complexity regions")
 
-    # Optionally, run BLAST (uncomment the following lines if needed)
+    # Optionally, run BLAST (uncomment the following lines if needed). Both sets go through
+    # one cache, so sequences shared between them or searched in an earlier run are not re-BLASTed
     # blast_db = "/path/to/blast/db/nt"  # Update with your BLAST database path
-    # for key in output_fastas:
-    #     output_blast = output_fastas[key].replace(".fasta", "_blast_results.txt")
-    #     run_blast(output_fastas[key], blast_db, output_blast)
+    # blast_cache = "/export/martinsons/adam/kmer_analysis/blast_cache"
+    # jobs = [(filtered_fastas[key], output_fastas[key].replace(".fasta", "_blast_results.txt"))
+    #         for key in filtered_fastas]
+    # n_sequences, n_distinct, n_searched = cached_blast(jobs, blast_db, blast_cache)
+    # print(f"{n_sequences} sequences, {n_distinct} distinct, {n_searched} BLASTed")
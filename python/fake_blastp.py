@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Stand-in for blastp to exercise run_blast.py without a BLAST database
+
+Accepts blastp's -query/-db/-out/-outfmt/-evalue/-num_threads options (others
+are ignored) and writes three deterministic outfmt 6 hits per query: one
+plant (At_|), one insect (Nv_|) and one bacterial (WP_) subject, with
+identities derived from the query and subject IDs. If -db names a FASTA
+file, the subjects are picked from its headers instead.
+
+Environment:
+    FAKE_BLASTP_SLEEP  seconds to sleep per query (default: 0)
+    FAKE_BLASTP_FAIL   comma-separated query file names to fail on, after
+                       writing half of their output
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+
+def fake_identity(query_id, subject_id):
+    digest = hashlib.md5('{}\t{}'.format(query_id, subject_id).encode()).digest()
+    return 20 + (int.from_bytes(digest[:4], 'big') % 80000) / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake blastp for testing', prefix_chars='-')
+    parser.add_argument('-query', required=True)
+    parser.add_argument('-db', required=True)
+    parser.add_argument('-out', required=True)
+    parser.add_argument('-outfmt', default='6')
+    parser.add_argument('-evalue', default='10')
+    parser.add_argument('-num_threads', default='1')
+    args, _ = parser.parse_known_args()
+
+    with open(args.query, 'r') as f:
+        query_ids = [line[1:].split(None, 1)[0] for line in f if line.startswith('>')]
+
+    subject_ids = None
+    if os.path.isfile(args.db):
+        with open(args.db, 'r') as f:
+            subject_ids = [line[1:].split(None, 1)[0] for line in f if line.startswith('>')]
+
+    fail = os.path.basename(args.query) in os.environ.get('FAKE_BLASTP_FAIL', '').split(',')
+    delay = float(os.environ.get('FAKE_BLASTP_SLEEP', 0))
+    with open(args.out, 'w') as out:
+        for n, query_id in enumerate(query_ids):
+            if fail and n >= len(query_ids) // 2:
+                print("fake_blastp: simulated failure on {}".format(args.query), file=sys.stderr)
+                sys.exit(2)
+            time.sleep(delay)
+            number = int(hashlib.md5(query_id.encode()).hexdigest()[:6], 16)
+            if subject_ids:
+                subjects = [subject_ids[(number + k) % len(subject_ids)] for k in range(3)]
+            else:
+                subjects = ['At_|fake{}'.format(number), 'Nv_|fake{}'.format(number),
+                            'WP_{:09d}.1'.format(number)]
+            for subject_id in subjects:
+                out.write('{}\t{}\t{:.3f}\t100\t0\t0\t1\t100\t1\t100\t1e-20\t200\n'.format(
+                    query_id, subject_id, fake_identity(query_id, subject_id)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,38 @@
 #!/usr/bin/env python3
-import sys
-from collections import defaultdict
+import argparse
 
-def parse_blast_results(blast_file):
-    hits = defaultdict(lambda: {'oak': [], 'insect': []})
+from blast_columns import best_hit_table, load_blast_columns, select_candidates
+from blast_hits import add_filter_arguments, expand_blast_files, iter_best_hits_files
+from blast_watch import watch_blast_chunks, write_candidate_table
+from hgt_sweep import DEFAULT_THRESHOLDS, parse_grid, run_sweep
+from lineage import INSECTA, QUERCUS, SubjectClassifier, TaxonIndex
+
+def subject_classifier(taxon_index=None):
+    """Nasonia/Apis prefixes are insect, oak prefixes are oak, anything else is ignored
+
+    With a taxon index, unprefixed accessions are placed by lineage instead.
+    """
+    return SubjectClassifier([('Nv_', 'insect'), ('Am_', 'insect'), ('Oak_', 'oak')], default=None,
+                             taxon_index=taxon_index,
+                             lineages={INSECTA: 'insect', QUERCUS: 'oak'})
+
+categorize_subject = subject_classifier()
+
+def parse_blast_results(blast_files, workers=None, categorize=categorize_subject):
     print("Parsing BLAST results...")
-    with open(blast_file, 'r') as f:
-        for line in f:
-            fields = line.strip().split('\t')
-            query_id = fields[0]
-            subject_id = fields[1]
-            identity = float(fields[2])
-            if subject_id.startswith(('Nv_', 'Am_')):  # Adjust for actual Nasonia and Apis prefixes
-                category = 'insect'
-            elif subject_id.startswith('Oak_'):  # Adjust for oak prefixes
-                category = 'oak'
-            else:
-                continue
-            hits[query_id][category].append({
-                'subject': subject_id,
-                'identity': identity
-            })
-    print("Found hits for {} query proteins".format(len(hits)))
-    return hits
+    return iter_best_hits_files(blast_files, categorize, workers=workers)
 
 def find_candidates(hits, min_difference=20, min_oak=75, max_insect=50, max_identity=90):
     print("Finding candidates with updated criteria...")
     candidates = []
-    for query_id, categories in hits.items():
-        if not categories['oak'] or not categories['insect']:
+    n_queries = 0
+    for query_id, best in hits:
+        n_queries += 1
+        if 'oak' not in best or 'insect' not in best:
             continue
         
-        best_oak = max(categories['oak'], key=lambda x: x['identity'])
-        best_insect = max(categories['insect'], key=lambda x: x['identity'])
+        best_oak = best['oak']
+        best_insect = best['insect']
         
         oak_id = best_oak['identity']
         insect_id = best_insect['identity']
@@ -53,35 +53,93 @@ def find_candidates(hits, min_difference=20, min_oak=75, max_insect=50, max_iden
                 'insect_identity': insect_id,
                 'difference': difference
             })
+    print("Found hits for {} query proteins".format(n_queries))
     return candidates
 
+def find_candidates_columnar(blast_files, min_difference=20, min_oak=75, max_insect=50, max_identity=90, cache=True, workers=None,
+        categorize=categorize_subject):
+    print("Loading BLAST results into columns...")
+    columns = load_blast_columns(blast_files, categorize, cache=cache,
+                                 workers=workers)
+    table = best_hit_table(columns, 'oak', 'insect')
+    print("Finding candidates with updated criteria...")
+    print("Found hits for {} query proteins".format(table['n_queries']))
+    candidates = []
+    for query_id, best_oak, best_insect, difference in select_candidates(
+            table, min_difference, max_identity, min_oak, max_insect):
+        oak_id = best_oak['identity']
+        insect_id = best_insect['identity']
+        candidates.append({
+            'query': query_id,
+            'oak_hit': best_oak['subject'],
+            'oak_identity': oak_id,
+            'insect_hit': best_insect['subject'],
+            'insect_identity': insect_id,
+            'difference': difference
+        })
+    return candidates
+
+def format_candidates(candidates):
+    lines = ["{}\t{}\t{}\t{}\t{}\t{}".format(
+        "Query_protein",
+        "Best_oak_hit",
+        "Oak_identity",
+        "Best_insect_hit",
+        "Insect_identity",
+        "Difference"
+    )]
+    for c in candidates:
+        lines.append("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
+            c['query'],
+            c['oak_hit'],
+            c['oak_identity'],
+            c['insect_hit'],
+            c['insect_identity'],
+            c['difference']
+        ))
+    return lines
 
 def main():
-    if len(sys.argv) != 2:
-        sys.exit("Usage: {} <blast_output>".format(sys.argv[0]))
-    
-    blast_file = sys.argv[1]
-    hits = parse_blast_results(blast_file)
-    candidates = find_candidates(hits)
+    parser = argparse.ArgumentParser(description='Filter for B. kinseyi proteins closer to oak than to Nasonia/Apis')
+    parser.add_argument('blast_files', nargs='+',
+                       help='BLAST results file, or the per-chunk outputs (files or a quoted glob)')
+    add_filter_arguments(parser)
+    args = parser.parse_args()
+    grid = None
+    if args.sweep:
+        try:
+            grid = parse_grid(args.sweep, DEFAULT_THRESHOLDS, 'oak', 'insect')
+        except ValueError as e:
+            parser.error(str(e))
+    categorize = subject_classifier(TaxonIndex(args.taxon_index) if args.taxon_index else None)
+
+    if args.watch:
+        def update(hits):
+            candidates = find_candidates(hits)
+            write_candidate_table(args.watch, format_candidates(candidates))
+            print("{} candidates so far written to {}".format(len(candidates), args.watch))
+        watch_blast_chunks(args.blast_files, categorize, args.watch + '.checkpoint.json', update,
+                           expected=args.expected_chunks, interval=args.interval, settle=args.settle,
+                           workers=args.workers)
+        return
+
+    blast_files = expand_blast_files(args.blast_files)
+
+    if args.sweep:
+        run_sweep(blast_files, categorize, 'oak', 'insect', grid,
+                  args.sweep_output or blast_files[0] + '.sweep',
+                  cache=not args.no_cache, workers=args.workers)
+        return
+
+    if args.engine == 'columnar':
+        candidates = find_candidates_columnar(blast_files, cache=not args.no_cache,
+            workers=args.workers, categorize=categorize)
+    else:
+        hits = parse_blast_results(blast_files, args.workers, categorize)
+        candidates = find_candidates(hits)
     
     if candidates:
-        print("{}\t{}\t{}\t{}\t{}\t{}".format(
-            "Query_protein",
-            "Best_oak_hit",
-            "Oak_identity",
-            "Best_insect_hit",
-            "Insect_identity",
-            "Difference"
-        ))
-        for c in candidates:
-            print("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
-                c['query'],
-                c['oak_hit'],
-                c['oak_identity'],
-                c['insect_hit'],
-                c['insect_identity'],
-                c['difference']
-            ))
+        print('\n'.join(format_candidates(candidates)))
         print("Found {} potential candidates".format(len(candidates)))
     else:
         print("No candidates found matching criteria")
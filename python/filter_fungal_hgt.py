@@ -1,45 +1,45 @@
 #!/usr/bin/env python3
 import argparse
 import sys
-from collections import defaultdict
 
-def parse_blast_results(blast_file, min_difference=20, max_conserved=90, min_fungal=75, max_plant=50):
-    """Parse BLAST results and categorize hits by fungal vs plant"""
-    hits = defaultdict(lambda: {'fungal': [], 'plant': []})
+from blast_columns import best_hit_table, load_blast_columns, select_candidates
+from blast_hits import add_filter_arguments, expand_blast_files, iter_best_hits_files
+from blast_watch import watch_blast_chunks, write_candidate_table
+from compressed_io import open_file
+from dedup_sequences import format_members, load_members
+from hgt_sweep import THRESHOLDS, parse_grid, run_sweep
+from lineage import FUNGI, VIRIDIPLANTAE, SubjectClassifier, TaxonIndex
+from protein_store import ProteinStore, format_protein, protein_columns
 
-    with open(blast_file, 'r') as f:
-        for line in f:
-            fields = line.strip().split('\t')
+def subject_classifier(taxon_index=None):
+    """Arabidopsis/Populus prefixes are plant, everything else is fungal
 
-            query_id = fields[0]
-            subject_id = fields[1]
-            identity = float(fields[2])
+    With a taxon index, unprefixed accessions are placed by lineage instead.
+    """
+    return SubjectClassifier([('At_|', 'plant'), ('Pt_|', 'plant')], default='fungal',
+                             taxon_index=taxon_index,
+                             lineages={VIRIDIPLANTAE: 'plant', FUNGI: 'fungal'})
 
-            # Categorize based on subject ID prefixes
-            if subject_id.startswith(('At_|', 'Pt_|')):
-                category = 'plant'
-            else:
-                category = 'fungal'
+categorize_subject = subject_classifier()
 
-            hits[query_id][category].append({
-                'subject': subject_id,
-                'identity': identity
-            })
-
-    return hits
+def parse_blast_results(blast_files, workers=None, categorize=categorize_subject):
+    """Stream BLAST results as best fungal and plant hits for each query"""
+    return iter_best_hits_files(blast_files, categorize, workers=workers)
 
 def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_fungal=75, max_plant=50):
     """Find proteins where fungal identity is significantly higher than plant identity"""
     candidates = {}
+    n_queries = 0
 
-    for query_id, categories in hits.items():
+    for query_id, best in hits:
+        n_queries += 1
         # Skip if missing either category
-        if not categories['fungal'] or not categories['plant']:
+        if 'fungal' not in best or 'plant' not in best:
             continue
 
         # Get best hits
-        best_fungal = max(categories['fungal'], key=lambda x: x['identity'])
-        best_plant = max(categories['plant'], key=lambda x: x['identity'])
+        best_fungal = best['fungal']
+        best_plant = best['plant']
 
         fungal_id = best_fungal['identity']
         plant_id = best_plant['identity']
@@ -55,3 +55,126 @@ def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_fungal=75
                 'fungal_hit': best_fungal,
                 'plant_hit': best_plant,
                 'difference': difference
+            }
+
+    print(f"Found hits for {n_queries} query proteins")
+    return candidates
+
+def find_hgt_candidates_columnar(blast_files, min_difference=20, max_conserved=90, min_fungal=75, max_plant=50, cache=True, workers=None,
+        categorize=categorize_subject):
+    """Columnar-engine equivalent of find_hgt_candidates, reading the BLAST files directly"""
+    columns = load_blast_columns(blast_files, categorize, cache=cache,
+                                 workers=workers)
+    table = best_hit_table(columns, 'fungal', 'plant')
+    print(f"Found hits for {table['n_queries']} query proteins")
+
+    candidates = {}
+    for query_id, best_fungal, best_plant, difference in select_candidates(
+            table, min_difference, max_conserved, min_fungal, max_plant):
+        candidates[query_id] = {
+            'fungal_hit': best_fungal,
+            'plant_hit': best_plant,
+            'difference': difference
+        }
+
+    return candidates
+
+def format_candidates(candidates, members=None, store=None):
+    """Output lines for candidates, sorted by difference in identity"""
+    sorted_candidates = sorted(
+        candidates.items(),
+        key=lambda x: x[1]['difference'],
+        reverse=True
+    )
+
+    lines = ["Oak_protein\tBest_fungal_hit\tFungal_identity\tBest_plant_hit\tPlant_identity\tDifference"]
+    for query_id, data in sorted_candidates:
+        lines.append(
+            f"{query_id}\t{data['fungal_hit']['subject']}\t{data['fungal_hit']['identity']:.1f}\t"
+            f"{data['plant_hit']['subject']}\t{data['plant_hit']['identity']:.1f}\t{data['difference']:.1f}"
+        )
+        if members is not None:
+            lines[-1] += '\t' + format_members(members, data['fungal_hit']['subject'])
+        if store is not None:
+            lines[-1] += '\t' + format_protein(store, data['fungal_hit']['subject'])
+    if members is not None:
+        lines[0] += "\tIdentical_fungal_hits"
+    if store is not None:
+        lines[0] += '\t' + '\t'.join(protein_columns('fungal'))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Filter for oak fungal HGT candidates')
+    parser.add_argument('blast_files', nargs='+',
+                       help='Combined BLAST results file, or the per-chunk outputs (files or a quoted glob)')
+    parser.add_argument('--min-difference', type=float, default=20,
+                       help='Minimum difference between fungal and plant identity (default: 20)')
+    parser.add_argument('--max-conserved', type=float, default=90,
+                       help='Maximum identity to filter out conserved proteins (default: 90)')
+    parser.add_argument('--min-fungal', type=float, default=75,
+                       help='Minimum fungal identity required (default: 75)')
+    parser.add_argument('--max-plant', type=float, default=50,
+                       help='Maximum plant identity allowed (default: 50)')
+    parser.add_argument('--output', help='Output file, compressed if it ends in .gz/.bgz/.zst (default: stdout)')
+    add_filter_arguments(parser, 'fungal')
+    args = parser.parse_args()
+    thresholds = (
+        args.min_difference,
+        args.max_conserved,
+        args.min_fungal,
+        args.max_plant
+    )
+    grid = None
+    if args.sweep:
+        try:
+            grid = parse_grid(args.sweep, dict(zip(THRESHOLDS, thresholds)), 'fungal', 'plant')
+        except ValueError as e:
+            parser.error(str(e))
+    categorize = subject_classifier(TaxonIndex(args.taxon_index) if args.taxon_index else None)
+    store = ProteinStore(args.protein_store) if args.protein_store else None
+
+    if args.watch:
+        def update(hits):
+            candidates = find_hgt_candidates(hits, *thresholds)
+            members = None
+            if args.members:
+                members = load_members(args.members, {data['fungal_hit']['subject'] for data in candidates.values()})
+            write_candidate_table(args.watch, format_candidates(candidates, members, store))
+            print("{} candidates so far written to {}".format(len(candidates), args.watch))
+        watch_blast_chunks(args.blast_files, categorize, args.watch + '.checkpoint.json', update,
+                           expected=args.expected_chunks, interval=args.interval,
+                           settle=args.settle, workers=args.workers)
+        return
+
+    blast_files = expand_blast_files(args.blast_files)
+
+    if args.sweep:
+        run_sweep(blast_files, categorize, 'fungal', 'plant', grid,
+                  args.sweep_output or blast_files[0] + '.sweep',
+                  cache=not args.no_cache, workers=args.workers)
+        return
+
+    print("Parsing BLAST results and finding HGT candidates...")
+    if args.engine == 'columnar':
+        candidates = find_hgt_candidates_columnar(blast_files, *thresholds, cache=not args.no_cache,
+            workers=args.workers, categorize=categorize)
+    else:
+        hits = parse_blast_results(blast_files, args.workers, categorize)
+        candidates = find_hgt_candidates(hits, *thresholds)
+
+    members = None
+    if args.members:
+        members = load_members(args.members, {data['fungal_hit']['subject'] for data in candidates.values()})
+    output_lines = format_candidates(candidates, members, store)
+
+    # Write output
+    if args.output:
+        with open_file(args.output, 'w') as f:
+            f.write('\n'.join(output_lines))
+    else:
+        print('\n'.join(output_lines))
+
+    print(f"\nFound {len(candidates)} potential HGT candidates", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,40 @@
 # filter_oak_bact_hgt.py
 #!/usr/bin/env python3
-import sys
-from collections import defaultdict
+import argparse
 
-def parse_blast_results(blast_file):
-    hits = defaultdict(lambda: {'bacterial': [], 'plant': []})
+from blast_columns import best_hit_table, load_blast_columns, select_candidates
+from blast_hits import add_filter_arguments, expand_blast_files, iter_best_hits_files
+from blast_watch import watch_blast_chunks, write_candidate_table
+from dedup_sequences import format_members, load_members
+from hgt_sweep import DEFAULT_THRESHOLDS, parse_grid, run_sweep
+from lineage import BACTERIA, VIRIDIPLANTAE, SubjectClassifier, TaxonIndex
+from protein_store import ProteinStore, format_protein, protein_columns
+
+def subject_classifier(taxon_index=None):
+    """Arabidopsis/Populus prefixes are plant, everything else is bacterial
+
+    With a taxon index, unprefixed accessions are placed by lineage instead.
+    """
+    return SubjectClassifier([('At_|', 'plant'), ('Pt_|', 'plant')], default='bacterial',
+                             taxon_index=taxon_index,
+                             lineages={BACTERIA: 'bacterial', VIRIDIPLANTAE: 'plant'})
+
+categorize_subject = subject_classifier()
+
+def parse_blast_results(blast_files, workers=None, categorize=categorize_subject):
     print("Parsing BLAST results...")
-    with open(blast_file, 'r') as f:
-        for line in f:
-            fields = line.strip().split('\t')
-            query_id = fields[0]
-            subject_id = fields[1]
-            identity = float(fields[2])
-            if subject_id.startswith(('At_|', 'Pt_|')):
-                category = 'plant'
-            else:
-                category = 'bacterial'
-            hits[query_id][category].append({
-                'subject': subject_id,
-                'identity': identity
-            })
-    print("Found hits for {} query proteins".format(len(hits)))
-    return hits
+    return iter_best_hits_files(blast_files, categorize, workers=workers)
 
 def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_bacterial=75, max_plant=50):
     print("Finding HGT candidates...")
     candidates = []
-    for query_id, categories in hits.items():
-        if not categories['bacterial'] or not categories['plant']:
+    n_queries = 0
+    for query_id, best in hits:
+        n_queries += 1
+        if 'bacterial' not in best or 'plant' not in best:
             continue
-        best_bacterial = max(categories['bacterial'], key=lambda x: x['identity'])
-        best_plant = max(categories['plant'], key=lambda x: x['identity'])
+        best_bacterial = best['bacterial']
+        best_plant = best['plant']
         bacterial_id = best_bacterial['identity']
         plant_id = best_plant['identity']
         difference = bacterial_id - plant_id
@@ -46,34 +50,108 @@ def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_bacterial
                 'plant_identity': plant_id,
                 'difference': difference
             })
+    print("Found hits for {} query proteins".format(n_queries))
+    return candidates
+
+def find_hgt_candidates_columnar(blast_files, min_difference=20, max_conserved=90, min_bacterial=75, max_plant=50, cache=True, workers=None,
+        categorize=categorize_subject):
+    print("Loading BLAST results into columns...")
+    columns = load_blast_columns(blast_files, categorize, cache=cache,
+                                 workers=workers)
+    table = best_hit_table(columns, 'bacterial', 'plant')
+    print("Finding HGT candidates...")
+    print("Found hits for {} query proteins".format(table['n_queries']))
+    candidates = []
+    for query_id, best_bacterial, best_plant, difference in select_candidates(
+            table, min_difference, max_conserved, min_bacterial, max_plant):
+        bacterial_id = best_bacterial['identity']
+        plant_id = best_plant['identity']
+        candidates.append({
+            'query': query_id,
+            'bacterial_hit': best_bacterial['subject'],
+            'bacterial_identity': bacterial_id,
+            'plant_hit': best_plant['subject'],
+            'plant_identity': plant_id,
+            'difference': difference
+        })
     return candidates
 
+def format_candidates(candidates, members=None, store=None):
+    lines = ["{}\t{}\t{}\t{}\t{}\t{}".format(
+        "Query_protein",
+        "Best_bacterial_hit",
+        "Bacterial_identity",
+        "Best_plant_hit",
+        "Plant_identity",
+        "Difference"
+    )]
+    for c in candidates:
+        lines.append("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
+            c['query'],
+            c['bacterial_hit'],
+            c['bacterial_identity'],
+            c['plant_hit'],
+            c['plant_identity'],
+            c['difference']
+        ))
+        if members is not None:
+            lines[-1] += '\t' + format_members(members, c['bacterial_hit'])
+        if store is not None:
+            lines[-1] += '\t' + format_protein(store, c['bacterial_hit'])
+    if members is not None:
+        lines[0] += "\tIdentical_bacterial_hits"
+    if store is not None:
+        lines[0] += '\t' + '\t'.join(protein_columns('bacterial'))
+    return lines
+
 def main():
-    if len(sys.argv) != 2:
-        sys.exit("Usage: {} <blast_output>".format(sys.argv[0]))
-    
-    blast_file = sys.argv[1]
-    hits = parse_blast_results(blast_file)
-    candidates = find_hgt_candidates(hits)
+    parser = argparse.ArgumentParser(description='Filter for oak bacterial HGT candidates')
+    parser.add_argument('blast_files', nargs='+',
+                       help='BLAST results file, or the per-chunk outputs (files or a quoted glob)')
+    add_filter_arguments(parser, 'bacterial')
+    args = parser.parse_args()
+    grid = None
+    if args.sweep:
+        try:
+            grid = parse_grid(args.sweep, DEFAULT_THRESHOLDS, 'bacterial', 'plant')
+        except ValueError as e:
+            parser.error(str(e))
+    categorize = subject_classifier(TaxonIndex(args.taxon_index) if args.taxon_index else None)
+    store = ProteinStore(args.protein_store) if args.protein_store else None
+
+    if args.watch:
+        def update(hits):
+            candidates = find_hgt_candidates(hits)
+            members = None
+            if args.members:
+                members = load_members(args.members, {c['bacterial_hit'] for c in candidates})
+            write_candidate_table(args.watch, format_candidates(candidates, members, store))
+            print("{} candidates so far written to {}".format(len(candidates), args.watch))
+        watch_blast_chunks(args.blast_files, categorize, args.watch + '.checkpoint.json', update,
+                           expected=args.expected_chunks, interval=args.interval, settle=args.settle,
+                           workers=args.workers)
+        return
+
+    blast_files = expand_blast_files(args.blast_files)
+
+    if args.sweep:
+        run_sweep(blast_files, categorize, 'bacterial', 'plant', grid,
+                  args.sweep_output or blast_files[0] + '.sweep',
+                  cache=not args.no_cache, workers=args.workers)
+        return
+
+    if args.engine == 'columnar':
+        candidates = find_hgt_candidates_columnar(blast_files, cache=not args.no_cache,
+            workers=args.workers, categorize=categorize)
+    else:
+        hits = parse_blast_results(blast_files, args.workers, categorize)
+        candidates = find_hgt_candidates(hits)
     
     if candidates:
-        print("{}\t{}\t{}\t{}\t{}\t{}".format(
-            "Query_protein",
-            "Best_bacterial_hit",
-            "Bacterial_identity",
-            "Best_plant_hit",
-            "Plant_identity",
-            "Difference"
-        ))
-        for c in candidates:
-            print("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
-                c['query'],
-                c['bacterial_hit'],
-                c['bacterial_identity'],
-                c['plant_hit'],
-                c['plant_identity'],
-                c['difference']
-            ))
+        members = None
+        if args.members:
+            members = load_members(args.members, {c['bacterial_hit'] for c in candidates})
+        print('\n'.join(format_candidates(candidates, members, store)))
         print("Found {} potential HGT candidates".format(len(candidates)))
     else:
         print("No HGT candidates found matching criteria")
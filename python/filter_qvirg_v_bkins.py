@@ -1,36 +1,38 @@
 #!/usr/bin/env python3
-import sys
-from collections import defaultdict
+import argparse
 
-def parse_blast_results(blast_file):
-    hits = defaultdict(lambda: {'wasp': [], 'other': []})
+from blast_columns import best_hit_table, load_blast_columns, select_candidates
+from blast_hits import add_filter_arguments, expand_blast_files, iter_best_hits_files
+from blast_watch import watch_blast_chunks, write_candidate_table
+from hgt_sweep import DEFAULT_THRESHOLDS, parse_grid, run_sweep
+from lineage import VIRIDIPLANTAE, SubjectClassifier, TaxonIndex
+
+def subject_classifier(taxon_index=None):
+    """Belonocnema/Dryocosmus prefixes are wasp, everything else is other
+
+    With a taxon index, unprefixed accessions are placed by lineage instead.
+    """
+    return SubjectClassifier([('Bk_', 'wasp'), ('Dq_', 'wasp')], default='other',
+                             taxon_index=taxon_index,
+                             lineages={VIRIDIPLANTAE: 'other'})
+
+categorize_subject = subject_classifier()
+
+def parse_blast_results(blast_files, workers=None, categorize=categorize_subject):
     print("Parsing BLAST results...")
-    with open(blast_file, 'r') as f:
-        for line in f:
-            fields = line.strip().split('\t')
-            query_id = fields[0]
-            subject_id = fields[1]
-            identity = float(fields[2])
-            if subject_id.startswith(('Bk_', 'Dq_')):  # Adjust prefixes for wasp proteins
-                category = 'wasp'
-            else:
-                category = 'other'
-            hits[query_id][category].append({
-                'subject': subject_id,
-                'identity': identity
-            })
-    print("Found hits for {} query proteins".format(len(hits)))
-    return hits
+    return iter_best_hits_files(blast_files, categorize, workers=workers)
 
 def find_candidates(hits, min_difference=20, min_wasp=75, max_other=50, max_identity=90):
     print("Finding HGT candidates with updated criteria...")
     candidates = []
-    for query_id, categories in hits.items():
-        if not categories['wasp'] or not categories['other']:
+    n_queries = 0
+    for query_id, best in hits:
+        n_queries += 1
+        if 'wasp' not in best or 'other' not in best:
             continue
         
-        best_wasp = max(categories['wasp'], key=lambda x: x['identity'])
-        best_other = max(categories['other'], key=lambda x: x['identity'])
+        best_wasp = best['wasp']
+        best_other = best['other']
         
         wasp_id = best_wasp['identity']
         other_id = best_other['identity']
@@ -51,34 +53,93 @@ def find_candidates(hits, min_difference=20, min_wasp=75, max_other=50, max_iden
                 'other_identity': other_id,
                 'difference': difference
             })
+    print("Found hits for {} query proteins".format(n_queries))
+    return candidates
+
+def find_candidates_columnar(blast_files, min_difference=20, min_wasp=75, max_other=50, max_identity=90, cache=True, workers=None,
+        categorize=categorize_subject):
+    print("Loading BLAST results into columns...")
+    columns = load_blast_columns(blast_files, categorize, cache=cache,
+                                 workers=workers)
+    table = best_hit_table(columns, 'wasp', 'other')
+    print("Finding HGT candidates with updated criteria...")
+    print("Found hits for {} query proteins".format(table['n_queries']))
+    candidates = []
+    for query_id, best_wasp, best_other, difference in select_candidates(
+            table, min_difference, max_identity, min_wasp, max_other):
+        wasp_id = best_wasp['identity']
+        other_id = best_other['identity']
+        candidates.append({
+            'query': query_id,
+            'wasp_hit': best_wasp['subject'],
+            'wasp_identity': wasp_id,
+            'other_hit': best_other['subject'],
+            'other_identity': other_id,
+            'difference': difference
+        })
     return candidates
 
+def format_candidates(candidates):
+    lines = ["{}\t{}\t{}\t{}\t{}\t{}".format(
+        "Query_protein",
+        "Best_wasp_hit",
+        "Wasp_identity",
+        "Best_other_hit",
+        "Other_identity",
+        "Difference"
+    )]
+    for c in candidates:
+        lines.append("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
+            c['query'],
+            c['wasp_hit'],
+            c['wasp_identity'],
+            c['other_hit'],
+            c['other_identity'],
+            c['difference']
+        ))
+    return lines
+
 def main():
-    if len(sys.argv) != 2:
-        sys.exit("Usage: {} <blast_output>".format(sys.argv[0]))
-    
-    blast_file = sys.argv[1]
-    hits = parse_blast_results(blast_file)
-    candidates = find_candidates(hits)
+    parser = argparse.ArgumentParser(description='Filter for Q. virginiana proteins closer to B. kinseyi than to Populus/Arabidopsis')
+    parser.add_argument('blast_files', nargs='+',
+                       help='BLAST results file, or the per-chunk outputs (files or a quoted glob)')
+    add_filter_arguments(parser)
+    args = parser.parse_args()
+    grid = None
+    if args.sweep:
+        try:
+            grid = parse_grid(args.sweep, DEFAULT_THRESHOLDS, 'wasp', 'other')
+        except ValueError as e:
+            parser.error(str(e))
+    categorize = subject_classifier(TaxonIndex(args.taxon_index) if args.taxon_index else None)
+
+    if args.watch:
+        def update(hits):
+            candidates = find_candidates(hits)
+            write_candidate_table(args.watch, format_candidates(candidates))
+            print("{} candidates so far written to {}".format(len(candidates), args.watch))
+        watch_blast_chunks(args.blast_files, categorize, args.watch + '.checkpoint.json', update,
+                           expected=args.expected_chunks, interval=args.interval, settle=args.settle,
+                           workers=args.workers)
+        return
+
+    blast_files = expand_blast_files(args.blast_files)
+
+    if args.sweep:
+        run_sweep(blast_files, categorize, 'wasp', 'other', grid,
+                  args.sweep_output or blast_files[0] + '.sweep',
+                  cache=not args.no_cache, workers=args.workers)
+        return
+
+    if args.engine == 'columnar':
+        candidates = find_candidates_columnar(blast_files, cache=not args.no_cache,
+            workers=args.workers, categorize=categorize)
+    else:
+        hits = parse_blast_results(blast_files, args.workers, categorize)
+        candidates = find_candidates(hits)
     
     if candidates:
-        print("{}\t{}\t{}\t{}\t{}\t{}".format(
-            "Query_protein",
-            "Best_wasp_hit",
-            "Wasp_identity",
-            "Best_other_hit",
-            "Other_identity",
-            "Difference"
-        ))
-        for c in candidates:
-            print("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
-                c['query'],
-                c['wasp_hit'],
-                c['wasp_identity'],
-                c['other_hit'],
-                c['other_identity'],
-                c['difference']
-            ))
+        print('\n'.join(format_candidates(candidates)))
         print("Found {} potential candidates".format(len(candidates)))
     else:
         print("No candidates found matching criteria")
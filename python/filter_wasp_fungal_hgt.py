@@ -1,36 +1,40 @@
 # filter_wasp_fungal_hgt.py
 #!/usr/bin/env python3
-import sys
-from collections import defaultdict
+import argparse
 
-def parse_blast_results(blast_file):
-    hits = defaultdict(lambda: {'fungal': [], 'insect': []})
+from blast_columns import best_hit_table, load_blast_columns, select_candidates
+from blast_hits import add_filter_arguments, expand_blast_files, iter_best_hits_files
+from blast_watch import watch_blast_chunks, write_candidate_table
+from dedup_sequences import format_members, load_members
+from hgt_sweep import DEFAULT_THRESHOLDS, parse_grid, run_sweep
+from lineage import FUNGI, INSECTA, SubjectClassifier, TaxonIndex
+from protein_store import ProteinStore, format_protein, protein_columns
+
+def subject_classifier(taxon_index=None):
+    """Apis/Nasonia prefixes are insect, everything else is fungal
+
+    With a taxon index, unprefixed accessions are placed by lineage instead.
+    """
+    return SubjectClassifier([('Am_|', 'insect'), ('Nv_|', 'insect')], default='fungal',
+                             taxon_index=taxon_index,
+                             lineages={INSECTA: 'insect', FUNGI: 'fungal'})
+
+categorize_subject = subject_classifier()
+
+def parse_blast_results(blast_files, workers=None, categorize=categorize_subject):
     print("Parsing BLAST results...")
-    with open(blast_file, 'r') as f:
-        for line in f:
-            fields = line.strip().split('\t')
-            query_id = fields[0]
-            subject_id = fields[1]
-            identity = float(fields[2])
-            if subject_id.startswith(('Am_|', 'Nv_|')):
-                category = 'insect'
-            else:
-                category = 'fungal'
-            hits[query_id][category].append({
-                'subject': subject_id,
-                'identity': identity
-            })
-    print("Found hits for {} query proteins".format(len(hits)))
-    return hits
+    return iter_best_hits_files(blast_files, categorize, workers=workers)
 
 def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_fungal=75, max_insect=50):
     print("Finding HGT candidates...")
     candidates = []
-    for query_id, categories in hits.items():
-        if not categories['fungal'] or not categories['insect']:
+    n_queries = 0
+    for query_id, best in hits:
+        n_queries += 1
+        if 'fungal' not in best or 'insect' not in best:
             continue
-        best_fungal = max(categories['fungal'], key=lambda x: x['identity'])
-        best_insect = max(categories['insect'], key=lambda x: x['identity'])
+        best_fungal = best['fungal']
+        best_insect = best['insect']
         fungal_id = best_fungal['identity']
         insect_id = best_insect['identity']
         difference = fungal_id - insect_id
@@ -46,34 +50,108 @@ def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_fungal=75
                 'insect_identity': insect_id,
                 'difference': difference
             })
+    print("Found hits for {} query proteins".format(n_queries))
+    return candidates
+
+def find_hgt_candidates_columnar(blast_files, min_difference=20, max_conserved=90, min_fungal=75, max_insect=50, cache=True, workers=None,
+        categorize=categorize_subject):
+    print("Loading BLAST results into columns...")
+    columns = load_blast_columns(blast_files, categorize, cache=cache,
+                                 workers=workers)
+    table = best_hit_table(columns, 'fungal', 'insect')
+    print("Finding HGT candidates...")
+    print("Found hits for {} query proteins".format(table['n_queries']))
+    candidates = []
+    for query_id, best_fungal, best_insect, difference in select_candidates(
+            table, min_difference, max_conserved, min_fungal, max_insect):
+        fungal_id = best_fungal['identity']
+        insect_id = best_insect['identity']
+        candidates.append({
+            'query': query_id,
+            'fungal_hit': best_fungal['subject'],
+            'fungal_identity': fungal_id,
+            'insect_hit': best_insect['subject'],
+            'insect_identity': insect_id,
+            'difference': difference
+        })
     return candidates
 
+def format_candidates(candidates, members=None, store=None):
+    lines = ["{}\t{}\t{}\t{}\t{}\t{}".format(
+        "Query_protein",
+        "Best_fungal_hit",
+        "Fungal_identity",
+        "Best_insect_hit",
+        "Insect_identity",
+        "Difference"
+    )]
+    for c in candidates:
+        lines.append("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
+            c['query'],
+            c['fungal_hit'],
+            c['fungal_identity'],
+            c['insect_hit'],
+            c['insect_identity'],
+            c['difference']
+        ))
+        if members is not None:
+            lines[-1] += '\t' + format_members(members, c['fungal_hit'])
+        if store is not None:
+            lines[-1] += '\t' + format_protein(store, c['fungal_hit'])
+    if members is not None:
+        lines[0] += "\tIdentical_fungal_hits"
+    if store is not None:
+        lines[0] += '\t' + '\t'.join(protein_columns('fungal'))
+    return lines
+
 def main():
-    if len(sys.argv) != 2:
-        sys.exit("Usage: {} <blast_output>".format(sys.argv[0]))
-    
-    blast_file = sys.argv[1]
-    hits = parse_blast_results(blast_file)
-    candidates = find_hgt_candidates(hits)
+    parser = argparse.ArgumentParser(description='Filter for wasp fungal HGT candidates')
+    parser.add_argument('blast_files', nargs='+',
+                       help='BLAST results file, or the per-chunk outputs (files or a quoted glob)')
+    add_filter_arguments(parser, 'fungal')
+    args = parser.parse_args()
+    grid = None
+    if args.sweep:
+        try:
+            grid = parse_grid(args.sweep, DEFAULT_THRESHOLDS, 'fungal', 'insect')
+        except ValueError as e:
+            parser.error(str(e))
+    categorize = subject_classifier(TaxonIndex(args.taxon_index) if args.taxon_index else None)
+    store = ProteinStore(args.protein_store) if args.protein_store else None
+
+    if args.watch:
+        def update(hits):
+            candidates = find_hgt_candidates(hits)
+            members = None
+            if args.members:
+                members = load_members(args.members, {c['fungal_hit'] for c in candidates})
+            write_candidate_table(args.watch, format_candidates(candidates, members, store))
+            print("{} candidates so far written to {}".format(len(candidates), args.watch))
+        watch_blast_chunks(args.blast_files, categorize, args.watch + '.checkpoint.json', update,
+                           expected=args.expected_chunks, interval=args.interval, settle=args.settle,
+                           workers=args.workers)
+        return
+
+    blast_files = expand_blast_files(args.blast_files)
+
+    if args.sweep:
+        run_sweep(blast_files, categorize, 'fungal', 'insect', grid,
+                  args.sweep_output or blast_files[0] + '.sweep',
+                  cache=not args.no_cache, workers=args.workers)
+        return
+
+    if args.engine == 'columnar':
+        candidates = find_hgt_candidates_columnar(blast_files, cache=not args.no_cache,
+            workers=args.workers, categorize=categorize)
+    else:
+        hits = parse_blast_results(blast_files, args.workers, categorize)
+        candidates = find_hgt_candidates(hits)
     
     if candidates:
-        print("{}\t{}\t{}\t{}\t{}\t{}".format(
-            "Query_protein",
-            "Best_fungal_hit",
-            "Fungal_identity",
-            "Best_insect_hit",
-            "Insect_identity",
-            "Difference"
-        ))
-        for c in candidates:
-            print("{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}".format(
-                c['query'],
-                c['fungal_hit'],
-                c['fungal_identity'],
-                c['insect_hit'],
-                c['insect_identity'],
-                c['difference']
-            ))
+        members = None
+        if args.members:
+            members = load_members(args.members, {c['fungal_hit'] for c in candidates})
+        print('\n'.join(format_candidates(candidates, members, store)))
         print("Found {} potential HGT candidates".format(len(candidates)))
     else:
         print("No HGT candidates found matching criteria")
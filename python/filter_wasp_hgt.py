@@ -1,52 +1,44 @@
 #!/usr/bin/env python3
 import argparse
-from collections import defaultdict
-
-def parse_blast_results(blast_file):
-    """Parse combined BLAST results and categorize hits by type"""
-    hits = defaultdict(lambda: {'bacterial': [], 'insect': []})
-
-    with open(blast_file, 'r') as f:
-        for line in f:
-            fields = line.strip().split('\t')
-            if len(fields) < 12:
-                continue
-
-            query_id = fields[0]
-            subject_id = fields[1]
-            identity = float(fields[2])
-            aln_length = int(fields[3])
-            evalue = float(fields[10])
-            bit_score = float(fields[11])
-
-            # Categorize hit
-            if subject_id.startswith('Am_|') or subject_id.startswith('Nv_|'):
-                category = 'insect'
-            else:
-                category = 'bacterial'
-
-            hits[query_id][category].append({
-                'subject': subject_id,
-                'identity': identity,
-                'length': aln_length,
-                'evalue': evalue,
-                'bit_score': bit_score
-            })
-
-    return hits
+
+from blast_columns import best_hit_table, load_blast_columns, select_candidates
+from blast_hits import add_filter_arguments, expand_blast_files, iter_best_hits_files
+from blast_watch import watch_blast_chunks, write_candidate_table
+from compressed_io import open_file
+from dedup_sequences import format_members, load_members
+from hgt_sweep import THRESHOLDS, parse_grid, run_sweep
+from lineage import BACTERIA, INSECTA, SubjectClassifier, TaxonIndex
+from protein_store import ProteinStore, format_protein, protein_columns
+
+def subject_classifier(taxon_index=None):
+    """Apis/Nasonia prefixes are insect, everything else is bacterial
+
+    With a taxon index, unprefixed accessions are placed by lineage instead.
+    """
+    return SubjectClassifier([('Am_|', 'insect'), ('Nv_|', 'insect')], default='bacterial',
+                             taxon_index=taxon_index,
+                             lineages={INSECTA: 'insect', BACTERIA: 'bacterial'})
+
+categorize_subject = subject_classifier()
+
+def parse_blast_results(blast_files, workers=None, categorize=categorize_subject):
+    """Stream combined BLAST results as best hits per category for each query"""
+    return iter_best_hits_files(blast_files, categorize, min_fields=12, workers=workers)
 
 def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_bact=75, max_insect=50):
     """Find proteins where best bacterial hit has higher identity than best insect hit"""
     candidates = {}
+    n_queries = 0
 
-    for query_id, categories in hits.items():
+    for query_id, best in hits:
+        n_queries += 1
         # Skip if no hits in either category
-        if not categories['bacterial'] or not categories['insect']:
+        if 'bacterial' not in best or 'insect' not in best:
             continue
 
         # Get best hits for each category
-        best_bacterial = max(categories['bacterial'], key=lambda x: x['identity'])
-        best_insect = max(categories['insect'], key=lambda x: x['identity'])
+        best_bacterial = best['bacterial']
+        best_insect = best['insect']
 
         bact_id = best_bacterial['identity']
         insect_id = best_insect['identity']
@@ -64,11 +56,56 @@ def find_hgt_candidates(hits, min_difference=20, max_conserved=90, min_bact=75,
                 'difference': difference
             }
 
+    print(f"Found hits for {n_queries} query proteins")
+    return candidates
+
+def find_hgt_candidates_columnar(blast_files, min_difference=20, max_conserved=90, min_bact=75, max_insect=50, cache=True, workers=None,
+        categorize=categorize_subject):
+    """Columnar-engine equivalent of find_hgt_candidates, reading the BLAST files directly"""
+    columns = load_blast_columns(blast_files, categorize, min_fields=12, cache=cache,
+                                 workers=workers)
+    table = best_hit_table(columns, 'bacterial', 'insect')
+    print(f"Found hits for {table['n_queries']} query proteins")
+
+    candidates = {}
+    for query_id, best_bacterial, best_insect, difference in select_candidates(
+            table, min_difference, max_conserved, min_bact, max_insect):
+        candidates[query_id] = {
+            'bacterial_hit': best_bacterial,
+            'insect_hit': best_insect,
+            'difference': difference
+        }
+
     return candidates
 
+def format_candidates(candidates, members=None, store=None):
+    """Output lines for candidates, sorted by difference in identity"""
+    sorted_candidates = sorted(
+        candidates.items(),
+        key=lambda x: x[1]['difference'],
+        reverse=True
+    )
+
+    lines = ["Wasp_protein\tBacterial_hit\tBacterial_identity\tInsect_hit\tInsect_identity\tDifference"]
+    for query_id, data in sorted_candidates:
+        lines.append(
+            f"{query_id}\t{data['bacterial_hit']['subject']}\t{data['bacterial_hit']['identity']:.1f}\t"
+            f"{data['insect_hit']['subject']}\t{data['insect_hit']['identity']:.1f}\t{data['difference']:.1f}"
+        )
+        if members is not None:
+            lines[-1] += '\t' + format_members(members, data['bacterial_hit']['subject'])
+        if store is not None:
+            lines[-1] += '\t' + format_protein(store, data['bacterial_hit']['subject'])
+    if members is not None:
+        lines[0] += "\tIdentical_bacterial_hits"
+    if store is not None:
+        lines[0] += '\t' + '\t'.join(protein_columns('bacterial'))
+    return lines
+
 def main():
     parser = argparse.ArgumentParser(description='Filter for wasp HGT candidates')
-    parser.add_argument('blast_file', help='Combined BLAST results file')
+    parser.add_argument('blast_files', nargs='+',
+                       help='Combined BLAST results file, or the per-chunk outputs (files or a quoted glob)')
     parser.add_argument('--min-difference', type=float, default=20,
                        help='Minimum difference between bacterial and insect identity (default: 20)')
     parser.add_argument('--max-conserved', type=float, default=90,
@@ -77,41 +114,61 @@ def main():
                        help='Minimum bacterial identity required (default: 75)')
     parser.add_argument('--max-insect', type=float, default=50,
                        help='Maximum insect identity allowed (default: 50)')
-    parser.add_argument('--output', help='Output file (default: stdout)')
-
+    parser.add_argument('--output', help='Output file, compressed if it ends in .gz/.bgz/.zst (default: stdout)')
+    add_filter_arguments(parser, 'bacterial')
     args = parser.parse_args()
-
-    print("Parsing BLAST results...")
-    hits = parse_blast_results(args.blast_file)
-    print(f"Found hits for {len(hits)} query proteins")
-
-    print("\nFinding HGT candidates...")
-    candidates = find_hgt_candidates(
-        hits,
+    thresholds = (
         args.min_difference,
         args.max_conserved,
         args.min_bact,
         args.max_insect
     )
+    grid = None
+    if args.sweep:
+        try:
+            grid = parse_grid(args.sweep, dict(zip(THRESHOLDS, thresholds)), 'bacterial', 'insect')
+        except ValueError as e:
+            parser.error(str(e))
+    categorize = subject_classifier(TaxonIndex(args.taxon_index) if args.taxon_index else None)
+    store = ProteinStore(args.protein_store) if args.protein_store else None
+
+    if args.watch:
+        def update(hits):
+            candidates = find_hgt_candidates(hits, *thresholds)
+            members = None
+            if args.members:
+                members = load_members(args.members, {data['bacterial_hit']['subject'] for data in candidates.values()})
+            write_candidate_table(args.watch, format_candidates(candidates, members, store))
+            print("{} candidates so far written to {}".format(len(candidates), args.watch))
+        watch_blast_chunks(args.blast_files, categorize, args.watch + '.checkpoint.json', update,
+                           min_fields=12, expected=args.expected_chunks, interval=args.interval,
+                           settle=args.settle, workers=args.workers)
+        return
+
+    blast_files = expand_blast_files(args.blast_files)
+
+    if args.sweep:
+        run_sweep(blast_files, categorize, 'bacterial', 'insect', grid,
+                  args.sweep_output or blast_files[0] + '.sweep', min_fields=12,
+                  cache=not args.no_cache, workers=args.workers)
+        return
+
+    print("Parsing BLAST results and finding HGT candidates...")
+    if args.engine == 'columnar':
+        candidates = find_hgt_candidates_columnar(blast_files, *thresholds, cache=not args.no_cache,
+            workers=args.workers, categorize=categorize)
+    else:
+        hits = parse_blast_results(blast_files, args.workers, categorize)
+        candidates = find_hgt_candidates(hits, *thresholds)
 
-    # Sort by difference in identity
-    sorted_candidates = sorted(
-        candidates.items(),
-        key=lambda x: x[1]['difference'],
-        reverse=True
-    )
-
-     # Prepare output
-    output_lines = ["Wasp_protein\tBacterial_hit\tBacterial_identity\tInsect_hit\tInsect_identity\tDifference"]
-    for query_id, data in sorted_candidates:
-        output_lines.append(
-            f"{query_id}\t{data['bacterial_hit']['subject']}\t{data['bacterial_hit']['identity']:.1f}\t"
-            f"{data['insect_hit']['subject']}\t{data['insect_hit']['identity']:.1f}\t{data['difference']:.1f}"
-        )
+    members = None
+    if args.members:
+        members = load_members(args.members, {data['bacterial_hit']['subject'] for data in candidates.values()})
+    output_lines = format_candidates(candidates, members, store)
 
     # Write output
     if args.output:
-        with open(args.output, 'w') as f:
+        with open_file(args.output, 'w') as f:
             f.write('\n'.join(output_lines))
     else:
         print('\n'.join(output_lines))
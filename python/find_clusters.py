@@ -2,100 +2,224 @@
 
 import pysam
 import numpy as np
-from collections import defaultdict
 import argparse
+import heapq
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
-def find_kmer_clusters(bam_file, min_kmers=3, min_length=100, max_gap=50, min_density=0.1):
+from compressed_io import available_cpus
+from kmer_intervals import (cluster_intervals, drop_flagged, interval_cache, parse_grid, segment_intervals,
+                            write_sweep)
+
+class Cluster:
+    """One cluster of k-mer matches: coordinates and coverage totals, not the k-mer names"""
+    __slots__ = ('ref_id', 'start', 'end', 'n_kmers', 'covered_bases', 'covered_end',
+                 'aligned_bases', 'density')
+
+    def __init__(self, ref_id, start=None, end=None, n_kmers=0):
+        self.ref_id = ref_id
+        self.start = start
+        self.end = end
+        self.n_kmers = n_kmers
+        self.covered_bases = 0
+        self.covered_end = start or 0
+        self.aligned_bases = 0
+        self.density = None
+
+    def add_coverage(self, pos, end):
+        """
+        Add one alignment interval to the coverage totals.
+        
+        Alignments arrive sorted by start, so the bases covered by the cluster so
+        far are a union that can only grow at its right edge; tracking that edge
+        gives the covered base count without a per-base table.
+        """
+        self.aligned_bases += end - pos
+        if pos >= self.covered_end:
+            self.covered_bases += end - pos
+            self.covered_end = end
+        elif end > self.covered_end:
+            self.covered_bases += end - self.covered_end
+            self.covered_end = end
+
+def iter_contig_clusters(bam, ref, min_kmers=3, min_length=100, max_gap=50, min_density=0.1):
+    """Yield clusters of k-mer matches on one reference of an open BAM file as they close"""
+    print(f"Processing {ref}...")
+    ref_id = bam.get_tid(ref)
+    current_cluster = Cluster(ref_id)
+    
+    # Get all k-mer alignments for this reference
+    for read in bam.fetch(ref):
+        pos = read.reference_start
+        end = read.reference_end
+        
+        # If this is far from current cluster, close current and start new
+        if (current_cluster.start is not None and 
+            pos - current_cluster.end > max_gap):
+            
+            # Process completed cluster
+            if current_cluster.n_kmers >= min_kmers:
+                cluster_length = current_cluster.end - current_cluster.start
+                if cluster_length >= min_length:
+                    # Calculate coverage density
+                    density = current_cluster.covered_bases / cluster_length
+                    if density >= min_density:
+                        current_cluster.density = density
+                        yield current_cluster
+            
+            # Start new cluster
+            current_cluster = Cluster(ref_id, pos, end, 1)
+        else:
+            # Add to current cluster
+            if current_cluster.start is None:
+                current_cluster.start = pos
+            current_cluster.end = max(current_cluster.end if current_cluster.end else pos, end)
+            current_cluster.n_kmers += 1
+        
+        # Update coverage
+        current_cluster.add_coverage(pos, end)
+
+def find_shard_clusters(bam_file, refs, min_kmers, min_length, max_gap, min_density):
+    """Worker: open the BAM once and find clusters on each reference of a shard"""
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        return {ref: list(iter_contig_clusters(bam, ref, min_kmers, min_length, max_gap, min_density))
+                for ref in refs}
+
+def shard_references(bam, n_shards):
+    """
+    Split the references with mapped reads into shards with similar read totals.
+    
+    Counts come from the BAM index, so no reads are read. References are
+    assigned largest first to the shard with the fewest reads so far.
+    """
+    counts = [(stat.mapped, stat.contig) for stat in bam.get_index_statistics() if stat.mapped > 0]
+    counts.sort(key=lambda count: -count[0])
+    loads = [(0, i) for i in range(max(1, min(n_shards, len(counts))))]
+    shards = [[] for _ in loads]
+    for mapped, ref in counts:
+        load, i = heapq.heappop(loads)
+        shards[i].append(ref)
+        heapq.heappush(loads, (load + mapped, i))
+    return [shard for shard in shards if shard]
+
+def iter_kmer_clusters(bam_file, min_kmers=3, min_length=100, max_gap=50, min_density=0.1, workers=1):
     """
-    Find clusters of k-mer matches in BAM file.
+    Yield clusters of k-mer matches in BAM file, in reference order.
     
     Parameters:
     - min_kmers: Minimum number of k-mers in a cluster
     - min_length: Minimum length of a cluster (bp)
     - max_gap: Maximum gap between k-mers to be considered same cluster
     - min_density: Minimum k-mers per base pair in cluster
+    - workers: Processes for the contigs; with more than one, contigs are
+      sharded by mapped reads (needs an indexed BAM) and the clusters are
+      yielded in reference order, as from a serial run
     """
-    clusters = []
     bam = pysam.AlignmentFile(bam_file, "rb")
     
-    # Process each chromosome/contig
-    for ref in bam.references:
-        print(f"Processing {ref}...")
-        current_cluster = {
-            'ref': ref,
-            'start': None,
-            'end': None,
-            'kmers': [],
-            'coverage': defaultdict(int)
-        }
-        
-        # Get all k-mer alignments for this reference
-        for read in bam.fetch(ref):
-            pos = read.reference_start
-            end = read.reference_end
-            
-            # If this is far from current cluster, close current and start new
-            if (current_cluster['start'] is not None and 
-                pos - current_cluster['end'] > max_gap):
-                
-                # Process completed cluster
-                if len(current_cluster['kmers']) >= min_kmers:
-                    cluster_length = current_cluster['end'] - current_cluster['start']
-                    if cluster_length >= min_length:
-                        # Calculate coverage density
-                        coverage_points = len([v for v in current_cluster['coverage'].values() if v > 0])
-                        density = coverage_points / cluster_length
-                        if density >= min_density:
-                            current_cluster['density'] = density
-                            current_cluster['n_kmers'] = len(current_cluster['kmers'])
-                            clusters.append(current_cluster.copy())
-                
-                # Start new cluster
-                current_cluster = {
-                    'ref': ref,
-                    'start': pos,
-                    'end': end,
-                    'kmers': [read.query_name],
-                    'coverage': defaultdict(int)
-                }
-            else:
-                # Add to current cluster
-                if current_cluster['start'] is None:
-                    current_cluster['start'] = pos
-                current_cluster['end'] = max(current_cluster['end'] if current_cluster['end'] else pos, end)
-                current_cluster['kmers'].append(read.query_name)
-            
-            # Update coverage
-            for p in range(pos, end):
-                current_cluster['coverage'][p] += 1
+    if workers <= 1:
+        # Process each chromosome/contig
+        for ref in bam.references:
+            yield from iter_contig_clusters(bam, ref, min_kmers, min_length, max_gap, min_density)
+        bam.close()
+        return
     
+    # Several shards per worker, so one large contig does not hold up the rest
+    shards = shard_references(bam, workers * 4)
+    sharded = {ref for shard in shards for ref in shard}
+    references = [ref for ref in bam.references if ref in sharded]
     bam.close()
-    return clusters
+    if not shards:
+        return
+    # Hold finished contigs until every contig before them is written
+    by_ref = {}
+    next_ref = 0
+    with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+        futures = [pool.submit(find_shard_clusters, bam_file, shard, min_kmers, min_length,
+                               max_gap, min_density) for shard in shards]
+        for future in as_completed(futures):
+            by_ref.update(future.result())
+            while next_ref < len(references) and references[next_ref] in by_ref:
+                yield from by_ref.pop(references[next_ref])
+                next_ref += 1
+
+def iter_cached_clusters(intervals, min_kmers=3, min_length=100, max_gap=50, min_density=0.1):
+    """Same clusters as iter_kmer_clusters, from intervals loaded with kmer_intervals.interval_cache"""
+    runs = segment_intervals(intervals, max_gap)
+    clusters = cluster_intervals(runs, min_kmers, min_length, min_density)
+    for ref_id, start, end, n_kmers, covered_bases, aligned_bases in zip(
+            clusters['ref_id'].tolist(), clusters['start'].tolist(), clusters['end'].tolist(),
+            clusters['n_kmers'].tolist(), clusters['covered_bases'].tolist(),
+            clusters['aligned_bases'].tolist()):
+        cluster = Cluster(ref_id, start, end, n_kmers)
+        cluster.covered_bases = covered_bases
+        cluster.aligned_bases = aligned_bases
+        cluster.density = covered_bases / (end - start)
+        yield cluster
 
-def write_clusters_to_bed(clusters, output_file):
-    """Write clusters to BED format"""
-    with open(output_file, 'w') as f:
+def find_kmer_clusters(bam_file, min_kmers=3, min_length=100, max_gap=50, min_density=0.1, workers=1):
+    """Find clusters of k-mer matches in BAM file (see iter_kmer_clusters)"""
+    return list(iter_kmer_clusters(bam_file, min_kmers, min_length, max_gap, min_density, workers))
+
+def write_clusters(clusters, references, output_prefix):
+    """
+    Write clusters to <prefix>.bed and <prefix>.detailed.txt as they arrive,
+    then the summary to <prefix>.stats.txt.
+    
+    Only the length, k-mer count and density of each cluster are kept, in
+    compact arrays, for the medians in the summary. Returns the cluster count.
+    """
+    lengths = array('q')
+    kmer_counts = array('q')
+    densities = array('d')
+    with open(f"{output_prefix}.bed", 'w') as bed, open(f"{output_prefix}.detailed.txt", 'w') as detailed:
+        detailed.write("ref\tstart\tend\tlength\tn_kmers\tdensity\tavg_coverage\n")
         for i, cluster in enumerate(clusters):
+            ref = references[cluster.ref_id]
+            length = cluster.end - cluster.start
             # BED format: chrom start end name score strand extra
-            score = int(cluster['density'] * 1000)  # Scale density to integer score
-            f.write(f"{cluster['ref']}\t{cluster['start']}\t{cluster['end']}\t"
-                   f"cluster_{i}\t{score}\t+\t{cluster['n_kmers']}\n")
+            score = int(cluster.density * 1000)  # Scale density to integer score
+            bed.write(f"{ref}\t{cluster.start}\t{cluster.end}\t"
+                      f"cluster_{i}\t{score}\t+\t{cluster.n_kmers}\n")
+            avg_cov = cluster.aligned_bases / length
+            detailed.write(f"{ref}\t{cluster.start}\t{cluster.end}\t"
+                           f"{length}\t{cluster.n_kmers}\t{cluster.density:.3f}\t"
+                           f"{avg_cov:.2f}\n")
+            lengths.append(length)
+            kmer_counts.append(cluster.n_kmers)
+            densities.append(cluster.density)
+    write_stats(lengths, kmer_counts, densities, f"{output_prefix}.stats.txt")
+    return len(lengths)
 
-def write_detailed_output(clusters, output_file):
-    """Write detailed information about each cluster"""
-    with open(output_file, 'w') as f:
-        f.write("ref\tstart\tend\tlength\tn_kmers\tdensity\tavg_coverage\n")
-        for cluster in clusters:
-            length = cluster['end'] - cluster['start']
-            avg_cov = sum(cluster['coverage'].values()) / length
-            f.write(f"{cluster['ref']}\t{cluster['start']}\t{cluster['end']}\t"
-                   f"{length}\t{cluster['n_kmers']}\t{cluster['density']:.3f}\t"
-                   f"{avg_cov:.2f}\n")
+def write_stats(lengths, kmer_counts, densities, stats_file):
+    """Write summary statistics of cluster lengths, k-mer counts and densities"""
+    with open(stats_file, 'w') as f:
+        f.write(f"Total clusters found: {len(lengths)}\n\n")
+        if lengths:
+            f.write("Cluster length statistics:\n")
+            f.write(f"  Mean: {np.mean(lengths):.1f}\n")
+            f.write(f"  Median: {np.median(lengths):.1f}\n")
+            f.write(f"  Min: {min(lengths)}\n")
+            f.write(f"  Max: {max(lengths)}\n\n")
+            
+            f.write("K-mer count statistics:\n")
+            f.write(f"  Mean: {np.mean(kmer_counts):.1f}\n")
+            f.write(f"  Median: {np.median(kmer_counts):.1f}\n")
+            f.write(f"  Min: {min(kmer_counts)}\n")
+            f.write(f"  Max: {max(kmer_counts)}\n\n")
+            
+            f.write("Density statistics:\n")
+            f.write(f"  Mean: {np.mean(densities):.3f}\n")
+            f.write(f"  Median: {np.median(densities):.3f}\n")
+            f.write(f"  Min: {min(densities):.3f}\n")
+            f.write(f"  Max: {max(densities):.3f}\n")
 
 def main():
     parser = argparse.ArgumentParser(description='Find clusters of shared k-mers in BAM file')
-    parser.add_argument('bam_file', help='Input BAM file')
+    parser.add_argument('bam_file',
+                       help='Input BAM file, or an interval directory written by shared_kmers.py')
     parser.add_argument('output_prefix', help='Prefix for output files')
     parser.add_argument('--min-kmers', type=int, default=3,
                        help='Minimum number of k-mers in cluster')
@@ -105,6 +229,17 @@ def main():
                        help='Maximum gap between k-mers in cluster')
     parser.add_argument('--min-density', type=float, default=0.1,
                        help='Minimum density of k-mers per bp')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Processes for per-contig clustering; 0 for all available CPUs '
+                            '(default: 1, needs an indexed BAM above 1; not used for interval '
+                            'directories, --cache or --sweep)')
+    parser.add_argument('--cache', action='store_true',
+                       help='Cluster from the k-mer interval cache <bam>.kmers, building it if needed')
+    parser.add_argument('--drop-flagged', action='store_true',
+                       help='Leave out k-mers flagged low complexity or high copy by shared_kmers.py --flag-only')
+    parser.add_argument('--sweep', nargs='+', metavar='NAME=V1,V2',
+                       help='Write <prefix>.sweep.tsv with cluster counts for every combination '
+                            'of max_gap, min_kmers, min_length and min_density values (uses the cache)')
     
     args = parser.parse_args()
     
@@ -114,48 +249,56 @@ def main():
     print(f"  Minimum length: {args.min_length}")
     print(f"  Maximum gap: {args.max_gap}")
     print(f"  Minimum density: {args.min_density}")
+    cached = bool(args.sweep) or args.cache or os.path.isdir(args.bam_file)
+    workers = args.workers or available_cpus()
+    if not cached:
+        print(f"  Workers: {workers}")
+    elif args.workers != 1:
+        # The interval arrays are clustered in one process
+        print("Warning: --workers is ignored when clustering from a k-mer interval directory or cache")
     
-    clusters = find_kmer_clusters(
-        args.bam_file,
-        min_kmers=args.min_kmers,
-        min_length=args.min_length,
-        max_gap=args.max_gap,
-        min_density=args.min_density
-    )
-    
-    # Write outputs
-    bed_file = f"{args.output_prefix}.bed"
-    write_clusters_to_bed(clusters, bed_file)
+    if args.sweep:
+        defaults = {'max_gap': args.max_gap, 'min_kmers': args.min_kmers,
+                    'min_length': args.min_length, 'min_density': args.min_density}
+        try:
+            grid = parse_grid(args.sweep, defaults)
+        except ValueError as e:
+            parser.error(str(e))
+        sweep_file = f"{args.output_prefix}.sweep.tsv"
+        intervals = interval_cache(args.bam_file)
+        if args.drop_flagged:
+            intervals = drop_flagged(intervals)
+        write_sweep(intervals, grid, sweep_file)
+        print(f"Wrote sweep summary to {sweep_file}")
+        return
     
-    detailed_file = f"{args.output_prefix}.detailed.txt"
-    write_detailed_output(clusters, detailed_file)
+    if cached:
+        intervals = interval_cache(args.bam_file)
+        if args.drop_flagged:
+            intervals = drop_flagged(intervals)
+        references = intervals['references']
+        clusters = iter_cached_clusters(
+            intervals,
+            min_kmers=args.min_kmers,
+            min_length=args.min_length,
+            max_gap=args.max_gap,
+            min_density=args.min_density
+        )
+    else:
+        with pysam.AlignmentFile(args.bam_file, "rb") as bam:
+            references = bam.references
+        clusters = iter_kmer_clusters(
+            args.bam_file,
+            min_kmers=args.min_kmers,
+            min_length=args.min_length,
+            max_gap=args.max_gap,
+            min_density=args.min_density,
+            workers=workers
+        )
     
-    # Write summary statistics
-    stats_file = f"{args.output_prefix}.stats.txt"
-    with open(stats_file, 'w') as f:
-        f.write(f"Total clusters found: {len(clusters)}\n\n")
-        if clusters:
-            lengths = [c['end'] - c['start'] for c in clusters]
-            kmer_counts = [c['n_kmers'] for c in clusters]
-            densities = [c['density'] for c in clusters]
-            
-            f.write("Cluster length statistics:\n")
-            f.write(f"  Mean: {np.mean(lengths):.1f}\n")
-            f.write(f"  Median: {np.median(lengths):.1f}\n")
-            f.write(f"  Min: {min(lengths)}\n")
-            f.write(f"  Max: {max(lengths)}\n\n")
-            
-            f.write("K-mer count statistics:\n")
-            f.write(f"  Mean: {np.mean(kmer_counts):.1f}\n")
-            f.write(f"  Median: {np.median(kmer_counts):.1f}\n")
-            f.write(f"  Min: {min(kmer_counts)}\n")
-            f.write(f"  Max: {max(kmer_counts)}\n\n")
-            
-            f.write("Density statistics:\n")
-            f.write(f"  Mean: {np.mean(densities):.3f}\n")
-            f.write(f"  Median: {np.median(densities):.3f}\n")
-            f.write(f"  Min: {min(densities):.3f}\n")
-            f.write(f"  Max: {max(densities):.3f}\n")
+    # Write outputs as the clusters close
+    n_clusters = write_clusters(clusters, references, args.output_prefix)
+    print(f"Wrote {n_clusters} clusters to {args.output_prefix}.bed, .detailed.txt and .stats.txt")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Threshold sweeps for the filter_* scripts
+
+Reduces a BLAST file once to the best donor and native hit per query
+(blast_columns.best_hit_table) and evaluates every combination of a grid of
+HGT cutoffs against that table.
+"""
+
+import itertools
+
+import numpy as np
+
+import sweep_grid
+from blast_columns import best_hit_table, load_blast_columns
+from two_stage_blast import native_cap
+
+THRESHOLDS = ('min_difference', 'max_conserved', 'min_donor', 'max_native')
+# The filter scripts' default cutoffs
+DEFAULT_THRESHOLDS = {'min_difference': 20, 'max_conserved': 90, 'min_donor': 75, 'max_native': 50}
+
+
+def parse_grid(specs, defaults, donor=None, native=None):
+    """Turn ['min_difference=10,15,20', ...] into {threshold: [values]}
+
+    Thresholds not named in specs are fixed at their value in defaults.
+    min_<donor> and max_<native> (e.g. min_fungal, max_plant, the names of the
+    sweep table columns) are accepted for min_donor and max_native.
+    """
+    aliases = {}
+    if donor:
+        aliases['min_' + donor] = 'min_donor'
+    if native:
+        aliases['max_' + native] = 'max_native'
+    return sweep_grid.parse_grid(specs, defaults, {name: float for name in THRESHOLDS}, aliases)
+
+
+def sweep_thresholds(table, grid):
+    """Yield (setting, mask) for every combination of threshold values in grid
+
+    Each criterion depends on a single threshold, so its mask is computed once
+    per value and the combinations are just ANDs of the precomputed masks.
+    """
+    donor_id = table['donor_identity']
+    native_id = table['native_identity']
+    difference = donor_id - native_id
+    criteria = {
+        'min_difference': lambda v: difference >= v,
+        'max_conserved': lambda v: donor_id <= v,
+        'min_donor': lambda v: donor_id >= v,
+        'max_native': lambda v: native_id <= v,
+    }
+    masks = {name: [criteria[name](v) for v in grid[name]] for name in THRESHOLDS}
+
+    for indices in itertools.product(*(range(len(grid[name])) for name in THRESHOLDS)):
+        mask = np.logical_and.reduce([masks[name][i] for name, i in zip(THRESHOLDS, indices)])
+        setting = {name: grid[name][i] for name, i in zip(THRESHOLDS, indices)}
+        yield setting, mask
+
+
+def run_sweep(blast_files, categorize, donor, native, grid, output_prefix,
+              min_fields=3, cache=True, workers=None):
+    """Evaluate a threshold grid (from parse_grid) and write <prefix>.counts.tsv and <prefix>.candidates.tsv
+
+    Threshold columns are named after the script's categories (e.g. min_fungal,
+    max_plant) so the tables read like the script's own options.
+    """
+    n_settings = int(np.prod([len(values) for values in grid.values()]))
+    cap = native_cap(blast_files)
+    above = [v for v in grid['max_native'] if cap is not None and v > cap]
+    if above:
+        print("Warning: two_stage_blast.py only searched the donor database for queries with a native hit "
+              "at or below {:g}%; candidate counts for max_{} {} are incomplete".format(
+                  cap, native, ', '.join('{:g}'.format(v) for v in above)))
+    print("Loading BLAST results into columns...")
+    columns = load_blast_columns(blast_files, categorize, min_fields=min_fields, cache=cache,
+                                 workers=workers)
+    table = best_hit_table(columns, donor, native)
+    print("Found hits for {} query proteins".format(table['n_queries']))
+    print("Evaluating {} threshold settings...".format(n_settings))
+
+    names = ['min_difference', 'max_conserved', 'min_' + donor, 'max_' + native]
+    counts_file = output_prefix + '.counts.tsv'
+    candidates_file = output_prefix + '.candidates.tsv'
+    with open(counts_file, 'w') as counts, open(candidates_file, 'w') as listing:
+        counts.write('\t'.join(names + ['n_candidates']) + '\n')
+        listing.write('\t'.join(names + [
+            'Query_protein', 'Best_{}_hit'.format(donor), '{}_identity'.format(donor.capitalize()),
+            'Best_{}_hit'.format(native), '{}_identity'.format(native.capitalize()), 'Difference'
+        ]) + '\n')
+
+        for setting, mask in sweep_thresholds(table, grid):
+            values = ['{:g}'.format(setting[name]) for name in THRESHOLDS]
+            hits = np.flatnonzero(mask)
+            counts.write('\t'.join(values + [str(len(hits))]) + '\n')
+            for i in hits:
+                donor_id = float(table['donor_identity'][i])
+                native_id = float(table['native_identity'][i])
+                listing.write('\t'.join(values) + '\t{}\t{}\t{:.1f}\t{}\t{:.1f}\t{:.1f}\n'.format(
+                    table['queries'][i],
+                    table['subjects'][table['donor_subject'][i]],
+                    donor_id,
+                    table['subjects'][table['native_subject'][i]],
+                    native_id,
+                    donor_id - native_id
+                ))
+
+    print("Candidate counts written to {}".format(counts_file))
+    print("Candidate lists written to {}".format(candidates_file))
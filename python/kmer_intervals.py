@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Cached k-mer alignment intervals for fast re-clustering
+
+find_clusters.py decodes every BAM record on each run, although clustering
+only needs each alignment's start and end. build_interval_cache stores them
+once per BAM as memory-mapped .npy arrays in <bam>.kmers/ (starts and ends
+in reference order, plus per-reference offsets), keyed by the BAM's size and
+mtime. cluster_intervals then finds the clusters for any parameter set with
+array operations, giving the same clusters as the per-read loop in
+find_clusters.py, and sweep_clusters evaluates a grid of parameters.
+
+shared_kmers.py writes the same directory layout directly from the genomes
+(mapped/shared_kmers_qv.kmers), and find_clusters.py accepts such a
+directory in place of a BAM.
+
+Usage:
+    kmer_intervals.py build mapped/shared_kmers_qv.bam
+    kmer_intervals.py summary mapped/shared_kmers_qv.kmers
+    find_clusters.py mapped/shared_kmers_qv.bam clusters/qv_clusters --cache
+    find_clusters.py mapped/shared_kmers_qv.bam clusters/qv_sweep \
+        --sweep max_gap=25,50,100 min_density=0.05,0.1,0.2
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+from array import array
+
+import numpy as np
+import pysam
+
+import sweep_grid
+
+CACHE_SUFFIX = '.kmers'
+CACHE_VERSION = 2
+CACHE_ARRAYS = ('starts', 'ends', 'offsets', 'references', 'lengths')
+PARAMETERS = ('max_gap', 'min_kmers', 'min_length', 'min_density')
+PARAMETER_TYPES = {'max_gap': int, 'min_kmers': int, 'min_length': int, 'min_density': float}
+# Bits of the optional flags.npy written by shared_kmers.py --flag-only
+FLAG_LOW_COMPLEXITY = 1
+FLAG_HIGH_COPY = 2
+
+
+def _cache_fingerprint(bam_file):
+    stat = os.stat(bam_file)
+    return {
+        'version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def read_intervals(intervals_dir):
+    """Memory-map an interval directory written by write_intervals"""
+    arrays = {name: np.load(os.path.join(intervals_dir, name + '.npy'), mmap_mode='r')
+              for name in CACHE_ARRAYS}
+    arrays['references'] = np.char.decode(arrays['references'], 'utf-8').tolist()
+    flags_file = os.path.join(intervals_dir, 'flags.npy')
+    if os.path.exists(flags_file):
+        arrays['flags'] = np.load(flags_file, mmap_mode='r')
+    return arrays
+
+
+def write_intervals(intervals_dir, starts, ends, offsets, references, lengths, meta, flags=None):
+    """Write sorted intervals as .npy files plus meta.json, swapping the directory in atomically
+
+    starts/ends are concatenated in reference order and offsets[i]:offsets[i + 1]
+    indexes reference i; flags, if given, marks each interval with FLAG_* bits.
+    Returns the arrays as read_intervals would.
+    """
+    # Positions fit in 32 bits for any contig under 2 Gb, halving the files
+    dtype = np.int32 if max(lengths, default=0) < 2 ** 31 else np.int64
+    arrays = {
+        'starts': np.asarray(starts).astype(dtype),
+        'ends': np.asarray(ends).astype(dtype),
+        'offsets': np.asarray(offsets, dtype=np.int64),
+        'references': np.array([ref.encode() for ref in references], dtype=bytes),
+        'lengths': np.asarray(lengths, dtype=np.int64),
+    }
+    if flags is not None:
+        arrays['flags'] = np.asarray(flags, dtype=np.uint8)
+    tmp_dir = '{}.tmp{}'.format(intervals_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        for name, data in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), data)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(intervals_dir):
+            shutil.rmtree(intervals_dir)
+        os.replace(tmp_dir, intervals_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    arrays['references'] = list(references)
+    return arrays
+
+
+def load_interval_cache(bam_file):
+    """Memory-map the cached intervals of bam_file, or return None if missing or stale"""
+    cache_dir = str(bam_file) + CACHE_SUFFIX
+    try:
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            if json.load(f) != _cache_fingerprint(bam_file):
+                return None
+        return read_intervals(cache_dir)
+    except (OSError, ValueError):
+        return None
+
+
+def build_interval_cache(bam_file):
+    """Read every alignment's start and end once and write <bam_file>.kmers
+
+    Unmapped records (no reference end) are skipped; they are not k-mer
+    alignments. Returns the arrays as load_interval_cache would.
+    """
+    cache_dir = str(bam_file) + CACHE_SUFFIX
+    fingerprint = _cache_fingerprint(bam_file)
+    starts = array('q')
+    ends = array('q')
+    offsets = [0]
+    with pysam.AlignmentFile(bam_file, "rb") as bam:
+        references = list(bam.references)
+        for ref in references:
+            for read in bam.fetch(ref):
+                end = read.reference_end
+                if end is None:
+                    continue
+                starts.append(read.reference_start)
+                ends.append(end)
+            offsets.append(len(starts))
+        lengths = list(bam.lengths)
+    starts = np.frombuffer(starts, dtype=np.int64)
+    ends = np.frombuffer(ends, dtype=np.int64)
+    try:
+        return write_intervals(cache_dir, starts, ends, offsets, references, lengths, fingerprint)
+    except OSError as e:
+        print("Warning: could not write interval cache {}: {}".format(cache_dir, e))
+        return {'starts': starts, 'ends': ends, 'offsets': np.asarray(offsets, dtype=np.int64),
+                'references': references, 'lengths': np.asarray(lengths, dtype=np.int64)}
+
+
+def interval_cache(bam_file):
+    """Cached intervals of bam_file, building the cache first if it is missing or stale
+
+    An interval directory (e.g. written by shared_kmers.py) is read as is.
+    """
+    if os.path.isdir(bam_file):
+        return read_intervals(bam_file)
+    intervals = load_interval_cache(bam_file)
+    if intervals is not None:
+        print("Using cached k-mer intervals from {}{}".format(bam_file, CACHE_SUFFIX))
+        return intervals
+    print("Building k-mer interval cache {}{}...".format(bam_file, CACHE_SUFFIX))
+    return build_interval_cache(bam_file)
+
+
+def drop_flagged(intervals):
+    """The intervals without the ones flagged low complexity or high copy"""
+    if 'flags' not in intervals:
+        return intervals
+    keep = np.asarray(intervals['flags']) == 0
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    return {
+        'starts': np.asarray(intervals['starts'])[keep],
+        'ends': np.asarray(intervals['ends'])[keep],
+        'offsets': kept[np.asarray(intervals['offsets'])],
+        'references': intervals['references'],
+        'lengths': intervals['lengths'],
+    }
+
+
+def segment_intervals(intervals, max_gap=50):
+    """Group alignments into runs separated by more than max_gap, as find_clusters does
+
+    Returns a dict of per-run arrays: ref_id, start, end, n_kmers,
+    covered_bases and aligned_bases. Only runs closed by a following
+    alignment on the same reference are included; find_clusters never
+    reports the run still open at the end of a reference.
+    """
+    starts = np.asarray(intervals['starts'], dtype=np.int64)
+    ends = np.asarray(intervals['ends'], dtype=np.int64)
+    offsets = np.asarray(intervals['offsets'])
+    names = ('ref_id', 'start', 'end', 'n_kmers', 'covered_bases', 'aligned_bases')
+    if len(starts) == 0:
+        return {name: np.zeros(0, dtype=np.int64) for name in names}
+
+    counts = np.diff(offsets)
+    ref_of = np.repeat(np.arange(len(counts)), counts)
+    # Shift each reference past the previous one's last end plus the gap, so a
+    # single pass over all references starts a new run at every reference
+    nonempty = counts > 0
+    span = np.zeros(len(counts), dtype=np.int64)
+    span[nonempty] = np.maximum.reduceat(ends, offsets[:-1][nonempty]) + max_gap + 1
+    shift = np.concatenate(([0], np.cumsum(span)[:-1]))[ref_of]
+    shifted_starts = starts + shift
+    shifted_ends = ends + shift
+
+    # The furthest end seen before each alignment; within a run it is the run's end so far
+    reach = np.maximum.accumulate(shifted_ends)
+    previous = np.empty_like(reach)
+    previous[0] = shifted_starts[0] - max_gap - 1
+    previous[1:] = reach[:-1]
+    first = np.flatnonzero(shifted_starts - previous > max_gap)
+    last = np.append(first[1:], len(starts)) - 1
+
+    # Bases each alignment adds to the union covered by its run
+    added = np.maximum(0, shifted_ends - np.maximum(shifted_starts, previous))
+    closed = np.append(ref_of[first[1:]] == ref_of[last[:-1]], False)
+    first, last = first[closed], last[closed]
+    return {
+        'ref_id': ref_of[first],
+        'start': starts[first],
+        'end': reach[last] - shift[first],
+        'n_kmers': last - first + 1,
+        'covered_bases': _run_sums(added, first, last),
+        'aligned_bases': _run_sums(ends - starts, first, last),
+    }
+
+
+def coverage_summary(intervals):
+    """Mean depth over all reference bases and the number of bases covered at least once
+
+    The same figures as summing `samtools depth -a` output over a BAM of the intervals.
+    """
+    starts = np.asarray(intervals['starts'], dtype=np.int64)
+    ends = np.asarray(intervals['ends'], dtype=np.int64)
+    offsets = np.asarray(intervals['offsets'])
+    total = int(np.sum(intervals['lengths']))
+    covered = 0
+    for i in np.flatnonzero(np.diff(offsets)):
+        ref_starts = starts[offsets[i]:offsets[i + 1]]
+        ref_ends = ends[offsets[i]:offsets[i + 1]]
+        previous = np.maximum.accumulate(np.concatenate(([0], ref_ends[:-1])))
+        covered += int(np.maximum(0, ref_ends - np.maximum(ref_starts, previous)).sum())
+    aligned = int((ends - starts).sum())
+    return (aligned / total if total else 0.0), covered
+
+
+def _run_sums(values, first, last):
+    """Sum values over each [first, last] index range"""
+    totals = np.concatenate(([0], np.cumsum(values)))
+    return totals[last + 1] - totals[first]
+
+
+def cluster_intervals(runs, min_kmers=3, min_length=100, min_density=0.1):
+    """Filter segmented runs to clusters; returns the runs dict restricted to clusters, plus density"""
+    length = runs['end'] - runs['start']
+    keep = (runs['n_kmers'] >= min_kmers) & (length >= min_length)
+    density = np.zeros(len(length))
+    np.divide(runs['covered_bases'], length, out=density, where=keep & (length > 0))
+    keep &= density >= min_density
+    clusters = {name: values[keep] for name, values in runs.items()}
+    clusters['density'] = density[keep]
+    return clusters
+
+
+def sweep_clusters(intervals, grid):
+    """Yield (setting, clusters) for every combination of parameter values in grid
+
+    Runs are segmented once per max_gap; the other parameters only filter them.
+    """
+    for max_gap in grid['max_gap']:
+        runs = segment_intervals(intervals, max_gap)
+        for min_kmers, min_length, min_density in itertools.product(
+                grid['min_kmers'], grid['min_length'], grid['min_density']):
+            setting = {'max_gap': max_gap, 'min_kmers': min_kmers,
+                       'min_length': min_length, 'min_density': min_density}
+            yield setting, cluster_intervals(runs, min_kmers, min_length, min_density)
+
+
+def parse_grid(specs, defaults):
+    """Turn ['max_gap=25,50,100', ...] into {parameter: [values]}
+
+    Parameters not named in specs are fixed at their value in defaults.
+    """
+    return sweep_grid.parse_grid(specs, defaults, PARAMETER_TYPES)
+
+
+def write_sweep(intervals, grid, output_file):
+    """Write one summary row per parameter combination"""
+    with open(output_file, 'w') as f:
+        f.write('\t'.join(PARAMETERS) + '\tn_clusters\ttotal_length\tmedian_length\tmedian_density\n')
+        for setting, clusters in sweep_clusters(intervals, grid):
+            length = clusters['end'] - clusters['start']
+            n_clusters = len(length)
+            f.write('{}\t{}\t{}\t{:.1f}\t{:.3f}\n'.format(
+                '\t'.join(str(setting[name]) for name in PARAMETERS), n_clusters, int(length.sum()),
+                np.median(length) if n_clusters else 0, np.median(clusters['density']) if n_clusters else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache k-mer alignment intervals of a BAM file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Write <bam>.kmers (rebuilt if the BAM changed)')
+    build.add_argument('bam_file', help='Indexed BAM of k-mer alignments')
+    build.add_argument('--force', action='store_true', help='Rebuild even if the cache is current')
+    summary = subparsers.add_parser('summary', help='Mean k-mer depth and bases covered')
+    summary.add_argument('intervals', help='Interval directory, or a BAM (its cache is built if needed)')
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        mean_depth, covered = coverage_summary(interval_cache(args.intervals))
+        print("Average coverage: {:.6g}".format(mean_depth))
+        print("Regions with coverage: {}".format(covered))
+        return
+
+    try:
+        if not args.force and load_interval_cache(args.bam_file) is not None:
+            print("{}{} is up to date".format(args.bam_file, CACHE_SUFFIX))
+            return
+        intervals = build_interval_cache(args.bam_file)
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("Cached {} alignments on {} references in {}{}".format(
+        len(intervals['starts']), len(intervals['references']), args.bam_file, CACHE_SUFFIX))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""Subject lineage classification for the filter_* scripts
+
+SubjectClassifier compiles a script's prefix rules (e.g. 'At_|' -> plant)
+into a dict lookup and can fall back to a TaxonIndex to place unprefixed
+RefSeq accessions (WP_/XP_/NP_...) by their real taxonomy.
+
+A TaxonIndex is a directory of .npy files built once from NCBI's
+prot.accession2taxid and taxdump nodes.dmp:
+    accessions.npy  sorted fixed-width accession.version keys
+    taxids.npy      taxid of each accession (uint32)
+    parents.npy     parent taxid of every taxid (uint32, indexed by taxid)
+All three are memory-mapped, so lookups are a binary search over the mapped
+file without loading it into RAM.
+
+Usage:
+    lineage.py build --accession2taxid prot.accession2taxid.gz --nodes nodes.dmp \
+        --output taxon_index [--fasta bacterial_proteins.faa ...]
+    lineage.py lookup taxon_index WP_000001.1 [...]
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from compressed_io import open_file
+
+# Clades the filter scripts care about, by NCBI taxid
+BACTERIA = 2
+ARCHAEA = 2157
+FUNGI = 4751
+VIRIDIPLANTAE = 33090
+INSECTA = 50557
+QUERCUS = 3511
+
+INDEX_VERSION = 1
+# Database prefixes BLAST may add to subject IDs when -parse_seqids was used
+SEQID_DATABASES = ('ref', 'gb', 'emb', 'dbj', 'pdb', 'sp', 'tr')
+
+
+def subject_accession(subject_id):
+    """Strip 'ref|WP_000001.1|'-style wrappers down to the accession"""
+    parts = subject_id.split('|')
+    if len(parts) > 1 and parts[0] in SEQID_DATABASES:
+        return parts[1]
+    return subject_id
+
+
+class TaxonIndex:
+    """Memory-mapped accession -> taxid -> lineage lookups"""
+
+    def __init__(self, index_dir):
+        self.index_dir = str(index_dir)
+        self._open()
+
+    def _open(self):
+        with open(os.path.join(self.index_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError("{} was built by an incompatible version of lineage.py".format(self.index_dir))
+        self.accessions = np.load(os.path.join(self.index_dir, 'accessions.npy'), mmap_mode='r')
+        self.taxids = np.load(os.path.join(self.index_dir, 'taxids.npy'), mmap_mode='r')
+        self.parents = np.load(os.path.join(self.index_dir, 'parents.npy'), mmap_mode='r')
+        self._width = self.accessions.dtype.itemsize
+
+    # Pickle by path so classifiers can be sent to worker processes without
+    # copying the mapped arrays
+    def __getstate__(self):
+        return {'index_dir': self.index_dir}
+
+    def __setstate__(self, state):
+        self.index_dir = state['index_dir']
+        self._open()
+
+    def __len__(self):
+        return len(self.accessions)
+
+    def taxid(self, accession):
+        """Taxid of an accession.version, or None if it is not in the index"""
+        key = subject_accession(accession).encode()
+        if len(key) > self._width:
+            return None
+        i = int(np.searchsorted(self.accessions, key))
+        if i < len(self.accessions) and self.accessions[i] == key:
+            return int(self.taxids[i])
+        return None
+
+    def lineage(self, taxid):
+        """Taxids from taxid up to the root"""
+        lineage = []
+        while 0 < taxid < len(self.parents) and taxid not in lineage:
+            lineage.append(taxid)
+            taxid = int(self.parents[taxid])
+        return lineage
+
+
+class SubjectClassifier:
+    """Callable mapping a BLAST subject ID to a category name
+
+    Prefix rules are grouped by the text up to the first underscore, so each
+    subject costs one dict lookup plus a startswith check or two instead of a
+    chain of startswith calls. Subjects that match no rule are looked up in
+    taxon_index, when one is given, and assigned the category of the first
+    clade in lineages (taxid -> category) found in their lineage; accessions
+    in the index but outside every clade are ignored (None). Everything else
+    gets the default category.
+    """
+
+    def __init__(self, rules, default=None, taxon_index=None, lineages=None):
+        self.rules = list(rules)
+        self.default = default
+        self.taxon_index = taxon_index
+        self.lineages = dict(lineages or {})
+        self._by_key = {}
+        self._irregular = []
+        # Longest prefixes first so 'Nv_|' is tried before 'Nv_'
+        for prefix, category in sorted(self.rules, key=lambda rule: -len(rule[0])):
+            cut = prefix.find('_')
+            if cut < 0:
+                self._irregular.append((prefix, category))
+            else:
+                self._by_key.setdefault(prefix[:cut + 1], []).append((prefix, category))
+
+    def __repr__(self):
+        index_dir = self.taxon_index.index_dir if self.taxon_index is not None else None
+        return 'SubjectClassifier({!r}, default={!r}, taxon_index={!r}, lineages={!r})'.format(
+            self.rules, self.default, index_dir, sorted(self.lineages.items()))
+
+    def __call__(self, subject_id):
+        cut = subject_id.find('_')
+        if cut >= 0:
+            for prefix, category in self._by_key.get(subject_id[:cut + 1], ()):
+                if subject_id.startswith(prefix):
+                    return category
+        for prefix, category in self._irregular:
+            if subject_id.startswith(prefix):
+                return category
+
+        if self.taxon_index is not None and self.lineages:
+            taxid = self.taxon_index.taxid(subject_id)
+            if taxid is not None:
+                for ancestor in self.taxon_index.lineage(taxid):
+                    if ancestor in self.lineages:
+                        return self.lineages[ancestor]
+                return None
+        return self.default
+
+
+def _fasta_accessions(fasta_files):
+    """Set of accessions (first word of each header) in FASTA files"""
+    accessions = set()
+    for fasta_file in fasta_files:
+        with open_file(fasta_file, 'r') as f:
+            for line in f:
+                if line.startswith('>'):
+                    accessions.add(line[1:].split(None, 1)[0])
+    return accessions
+
+
+def _write_run(records, run_dir, n_runs):
+    """Sort one in-memory block of (accession, taxid) records and save it as a run"""
+    keys = np.array([r[0] for r in records], dtype=bytes)
+    taxids = np.array([r[1] for r in records], dtype=np.uint32)
+    order = np.argsort(keys, kind='stable')
+    path = os.path.join(run_dir, 'run{}'.format(n_runs))
+    np.save(path + '.keys.npy', keys[order])
+    np.save(path + '.taxids.npy', taxids[order])
+    return path
+
+
+def _merge_runs(runs, accessions, taxids, block_size=1000000):
+    """Merge sorted runs into the accessions and taxids arrays, a block of each run at a time
+
+    Each round takes the next block of every unfinished run. Everything up to
+    the smallest of the blocks' last keys cannot be preceded by a later
+    record, so those slices (found with searchsorted) are sorted together
+    and written out. Equal keys keep run order, so the first record wins.
+    """
+    dtype = accessions.dtype
+    keys = [np.load(path + '.keys.npy', mmap_mode='r') for path in runs]
+    values = [np.load(path + '.taxids.npy', mmap_mode='r') for path in runs]
+    positions = [0] * len(runs)
+    out = 0
+    while True:
+        active = [r for r in range(len(runs)) if positions[r] < len(keys[r])]
+        if not active:
+            break
+        blocks = {r: keys[r][positions[r]:positions[r] + block_size].astype(dtype) for r in active}
+        bound = min(block[-1] for block in blocks.values())
+        key_parts = []
+        taxid_parts = []
+        for r in active:
+            cut = int(np.searchsorted(blocks[r], bound, side='right'))
+            key_parts.append(blocks[r][:cut])
+            taxid_parts.append(values[r][positions[r]:positions[r] + cut])
+            positions[r] += cut
+        merged_keys = np.concatenate(key_parts)
+        order = np.argsort(merged_keys, kind='stable')
+        accessions[out:out + len(order)] = merged_keys[order]
+        taxids[out:out + len(order)] = np.concatenate(taxid_parts)[order]
+        out += len(order)
+
+
+def build_taxon_index(accession2taxid_files, nodes_file, output_dir, fasta_files=None,
+                      run_size=20000000):
+    """Build a TaxonIndex directory from accession2taxid tables and nodes.dmp
+
+    Records are sorted in blocks of run_size and the sorted runs are merged
+    on disk, so memory stays bounded however large the mapping is. If
+    fasta_files are given, only their accessions are indexed.
+    """
+    wanted = _fasta_accessions(fasta_files) if fasta_files else None
+    run_dir = os.path.join(output_dir, 'runs')
+    os.makedirs(run_dir, exist_ok=True)
+
+    runs = []
+    records = []
+    for mapping_file in accession2taxid_files:
+        print("Reading {}...".format(mapping_file))
+        with open_file(mapping_file, 'r') as f:
+            for line in f:
+                # accession  accession.version  taxid  gi
+                fields = line.split('\t')
+                if len(fields) < 3 or fields[2] == 'taxid':
+                    continue
+                if wanted is not None and fields[1] not in wanted:
+                    continue
+                records.append((fields[1].encode(), int(fields[2])))
+                if len(records) >= run_size:
+                    runs.append(_write_run(records, run_dir, len(runs)))
+                    records = []
+    if records or not runs:
+        runs.append(_write_run(records, run_dir, len(runs)))
+    del records
+
+    width = max(np.load(path + '.keys.npy', mmap_mode='r').dtype.itemsize for path in runs)
+    total = sum(len(np.load(path + '.taxids.npy', mmap_mode='r')) for path in runs)
+    print("Merging {} sorted runs ({:,} accessions)...".format(len(runs), total))
+    accessions = np.lib.format.open_memmap(
+        os.path.join(output_dir, 'accessions.npy'), mode='w+', dtype='S{}'.format(width), shape=(total,))
+    taxids = np.lib.format.open_memmap(
+        os.path.join(output_dir, 'taxids.npy'), mode='w+', dtype=np.uint32, shape=(total,))
+    _merge_runs(runs, accessions, taxids)
+    accessions.flush()
+    taxids.flush()
+    del accessions, taxids
+
+    for path in runs:
+        os.remove(path + '.keys.npy')
+        os.remove(path + '.taxids.npy')
+    os.rmdir(run_dir)
+
+    print("Reading {}...".format(nodes_file))
+    nodes = []
+    with open_file(nodes_file, 'r') as f:
+        for line in f:
+            fields = line.split('\t|\t', 2)
+            nodes.append((int(fields[0]), int(fields[1])))
+    parents = np.zeros(max(taxid for taxid, _ in nodes) + 1, dtype=np.uint32)
+    for taxid, parent in nodes:
+        parents[taxid] = parent
+    np.save(os.path.join(output_dir, 'parents.npy'), parents)
+
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'accessions': total, 'width': width}, f)
+    print("Taxon index written to {}".format(output_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query an accession -> taxid -> lineage index')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Build an index from NCBI accession2taxid and nodes.dmp')
+    build.add_argument('--accession2taxid', nargs='+', required=True,
+                       help='prot.accession2taxid table(s), optionally compressed')
+    build.add_argument('--nodes', required=True, help='nodes.dmp from the NCBI taxdump')
+    build.add_argument('--output', required=True, help='Output index directory')
+    build.add_argument('--fasta', nargs='+',
+                       help='Only index accessions found in these FASTA files (e.g. bacterial_proteins.faa)')
+    build.add_argument('--run-size', type=int, default=20000000,
+                       help='Records sorted in memory at a time (default: 20000000)')
+
+    lookup = subparsers.add_parser('lookup', help='Print taxid and lineage for accessions')
+    lookup.add_argument('index', help='Index directory')
+    lookup.add_argument('accessions', nargs='+', help='Accession.version IDs')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_taxon_index(args.accession2taxid, args.nodes, args.output, args.fasta, args.run_size)
+    else:
+        index = TaxonIndex(args.index)
+        for accession in args.accessions:
+            taxid = index.taxid(accession)
+            if taxid is None:
+                print("{}\tnot found".format(accession), file=sys.stderr)
+            else:
+                print("{}\t{}\t{}".format(accession, taxid, ';'.join(str(t) for t in reversed(index.lineage(taxid)))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""DUST-style low-complexity scores for k-mers and extracted regions
+
+Both scores count the trinucleotides of a window: with c_t occurrences of
+triplet t among l triplets, the DUST score is sum(c_t * (c_t - 1) / 2) / (l - 1).
+Random sequence scores well under 1, while simple repeats score highly: a
+31-mer homopolymer scores 14.5 and a dinucleotide repeat about 7.
+
+kmer_dust_scores works on the 2-bit packed k-mers of shared_kmers.py;
+masked_fraction scores a region in 64 bp windows and returns the fraction of
+its bases in a window scoring above 2, dustmasker's default level 20 (sdust
+compares 10 x score with the level). Unlike sdust, only whole windows are
+scored, not their best sub-interval.
+
+Usage:
+    low_complexity.py clusters/qv_sequences.fasta --output clusters/qv_sequences.filtered.fasta
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+from dedup_sequences import iter_fasta, write_fasta_record
+
+CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    CODES[_base] = _code
+    CODES[ord(chr(_base).lower())] = _code
+
+SDUST_WINDOW = 64
+SDUST_THRESHOLD = 2.0
+BLOCK = 1 << 16
+
+
+def kmer_dust_scores(kmers, k=31):
+    """DUST score of each 2-bit packed k-mer (first base in the highest bits)"""
+    n_triplets = k - 2
+    if n_triplets < 2:
+        return np.zeros(len(kmers))
+    # Triplet j covers bases j..j+2, the last of which sits 2 * (k - 3 - j) bits up
+    shifts = (np.uint64(2) * np.arange(n_triplets - 1, -1, -1)).astype(np.uint64)
+    scores = np.empty(len(kmers))
+    for start in range(0, len(kmers), BLOCK):
+        part = np.asarray(kmers[start:start + BLOCK], dtype=np.uint64)
+        triplets = ((part[:, None] >> shifts) & np.uint64(63)).astype(np.int64)
+        rows = np.arange(len(part))[:, None] * 64
+        counts = np.bincount((rows + triplets).ravel(), minlength=len(part) * 64).reshape(-1, 64)
+        scores[start:start + len(part)] = (counts * (counts - 1) // 2).sum(axis=1) / (n_triplets - 1)
+    return scores
+
+
+def window_dust_scores(sequence, window=SDUST_WINDOW):
+    """DUST score of every window of a sequence (bytes), over the triplets without N"""
+    codes = CODES[np.frombuffer(sequence, dtype=np.uint8)].astype(np.int64)
+    n_triplets = len(codes) - 2
+    if n_triplets < 1:
+        return np.zeros(0)
+    valid = (codes[:-2] < 4) & (codes[1:-1] < 4) & (codes[2:] < 4)
+    triplets = (codes[:-2] & 3) * 16 + (codes[1:-1] & 3) * 4 + (codes[2:] & 3)
+    span = min(window, len(codes)) - 2
+    n_windows = n_triplets - span + 1
+    scores = np.empty(n_windows)
+    # Cumulative per-triplet counts over one block of windows at a time
+    for first in range(0, n_windows, BLOCK):
+        last = min(first + BLOCK, n_windows)
+        block = slice(first, last + span - 1)
+        onehot = np.zeros((last + span - 1 - first, 64), dtype=np.int32)
+        onehot[np.arange(onehot.shape[0]), triplets[block]] = valid[block]
+        cumulative = np.concatenate((np.zeros((1, 64), dtype=np.int32), np.cumsum(onehot, axis=0)))
+        counts = cumulative[span:] - cumulative[:-span]
+        pairs = (counts * (counts - 1) // 2).sum(axis=1)
+        length = counts.sum(axis=1)
+        scores[first:last] = np.where(length > 1, pairs / np.maximum(length - 1, 1), 0)
+    return scores
+
+
+def masked_fraction(sequence, window=SDUST_WINDOW, threshold=SDUST_THRESHOLD):
+    """Fraction of a sequence's bases inside a window whose DUST score exceeds threshold"""
+    if len(sequence) == 0:
+        return 0.0
+    scores = window_dust_scores(sequence, window)
+    starts = np.flatnonzero(scores > threshold)
+    if len(starts) == 0:
+        return 0.0
+    span = min(window, len(sequence))
+    depth = np.cumsum(np.bincount(starts, minlength=len(sequence) + 1)
+                      - np.bincount(starts + span, minlength=len(sequence) + 1))
+    return np.count_nonzero(depth[:len(sequence)]) / len(sequence)
+
+
+def filter_fasta(fasta_file, output_file, max_masked=0.5, window=SDUST_WINDOW, threshold=SDUST_THRESHOLD):
+    """Copy the records of fasta_file whose masked fraction is at most max_masked
+
+    Returns (records kept, records dropped).
+    """
+    kept = dropped = 0
+    with open(output_file, 'w') as out:
+        for header, sequence in iter_fasta(fasta_file):
+            if masked_fraction(sequence.encode(), window, threshold) > max_masked:
+                dropped += 1
+                continue
+            write_fasta_record(out, header, sequence, 60)
+            kept += 1
+    return kept, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drop low-complexity sequences (DUST) from a FASTA file')
+    parser.add_argument('fasta', help='Nucleotide FASTA, e.g. extracted cluster regions')
+    parser.add_argument('--output', required=True, help='FASTA of the records that pass')
+    parser.add_argument('--max-masked', type=float, default=0.5,
+                        help='Drop records with more than this fraction of bases in '
+                             'low-complexity windows (default: 0.5)')
+    parser.add_argument('--window', type=int, default=SDUST_WINDOW, help='Window length (default: 64)')
+    parser.add_argument('--threshold', type=float, default=SDUST_THRESHOLD,
+                        help='Window DUST score above which bases are masked (default: 2, '
+                             'i.e. dustmasker level 20)')
+    args = parser.parse_args()
+
+    try:
+        kept, dropped = filter_fasta(args.fasta, args.output, args.max_masked, args.window, args.threshold)
+    except OSError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("Kept {} sequences, dropped {} low-complexity sequences".format(kept, dropped))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Memory-mapped protein sequence and description store
+
+Looking up a BLAST subject's description or sequence otherwise means an NCBI
+query or a scan of a multi-GB FASTA. A ProteinStore is a directory built
+once from the FASTA files:
+    records.bin              description then residues of every record, back to back
+    accessions.npy           sorted fixed-width accession keys (first word of the header)
+    offsets.npy              start of each accession's record in records.bin (uint64)
+    description_lengths.npy  bytes of description at that offset (uint32)
+    lengths.npy              residues after the description (uint32)
+Everything is memory-mapped, so a lookup is a binary search plus one read,
+without loading the store into RAM.
+
+Build it from the FASTA before dedup_sequences.py collapse so that every
+member accession, not only the representatives, can be looked up.
+
+Usage:
+    protein_store.py build --fasta bacterial_proteins.faa.gz --output bacterial_store
+    protein_store.py lookup bacterial_store WP_000001.1 [...] [--fasta]
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import sys
+from array import array
+
+import numpy as np
+
+from compressed_io import open_file
+from lineage import subject_accession
+
+STORE_VERSION = 1
+KEY_BLOCK = 1000000
+ORGANISM = re.compile(r'\[([^\[\]]+)\]\s*$')
+
+
+def organism_of(description):
+    """Organism from a RefSeq-style description ('... [Escherichia coli]'), or ''"""
+    match = ORGANISM.search(description)
+    return match.group(1) if match else ''
+
+
+class ProteinStore:
+    """Memory-mapped accession -> description and sequence lookups"""
+
+    def __init__(self, store_dir):
+        self.store_dir = str(store_dir)
+        self._open()
+
+    def _open(self):
+        with open(os.path.join(self.store_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError("{} was built by an incompatible version of protein_store.py".format(self.store_dir))
+        self.accessions = np.load(os.path.join(self.store_dir, 'accessions.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(self.store_dir, 'offsets.npy'), mmap_mode='r')
+        self.description_lengths = np.load(os.path.join(self.store_dir, 'description_lengths.npy'), mmap_mode='r')
+        self.lengths = np.load(os.path.join(self.store_dir, 'lengths.npy'), mmap_mode='r')
+        self._width = self.accessions.dtype.itemsize
+        self._records = b''
+        path = os.path.join(self.store_dir, 'records.bin')
+        if os.path.getsize(path):
+            with open(path, 'rb') as f:
+                self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Pickle by path, like TaxonIndex, so stores can be sent to worker processes
+    def __getstate__(self):
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.store_dir = state['store_dir']
+        self._open()
+
+    def __len__(self):
+        return len(self.accessions)
+
+    def __contains__(self, accession):
+        return self._find(accession) is not None
+
+    def _find(self, accession):
+        key = subject_accession(accession).encode()
+        if len(key) > self._width:
+            return None
+        i = int(np.searchsorted(self.accessions, key))
+        if i < len(self.accessions) and self.accessions[i] == key:
+            return i
+        return None
+
+    def lookup(self, accession):
+        """{'accession', 'description', 'organism', 'length', 'sequence'}, or None if absent"""
+        i = self._find(accession)
+        if i is None:
+            return None
+        start = int(self.offsets[i])
+        cut = start + int(self.description_lengths[i])
+        length = int(self.lengths[i])
+        description = self._records[start:cut].decode()
+        return {
+            'accession': self.accessions[i].decode(),
+            'description': description,
+            'organism': organism_of(description),
+            'length': length,
+            'sequence': self._records[cut:cut + length].decode()
+        }
+
+
+def protein_columns(label):
+    """Header cells matching format_protein, e.g. Bacterial_hit_description for 'bacterial'"""
+    label = label.capitalize()
+    return ['{}_hit_{}'.format(label, field) for field in ('description', 'organism', 'length', 'sequence')]
+
+
+def format_protein(store, subject_id):
+    """Table cells (tab-joined) describing a subject; '-' when it is not in the store"""
+    record = store.lookup(subject_id)
+    if record is None:
+        return '\t'.join(['-'] * 4)
+    return '\t'.join([record['description'].replace('\t', ' ') or '-', record['organism'] or '-',
+                      str(record['length']), record['sequence']])
+
+
+def build_protein_store(fasta_files, output_dir):
+    """Pack FASTA records into a ProteinStore directory
+
+    Records are appended to records.bin as they are read; only the keys and
+    offsets are kept in memory for the final sort. The first record of a
+    repeated accession wins. Returns the number of records.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    key_blocks = []
+    keys = []
+    offsets = array('Q')
+    description_lengths = array('I')
+    lengths = array('I')
+    position = 0
+    with open(os.path.join(output_dir, 'records.bin'), 'wb') as out:
+        def add_record(header, parts):
+            nonlocal position
+            fields = header.split(None, 1)
+            description = fields[1].strip() if len(fields) > 1 else b''
+            sequence = b''.join(parts)
+            # Same key form as ProteinStore._find, so 'ref|WP_000001.1|' headers are found too
+            keys.append(subject_accession(fields[0].decode()).encode() if fields else b'')
+            offsets.append(position)
+            description_lengths.append(len(description))
+            lengths.append(len(sequence))
+            out.write(description)
+            out.write(sequence)
+            position += len(description) + len(sequence)
+            if len(keys) >= KEY_BLOCK:
+                key_blocks.append(np.array(keys, dtype=bytes))
+                keys.clear()
+
+        for fasta_file in fasta_files:
+            print("Reading {}...".format(fasta_file))
+            header = None
+            parts = []
+            with open_file(fasta_file, 'rb') as f:
+                for line in f:
+                    if line.startswith(b'>'):
+                        if header is not None:
+                            add_record(header, parts)
+                        header = line[1:]
+                        parts = []
+                    elif header is not None:
+                        parts.append(line.strip())
+            if header is not None:
+                add_record(header, parts)
+    key_blocks.append(np.array(keys, dtype=bytes))
+
+    accessions = np.concatenate(key_blocks) if len(key_blocks) > 1 else key_blocks[0]
+    if accessions.dtype.itemsize == 0:
+        accessions = accessions.astype('S1')
+    print("Sorting {:,} accessions...".format(len(accessions)))
+    order = np.argsort(accessions, kind='stable')
+    np.save(os.path.join(output_dir, 'accessions.npy'), accessions[order])
+    np.save(os.path.join(output_dir, 'offsets.npy'), np.frombuffer(offsets, dtype=np.uint64)[order])
+    np.save(os.path.join(output_dir, 'description_lengths.npy'),
+            np.frombuffer(description_lengths, dtype=np.uint32)[order])
+    np.save(os.path.join(output_dir, 'lengths.npy'), np.frombuffer(lengths, dtype=np.uint32)[order])
+
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': STORE_VERSION, 'records': len(accessions),
+                   'fasta': [os.path.abspath(path) for path in fasta_files]}, f)
+    print("Protein store written to {}".format(output_dir))
+    return len(accessions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query a memory-mapped protein store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Pack protein FASTA files into a store')
+    build.add_argument('--fasta', nargs='+', required=True,
+                       help='Protein FASTA file(s), optionally compressed (e.g. bacterial_proteins.faa)')
+    build.add_argument('--output', required=True, help='Output store directory')
+
+    lookup = subparsers.add_parser('lookup', help='Print description, organism, length and sequence')
+    lookup.add_argument('store', help='Store directory')
+    lookup.add_argument('accessions', nargs='+', help='Accession.version IDs')
+    lookup.add_argument('--fasta', action='store_true', help='Print FASTA records instead of a table')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        try:
+            build_protein_store(args.fasta, args.output)
+        except OSError as e:
+            print("Error: {}".format(e), file=sys.stderr)
+            sys.exit(1)
+        return
+
+    store = ProteinStore(args.store)
+    for accession in args.accessions:
+        record = store.lookup(accession)
+        if record is None:
+            print("{}\tnot found".format(accession), file=sys.stderr)
+        elif args.fasta:
+            print(">{} {}".format(record['accession'], record['description']).rstrip())
+            for i in range(0, record['length'], 80):
+                print(record['sequence'][i:i + 80])
+        else:
+            print("{}\t{}\t{}\t{}\t{}".format(accession, record['description'], record['organism'] or '-',
+                                              record['length'], record['sequence']))
+
+
+if __name__ == "__main__":
+    main()
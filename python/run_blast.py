@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""Run a chunked blastp search locally or as a Slurm array, resuming unfinished chunks
+
+One run is described by a run.json in its work directory (query, database,
+BLAST parameters, chunk count). The query is split with split_queries.py;
+chunk <i> is written to <results_dir>/results_<name>_<i>.out. blastp writes
+to a .partial file that is renamed when it exits successfully, then a
+<output>.done marker records the chunk checksum and BLAST parameters. A
+chunk counts as finished only when its marker matches the current chunk
+and parameters, so re-running the same command only runs what is missing
+or stale. The markers are the ones the filter scripts' --watch mode waits
+for.
+
+Usage:
+    run_blast.py run input_sequences/Q_virginiana_protein_prefixed.faa \
+        --db blast_dbs/oak_bact_db --name oak_bact [--backend slurm] \
+        [--merged blast_results/Q_virginiana_vs_bacterial.out]
+    run_blast.py chunk temp/oak_bact/run.json 3      # one chunk (used by array tasks)
+    run_blast.py merge temp/oak_bact/run.json       # check and concatenate outputs
+
+With --collapse-queries, identical query sequences are collapsed (see
+dedup_sequences.py) before splitting so each is BLASTed once; the merge step
+writes every original query ID's rows back, in query order.
+
+fake_blastp.py stands in for blastp (--blastp python/fake_blastp.py) to try
+out scheduling and resume without a database.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from compressed_io import available_cpus
+from dedup_sequences import collapse_fasta, expand_blast_rows
+from split_queries import MANIFEST_NAME, load_manifest, split_queries, verify_chunk, verify_results
+
+DONE_SUFFIX = '.done'
+CONFIG_NAME = 'run.json'
+UNIQUE_QUERIES = 'unique_queries.faa'
+QUERY_MEMBERS = 'query_members.tsv'
+SLURM_SETUP = 'source ~/.bashrc\nconda activate genomics'
+
+
+def _write_json(path, data):
+    tmp_file = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_file, path)
+
+
+def blast_params(config):
+    """The settings a finished chunk's output depends on"""
+    return {key: config[key] for key in ('db', 'evalue', 'outfmt', 'extra_args')}
+
+
+def chunk_output(config, index):
+    return os.path.join(config['results_dir'], 'results_{}_{}.out'.format(config['name'], index))
+
+
+def prepare_run(query, db, name, n_chunks, work_dir=None, results_dir='blast_results',
+                evalue='1e-5', outfmt='6', extra_args=None, blastp='blastp', collapse_queries=False):
+    """Write run.json and split the query, reusing an existing split of the same input"""
+    work_dir = os.path.abspath(work_dir or os.path.join('temp', name))
+    stat = os.stat(query)
+    config = {
+        'name': name,
+        'query': os.path.abspath(query),
+        'query_size': stat.st_size,
+        'query_mtime_ns': stat.st_mtime_ns,
+        'db': os.path.abspath(db),
+        'n_chunks': n_chunks,
+        'collapse_queries': collapse_queries,
+        'work_dir': work_dir,
+        'results_dir': os.path.abspath(results_dir),
+        'evalue': str(evalue),
+        'outfmt': str(outfmt),
+        'extra_args': list(extra_args or []),
+        # Resolve a blastp given as a path (e.g. the fake) so array tasks find it from any directory
+        'blastp': os.path.abspath(blastp) if os.path.sep in blastp else blastp,
+    }
+    os.makedirs(work_dir, exist_ok=True)
+    os.makedirs(config['results_dir'], exist_ok=True)
+
+    config_file = os.path.join(work_dir, CONFIG_NAME)
+    previous = None
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            previous = json.load(f)
+    split_keys = ('query', 'query_size', 'query_mtime_ns', 'n_chunks', 'collapse_queries')
+    if (previous is None or any(previous.get(key) != config[key] for key in split_keys)
+            or not os.path.exists(os.path.join(work_dir, MANIFEST_NAME))):
+        split_input = query
+        if collapse_queries:
+            split_input = os.path.join(work_dir, UNIQUE_QUERIES)
+            n_sequences, n_unique = collapse_fasta([query], split_input, os.path.join(work_dir, QUERY_MEMBERS))
+            print("Collapsed {} queries to {} distinct sequences".format(n_sequences, n_unique))
+        print("Splitting {} into {} chunks...".format(split_input, n_chunks))
+        split_queries(split_input, n_chunks, work_dir)
+    _write_json(config_file, config)
+    return config_file
+
+
+def load_config(config_file):
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+    config['config_file'] = os.path.abspath(config_file)
+    return config
+
+
+def chunk_is_done(config, index, chunk):
+    """True if chunk index has an output made from this chunk with these parameters"""
+    output = chunk_output(config, index)
+    try:
+        with open(output + DONE_SUFFIX, 'r') as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (os.path.exists(output) and marker.get('sha256') == chunk['sha256']
+            and marker.get('params') == blast_params(config))
+
+
+def pending_chunks(config):
+    manifest = load_manifest(os.path.join(config['work_dir'], MANIFEST_NAME))
+    return [i for i, chunk in enumerate(manifest['chunks']) if not chunk_is_done(config, i, chunk)]
+
+
+def run_chunk(config, index, threads=1):
+    """Run blastp on one chunk unless it is already done; returns True if it ran"""
+    chunk = verify_chunk(os.path.join(config['work_dir'], MANIFEST_NAME), index)
+    if chunk_is_done(config, index, chunk):
+        print("Chunk {} already done, skipping".format(index))
+        return False
+
+    output = chunk_output(config, index)
+    partial = output + '.partial'
+    if os.path.exists(output + DONE_SUFFIX):
+        os.remove(output + DONE_SUFFIX)
+    if chunk['n_sequences'] == 0:
+        # More chunks than sequences; an empty output keeps the numbering complete
+        open(partial, 'w').close()
+    else:
+        command = [
+            config['blastp'],
+            '-query', os.path.join(config['work_dir'], chunk['file']),
+            '-db', config['db'],
+            '-out', partial,
+            '-outfmt', config['outfmt'],
+            '-evalue', config['evalue'],
+            '-num_threads', str(threads),
+        ] + config['extra_args']
+        print("Starting BLAST for chunk {} ({} sequences, {} residues, {} threads)".format(
+            index, chunk['n_sequences'], chunk['residues'], threads))
+        subprocess.run(command, check=True)
+    os.replace(partial, output)
+    _write_json(output + DONE_SUFFIX, {'sha256': chunk['sha256'], 'params': blast_params(config)})
+    print("BLAST complete for chunk {}".format(index))
+    return True
+
+
+def run_local(config, workers=None, threads=None):
+    """Run pending chunks in a local pool; returns the indices that failed"""
+    pending = pending_chunks(config)
+    if not pending:
+        print("All {} chunks are already done".format(config['n_chunks']))
+        return []
+    cpus = available_cpus()
+    # blastp threading levels off around 8 threads, so run several chunks side by side
+    workers = min(workers or max(1, cpus // 8), len(pending))
+    threads = threads or max(1, cpus // workers)
+    print("Running {} of {} chunks, {} at a time with {} threads each".format(
+        len(pending), config['n_chunks'], workers, threads))
+
+    def attempt(index):
+        try:
+            run_chunk(config, index, threads)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            print("Chunk {} failed: {}".format(index, e), file=sys.stderr)
+            return index
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [index for index in pool.map(attempt, pending) if index is not None]
+
+
+def slurm_array_script(config, pending, partition='ceti', time='240:00:00', mem='16G', cpus=16,
+                       max_parallel=4, setup=SLURM_SETUP):
+    """sbatch script running the pending chunks as array tasks"""
+    name = config['name']
+    return '\n'.join([
+        '#!/bin/bash',
+        '#SBATCH --job-name=blastp_{}'.format(name),
+        '#SBATCH --output=logs/blastp_{}_%A_%a.out'.format(name),
+        '#SBATCH --error=logs/blastp_{}_%A_%a.err'.format(name),
+        '#SBATCH --time={}'.format(time),
+        '#SBATCH --mem={}'.format(mem),
+        '#SBATCH --cpus-per-task={}'.format(cpus),
+        '#SBATCH --partition={}'.format(partition),
+        '#SBATCH --array={}%{}'.format(','.join(str(i) for i in pending), max_parallel),
+        '',
+        setup,
+        '',
+        'python {} chunk {} ${{SLURM_ARRAY_TASK_ID}} --threads ${{SLURM_CPUS_PER_TASK}}'.format(
+            shlex.quote(os.path.abspath(__file__)), shlex.quote(config['config_file'])),
+        '',
+    ])
+
+
+def submit_after(job_id, job_name, command, partition='ceti', setup=SLURM_SETUP):
+    """Submit command as a job that starts once job_id has succeeded; returns its job ID"""
+    wrapped = '; '.join(setup.splitlines() + [command])
+    after_id = subprocess.run(
+        ['sbatch', '--parsable', '--dependency=afterok:{}'.format(job_id), '--job-name={}'.format(job_name),
+         '--output=logs/{}_%j.out'.format(job_name), '--partition={}'.format(partition), '--wrap', wrapped],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.strip().split(';')[0]
+    print("Submitted {} job {} (runs after {} succeeds)".format(job_name, after_id, job_id))
+    return after_id
+
+
+def submit_slurm(config, merged=None, dry_run=False, **slurm_options):
+    """Submit pending chunks as an array job, plus a merge job that runs once they all succeed
+
+    Returns the array job ID, or None if nothing was submitted.
+    """
+    pending = pending_chunks(config)
+    if not pending:
+        print("All {} chunks are already done".format(config['n_chunks']))
+        return None
+    os.makedirs('logs', exist_ok=True)
+    script_file = os.path.join(config['work_dir'], 'blast_array.sh')
+    with open(script_file, 'w') as f:
+        f.write(slurm_array_script(config, pending, **slurm_options))
+    print("Array script for {} of {} chunks written to {}".format(len(pending), config['n_chunks'], script_file))
+    if dry_run:
+        return None
+
+    job_id = subprocess.run(['sbatch', '--parsable', script_file], check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout.strip().split(';')[0]
+    print("Submitted array job {}".format(job_id))
+    if merged:
+        merge_command = 'python {} merge {} --merged {}'.format(
+            shlex.quote(os.path.abspath(__file__)), shlex.quote(config['config_file']),
+            shlex.quote(os.path.abspath(merged)))
+        submit_after(job_id, 'merge_{}'.format(config['name']), merge_command,
+                     slurm_options.get('partition', 'ceti'))
+    return job_id
+
+
+def merge_outputs(config, merged):
+    """Check every chunk is done and matches the manifest, then concatenate in chunk order"""
+    pending = pending_chunks(config)
+    if pending:
+        raise ValueError("Chunks not finished: {}".format(', '.join(str(i) for i in pending)))
+    template = os.path.join(config['results_dir'], 'results_{}_{{}}.out'.format(config['name']))
+    problems = verify_results(os.path.join(config['work_dir'], MANIFEST_NAME), template)
+    if problems:
+        raise ValueError('; '.join(problems))
+    # Rows of collapsed queries are expanded from a separate concatenation into merged
+    suffix = '.collapsed.tmp{}' if config.get('collapse_queries') else '.tmp{}'
+    tmp_file = merged + suffix.format(os.getpid())
+    with open(tmp_file, 'wb') as out:
+        for i in range(config['n_chunks']):
+            with open(chunk_output(config, i), 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    out.write(block)
+    if config.get('collapse_queries'):
+        try:
+            expand_blast_rows(tmp_file, os.path.join(config['work_dir'], QUERY_MEMBERS), merged, config['query'])
+        finally:
+            os.remove(tmp_file)
+    else:
+        os.replace(tmp_file, merged)
+    print("Merged {} chunk outputs into {}".format(config['n_chunks'], merged))
+
+
+def add_run_arguments(parser):
+    """Chunking, BLAST and backend options shared by run_blast.py and two_stage_blast.py"""
+    parser.add_argument('--chunks', type=int, default=10, help='Number of chunks (default: 10)')
+    parser.add_argument('--results-dir', default='blast_results',
+                        help='Directory for chunk outputs (default: blast_results)')
+    parser.add_argument('--evalue', default='1e-5', help='blastp -evalue (default: 1e-5)')
+    parser.add_argument('--outfmt', default='6', help='blastp -outfmt (default: 6)')
+    parser.add_argument('--blast-args', default='', help="Extra blastp arguments, e.g. '-max_target_seqs 50'")
+    parser.add_argument('--blastp', default='blastp',
+                        help='blastp executable (e.g. python/fake_blastp.py for testing)')
+    parser.add_argument('--collapse-queries', action='store_true',
+                        help='BLAST each distinct query sequence once; merged output lists every query')
+    parser.add_argument('--backend', choices=['local', 'slurm'], default='local',
+                        help='Run chunks in a local pool or as a Slurm array job (default: local)')
+    parser.add_argument('--workers', type=int, help='Local: chunks run at once (default: available CPUs / 8)')
+    parser.add_argument('--threads', type=int,
+                        help='Local: blastp -num_threads (default: available CPUs / workers)')
+    parser.add_argument('--partition', default='ceti', help='Slurm partition (default: ceti)')
+    parser.add_argument('--time', default='240:00:00', help='Slurm time limit per task (default: 240:00:00)')
+    parser.add_argument('--mem', default='16G', help='Slurm memory per task (default: 16G)')
+    parser.add_argument('--cpus-per-task', type=int, default=16, help='Slurm CPUs per task (default: 16)')
+    parser.add_argument('--max-parallel', type=int, default=4,
+                        help='Slurm array tasks running at once (default: 4)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Slurm: write the array script but do not submit it')
+
+
+def slurm_options(args):
+    return {'partition': args.partition, 'time': args.time, 'mem': args.mem,
+            'cpus': args.cpus_per_task, 'max_parallel': args.max_parallel}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chunked blastp runner with resume (local or Slurm)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Split the query and run or submit all unfinished chunks')
+    run.add_argument('query', help='Query protein FASTA')
+    run.add_argument('--db', required=True, help='BLAST database prefix')
+    run.add_argument('--name', required=True, help='Run name, used for outputs results_<name>_<i>.out')
+    run.add_argument('--work-dir', help='Directory for chunks and run.json (default: temp/<name>)')
+    run.add_argument('--merged', help='Concatenate the chunk outputs into this file once all are done')
+    add_run_arguments(run)
+
+    chunk = subparsers.add_parser('chunk', help='Run one chunk of a prepared run')
+    chunk.add_argument('config', help='run.json of the run')
+    chunk.add_argument('index', type=int, help='Chunk index')
+    chunk.add_argument('--threads', type=int, default=1, help='blastp -num_threads (default: 1)')
+
+    merge = subparsers.add_parser('merge', help='Check and concatenate the chunk outputs of a finished run')
+    merge.add_argument('config', help='run.json of the run')
+    merge.add_argument('--merged', required=True, help='Concatenated output file')
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'run':
+            config_file = prepare_run(args.query, args.db, args.name, args.chunks, args.work_dir,
+                                      args.results_dir, args.evalue, args.outfmt,
+                                      shlex.split(args.blast_args), args.blastp, args.collapse_queries)
+            config = load_config(config_file)
+            if args.backend == 'slurm':
+                submit_slurm(config, args.merged, args.dry_run, **slurm_options(args))
+                return
+            failed = run_local(config, args.workers, args.threads)
+            if failed:
+                print("{} chunks failed ({}); re-run the same command to retry them".format(
+                    len(failed), ', '.join(str(i) for i in failed)), file=sys.stderr)
+                sys.exit(1)
+            if args.merged:
+                merge_outputs(config, args.merged)
+        elif args.command == 'chunk':
+            run_chunk(load_config(args.config), args.index, args.threads)
+        else:
+            merge_outputs(load_config(args.config), args.merged)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""Locate k-mers shared by two genomes without counting, dumping and re-mapping them
+
+The KMC route (count, intersect, dump, wrap as FASTA, bwa index both genomes,
+bwa mem, sort/index the BAMs) only serves to learn where the shared k-mers
+sit. Here each genome is read once and its canonical k-mers are 2-bit
+encoded (k <= 32) into uint64 values with their positions. They are spilled
+to on-disk bucket files by a hash of the k-mer, so memory is bounded by one
+bucket. Each bucket pair is then sorted, counted and merge-joined, and the
+positions of the shared k-mers are written as interval directories
+(kmer_intervals.py layout) that find_clusters.py reads in place of a BAM.
+
+Like `kmc -ci2`, a k-mer must occur at least --min-count times in each
+genome. Windows containing anything but A/C/G/T (either case) are skipped.
+Every occurrence of a shared k-mer is reported; bwa mem placed each k-mer
+once, at one of its copies, so repeats now show up at all their copies.
+
+Most shared k-mers are simple or high-copy repeats, which are not HGT and
+cannot be BLASTed. --max-dust drops k-mers whose DUST triplet score
+(low_complexity.py) is above the cutoff and --max-count those occurring more
+often than that in either genome, before anything reaches find_clusters.py.
+With --flag-only they are kept but marked in flags.npy instead, and
+find_clusters.py --drop-flagged leaves them out.
+
+Usage:
+    shared_kmers.py input_sequences/cleaned/Q_virginiana_genome.cleaned.fa \
+        input_sequences/cleaned/B_kinseyi_genome.cleaned.fna \
+        --output-a kmer_analysis/mapped/shared_kmers_qv.kmers \
+        --output-b kmer_analysis/mapped/shared_kmers_bk.kmers
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from compressed_io import open_file
+from kmer_intervals import FLAG_HIGH_COPY, FLAG_LOW_COMPLEXITY, write_intervals
+from low_complexity import CODES, kmer_dust_scores
+
+WINDOW = 8 * 1024 * 1024
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def iter_genome(fasta_file):
+    """Yield (name, sequence bytes) for each record of a genome FASTA"""
+    name = None
+    parts = []
+    with open_file(fasta_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(parts)
+                fields = line[1:].split(None, 1)
+                name = fields[0].decode() if fields else ''
+                parts = []
+            elif name is not None:
+                parts.append(line.strip())
+    if name is not None:
+        yield name, b''.join(parts)
+
+
+def pack_windows(bases, k):
+    """2-bit values of every length-k window of bases (uint64 codes 0-3), first base highest
+
+    Windows are built by doubling (1, 2, 4, 8, 16 bases) and the powers of
+    two that make up k are then joined, about 2 log2(k) array passes instead
+    of k.
+    """
+    powers = [(1, bases)]
+    while powers[-1][0] * 2 <= k:
+        length, values = powers[-1]
+        m = len(values) - length
+        powers.append((length * 2, (values[:m] << np.uint64(2 * length)) | values[length:length + m]))
+    packed = None
+    done = 0
+    for length, values in reversed(powers):
+        if done + length > k:
+            continue
+        if packed is None:
+            packed = values
+        else:
+            m = len(bases) - (done + length) + 1
+            packed = (packed[:m] << np.uint64(2 * length)) | values[done:done + m]
+        done += length
+    return packed[:len(bases) - k + 1]
+
+
+def canonical_kmers(sequence, k=31):
+    """Canonical 2-bit k-mer values and start positions of the ACGT-only windows of sequence"""
+    codes = CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = invalid[k:] - invalid[:-k] == 0
+    bases = (codes & 3).astype(np.uint64)
+    forward = pack_windows(bases, k)
+    # Windows of the reversed complement, reversed back, are the reverse complements
+    reverse = pack_windows(np.uint64(3) - bases[::-1], k)[::-1]
+    return np.minimum(forward, reverse)[valid], np.flatnonzero(valid)
+
+
+def bucket_of(kmers, n_buckets):
+    """Spread k-mers evenly over buckets; canonical values alone cluster near zero"""
+    buckets = ((kmers * HASH_MULTIPLIER) >> np.uint64(32)) % np.uint64(n_buckets)
+    # Small integer types get a radix sort from argsort(kind='stable')
+    return buckets.astype(np.uint16 if n_buckets <= 1 << 16 else np.uint32)
+
+
+def spill_kmers(fasta_file, bucket_dir, n_buckets, k=31):
+    """Write every canonical k-mer of fasta_file and its genome-wide position to bucket files
+
+    Positions are offsets into the concatenated records. Returns the record
+    names and lengths.
+    """
+    names = []
+    lengths = []
+    kmer_files = [open(os.path.join(bucket_dir, '{}.kmer'.format(i)), 'wb') for i in range(n_buckets)]
+    pos_files = [open(os.path.join(bucket_dir, '{}.pos'.format(i)), 'wb') for i in range(n_buckets)]
+    try:
+        offset = 0
+        for name, sequence in iter_genome(fasta_file):
+            names.append(name)
+            lengths.append(len(sequence))
+            # Overlapping windows bound the temporary arrays for long chromosomes
+            for start in range(0, max(1, len(sequence) - k + 1), WINDOW):
+                kmers, positions = canonical_kmers(sequence[start:start + WINDOW + k - 1], k)
+                positions += offset + start
+                buckets = bucket_of(kmers, n_buckets)
+                order = np.argsort(buckets, kind='stable')
+                bounds = np.searchsorted(buckets[order], np.arange(n_buckets + 1))
+                for i in range(n_buckets):
+                    if bounds[i] < bounds[i + 1]:
+                        selected = order[bounds[i]:bounds[i + 1]]
+                        kmers[selected].tofile(kmer_files[i])
+                        positions[selected].astype(np.uint64).tofile(pos_files[i])
+            offset += len(sequence)
+    finally:
+        for handle in kmer_files + pos_files:
+            handle.close()
+    return names, lengths
+
+
+def _repeated(kmers, min_count):
+    """Sorted distinct values occurring at least min_count times in sorted kmers, and their counts"""
+    if len(kmers) == 0:
+        return kmers, np.zeros(0, dtype=np.int64)
+    first = np.flatnonzero(np.concatenate(([True], kmers[1:] != kmers[:-1])))
+    counts = np.diff(np.append(first, len(kmers)))
+    keep = counts >= min_count
+    return kmers[first[keep]], counts[keep]
+
+
+def _shared_index(kmers, shared):
+    """Index into the sorted array shared of each k-mer, and whether it is there"""
+    if len(shared) == 0:
+        return np.zeros(len(kmers), dtype=np.int64), np.zeros(len(kmers), dtype=bool)
+    index = np.minimum(np.searchsorted(shared, kmers), len(shared) - 1)
+    return index, shared[index] == kmers
+
+
+def join_bucket(dir_a, dir_b, bucket, min_count=2, k=31, max_dust=None, max_count=None,
+                flag_only=False):
+    """Positions in genome A and genome B of the k-mers shared by one bucket pair
+
+    Returns ([(positions, flags) for A and B], counts) where counts has the
+    number of shared k-mers and of those that are low complexity or high
+    copy. Flagged k-mers are dropped unless flag_only; flags is None then.
+    """
+    sides = []
+    for bucket_dir in (dir_a, dir_b):
+        kmers = np.fromfile(os.path.join(bucket_dir, '{}.kmer'.format(bucket)), dtype=np.uint64)
+        positions = np.fromfile(os.path.join(bucket_dir, '{}.pos'.format(bucket)), dtype=np.uint64)
+        order = np.argsort(kmers)
+        sides.append((kmers[order], positions[order]))
+    # Merge join of the two sorted distinct-k-mer lists
+    kmers_a, counts_a = _repeated(sides[0][0], min_count)
+    kmers_b, counts_b = _repeated(sides[1][0], min_count)
+    shared, index_a, index_b = np.intersect1d(kmers_a, kmers_b, assume_unique=True, return_indices=True)
+
+    flags = np.zeros(len(shared), dtype=np.uint8)
+    if max_dust is not None:
+        flags[kmer_dust_scores(shared, k) > max_dust] |= FLAG_LOW_COMPLEXITY
+    if max_count is not None:
+        flags[np.maximum(counts_a[index_a], counts_b[index_b]) > max_count] |= FLAG_HIGH_COPY
+    counts = {
+        'shared': len(shared),
+        'low_complexity': int(np.count_nonzero(flags & FLAG_LOW_COMPLEXITY)),
+        'high_copy': int(np.count_nonzero(flags & FLAG_HIGH_COPY)),
+    }
+    if not flag_only:
+        shared = shared[flags == 0]
+
+    found = []
+    for kmers, positions in sides:
+        index, present = _shared_index(kmers, shared)
+        found.append((positions[present], flags[index[present]] if flag_only else None))
+    return found, counts
+
+
+def write_positions(positions, names, lengths, intervals_dir, k, meta, flags=None):
+    """Turn sorted genome-wide k-mer positions into a per-record interval directory"""
+    record_starts = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    offsets = np.searchsorted(positions, record_starts.astype(np.uint64))
+    starts = positions.astype(np.int64) - np.repeat(record_starts[:-1], np.diff(offsets))
+    return write_intervals(intervals_dir, starts, starts + k, offsets, names, lengths, meta, flags)
+
+
+def locate_shared_kmers(fasta_a, fasta_b, output_a, output_b, k=31, min_count=2, n_buckets=64,
+                        tmp_dir=None, max_dust=None, max_count=None, flag_only=False):
+    """Write the positions of the k-mers shared by two genomes as interval directories
+
+    Returns (counts of shared/low-complexity/high-copy k-mers, occurrences
+    written for A, occurrences written for B).
+    """
+    if not 1 <= k <= 32:
+        raise ValueError("k must be between 1 and 32 to fit a 2-bit k-mer in 64 bits")
+    work_dir = tempfile.mkdtemp(prefix='shared_kmers_', dir=tmp_dir)
+    try:
+        dirs = [os.path.join(work_dir, side) for side in ('a', 'b')]
+        genomes = []
+        for fasta_file, bucket_dir in zip((fasta_a, fasta_b), dirs):
+            os.makedirs(bucket_dir)
+            print("Encoding {}-mers of {}...".format(k, fasta_file))
+            genomes.append(spill_kmers(fasta_file, bucket_dir, n_buckets, k))
+
+        # Shared positions are small next to the k-mer sets; gather them on disk per genome
+        found = [open(os.path.join(bucket_dir, 'shared.pos'), 'wb') for bucket_dir in dirs]
+        found_flags = [open(os.path.join(bucket_dir, 'shared.flags'), 'wb') for bucket_dir in dirs]
+        totals = {'shared': 0, 'low_complexity': 0, 'high_copy': 0}
+        try:
+            for bucket in range(n_buckets):
+                sides, counts = join_bucket(dirs[0], dirs[1], bucket, min_count, k, max_dust, max_count,
+                                            flag_only)
+                for name in totals:
+                    totals[name] += counts[name]
+                for handle, flags_handle, (positions, flags) in zip(found, found_flags, sides):
+                    positions.tofile(handle)
+                    if flags is not None:
+                        flags.tofile(flags_handle)
+                for bucket_dir in dirs:
+                    os.remove(os.path.join(bucket_dir, '{}.kmer'.format(bucket)))
+                    os.remove(os.path.join(bucket_dir, '{}.pos'.format(bucket)))
+        finally:
+            for handle in found + found_flags:
+                handle.close()
+
+        occurrences = []
+        for bucket_dir, (names, lengths), output, fasta_file in zip(
+                dirs, genomes, (output_a, output_b), (fasta_a, fasta_b)):
+            positions = np.fromfile(os.path.join(bucket_dir, 'shared.pos'), dtype=np.uint64)
+            order = np.argsort(positions)
+            flags = None
+            if flag_only:
+                flags = np.fromfile(os.path.join(bucket_dir, 'shared.flags'), dtype=np.uint8)[order]
+            meta = {'source': 'shared_kmers', 'genome': os.path.abspath(fasta_file), 'k': k,
+                    'min_count': min_count, 'max_dust': max_dust, 'max_count': max_count,
+                    'flag_only': flag_only}
+            write_positions(positions[order], names, lengths, output, k, meta, flags)
+            occurrences.append(len(positions))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return totals, occurrences[0], occurrences[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the positions of k-mers shared by two genomes')
+    parser.add_argument('genome_a', help='First genome FASTA (e.g. Q. virginiana, cleaned)')
+    parser.add_argument('genome_b', help='Second genome FASTA (e.g. B. kinseyi, cleaned)')
+    parser.add_argument('--output-a', required=True, help='Interval directory for positions in genome A')
+    parser.add_argument('--output-b', required=True, help='Interval directory for positions in genome B')
+    parser.add_argument('-k', type=int, default=31, help='K-mer length, at most 32 (default: 31)')
+    parser.add_argument('--min-count', type=int, default=2,
+                        help='Occurrences needed in each genome, like kmc -ci (default: 2)')
+    parser.add_argument('--buckets', type=int, default=64,
+                        help='On-disk hash buckets; memory use is about one bucket (default: 64)')
+    parser.add_argument('--tmp-dir', help='Directory for bucket files (default: system temp)')
+    parser.add_argument('--max-dust', type=float,
+                        help='Drop k-mers with a higher DUST triplet score, e.g. 2 '
+                             '(31-mer dinucleotide repeats score 7; default: keep all)')
+    parser.add_argument('--max-count', type=int,
+                        help='Drop k-mers occurring more often than this in either genome (default: keep all)')
+    parser.add_argument('--flag-only', action='store_true',
+                        help='Keep low-complexity/high-copy k-mers, marked in flags.npy, instead of dropping them')
+    args = parser.parse_args()
+
+    try:
+        totals, n_a, n_b = locate_shared_kmers(args.genome_a, args.genome_b, args.output_a,
+                                               args.output_b, args.k, args.min_count, args.buckets,
+                                               args.tmp_dir, args.max_dust, args.max_count, args.flag_only)
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    print("{} shared {}-mers ({} low complexity, {} high copy, {})".format(
+        totals['shared'], args.k, totals['low_complexity'], totals['high_copy'],
+        'flagged' if args.flag_only else 'dropped'))
+    print("{} positions in {}, {} in {}".format(n_a, args.output_a, n_b, args.output_b))
+
+
+if __name__ == "__main__":
+    main()
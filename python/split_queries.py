@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Split a query FASTA into chunks with balanced residue totals for BLAST array jobs
+
+blastp run time grows with the total query length, so chunks of a fixed
+number of sequences can differ several-fold in run time. The input is read
+once; each sequence goes to the chunk with the fewest residues so far, which
+keeps every chunk within one sequence length of the mean. A manifest records
+each chunk's sequence IDs, residue total and SHA-256 so array tasks and the
+merge step can check they are working on the chunks that were written.
+
+Usage:
+    split_queries.py split input_sequences/Q_virginiana_protein_prefixed.faa \
+        --chunks 10 --output-dir temp/oak_query_chunks
+    split_queries.py verify temp/oak_query_chunks/manifest.json --chunk 3
+    split_queries.py verify temp/oak_query_chunks/manifest.json \
+        --results 'blast_results/results_oak_bact_{}.out'
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import sys
+
+from compressed_io import open_file
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def split_queries(fasta_file, n_chunks, output_dir, prefix='chunk_'):
+    """Stream fasta_file into n_chunks residue-balanced chunk files and write the manifest
+
+    Sequences keep their input order within each chunk. Returns the manifest.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    chunks = [{
+        'file': '{}{}.faa'.format(prefix, i),
+        'n_sequences': 0,
+        'residues': 0,
+        'ids': [],
+    } for i in range(n_chunks)]
+    handles = [open(os.path.join(output_dir, chunk['file']), 'wb') for chunk in chunks]
+    hashes = [hashlib.sha256() for _ in chunks]
+    # (residues, index) of every chunk; ties go to the lowest index
+    loads = [(0, i) for i in range(n_chunks)]
+    seen_ids = set()
+
+    current = None
+    residues = 0
+    try:
+        with open_file(fasta_file, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    if current is not None:
+                        chunks[current]['residues'] += residues
+                        heapq.heappush(loads, (chunks[current]['residues'], current))
+                    fields = line[1:].split(None, 1)
+                    seq_id = fields[0].decode() if fields else ''
+                    if seq_id in seen_ids:
+                        raise ValueError("Duplicate sequence ID {} in {}".format(seq_id, fasta_file))
+                    seen_ids.add(seq_id)
+                    _, current = heapq.heappop(loads)
+                    chunks[current]['n_sequences'] += 1
+                    chunks[current]['ids'].append(seq_id)
+                    residues = 0
+                elif current is None:
+                    if line.strip():
+                        raise ValueError("{} does not start with a FASTA header".format(fasta_file))
+                    continue
+                else:
+                    residues += len(line.strip())
+                handles[current].write(line)
+                hashes[current].update(line)
+            if current is not None:
+                chunks[current]['residues'] += residues
+    finally:
+        for handle in handles:
+            handle.close()
+
+    for chunk, sha256 in zip(chunks, hashes):
+        chunk['sha256'] = sha256.hexdigest()
+    manifest = {
+        'input': str(fasta_file),
+        'n_chunks': n_chunks,
+        'n_sequences': len(seen_ids),
+        'residues': sum(chunk['residues'] for chunk in chunks),
+        'chunks': chunks,
+    }
+    manifest_file = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_file = '{}.tmp{}'.format(manifest_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+    return manifest
+
+
+def load_manifest(manifest_file):
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def verify_chunk(manifest_file, index):
+    """Raise ValueError unless chunk index exists and matches its manifest checksum"""
+    manifest = load_manifest(manifest_file)
+    if not 0 <= index < manifest['n_chunks']:
+        raise ValueError("{} has no chunk {} ({} chunks)".format(manifest_file, index, manifest['n_chunks']))
+    chunk = manifest['chunks'][index]
+    path = os.path.join(os.path.dirname(manifest_file), chunk['file'])
+    if file_sha256(path) != chunk['sha256']:
+        raise ValueError("{} does not match {}; re-run the split".format(path, manifest_file))
+    return chunk
+
+
+def verify_results(manifest_file, results_template):
+    """Check per-chunk BLAST outputs against the manifest
+
+    results_template is formatted with the chunk index. Returns a list of
+    problems: missing outputs and queries that do not belong to the chunk.
+    """
+    manifest = load_manifest(manifest_file)
+    problems = []
+    for i, chunk in enumerate(manifest['chunks']):
+        results_file = results_template.format(i)
+        if not os.path.exists(results_file):
+            problems.append("{}: missing".format(results_file))
+            continue
+        chunk_ids = set(chunk['ids'])
+        foreign = set()
+        with open_file(results_file, 'r') as f:
+            for line in f:
+                query_id = line.split('\t', 1)[0]
+                if query_id.strip() and query_id not in chunk_ids:
+                    foreign.add(query_id)
+        if foreign:
+            problems.append("{}: {} queries not in {} (e.g. {})".format(
+                results_file, len(foreign), chunk['file'], sorted(foreign)[0]))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split query FASTA into residue-balanced BLAST chunks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    split = subparsers.add_parser('split', help='Split a FASTA file and write manifest.json')
+    split.add_argument('fasta', help='Query FASTA (plain, gzip/bgzip or zstd)')
+    split.add_argument('--chunks', type=int, required=True, help='Number of chunks (size of the Slurm array)')
+    split.add_argument('--output-dir', required=True, help='Directory for chunk_<i>.faa and manifest.json')
+    split.add_argument('--prefix', default='chunk_', help='Chunk file name prefix (default: chunk_)')
+
+    verify = subparsers.add_parser('verify', help='Check chunks or their BLAST outputs against a manifest')
+    verify.add_argument('manifest', help='manifest.json written by split')
+    verify.add_argument('--chunk', type=int, help='Check this chunk file against its checksum')
+    verify.add_argument('--results',
+                        help="Per-chunk BLAST output names with {} for the chunk index, "
+                             "e.g. 'blast_results/results_oak_bact_{}.out'")
+
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        if args.chunks < 1:
+            parser.error('--chunks must be at least 1')
+        manifest = split_queries(args.fasta, args.chunks, args.output_dir, args.prefix)
+        mean = manifest['residues'] / args.chunks
+        for chunk in manifest['chunks']:
+            print("{}\t{} sequences\t{} residues".format(chunk['file'], chunk['n_sequences'], chunk['residues']))
+        print("Split {} sequences ({} residues) into {} chunks; largest is {:.1%} of the mean".format(
+            manifest['n_sequences'], manifest['residues'], args.chunks,
+            max(chunk['residues'] for chunk in manifest['chunks']) / mean if mean else 1))
+        return
+
+    if args.chunk is None and args.results is None:
+        parser.error('verify needs --chunk and/or --results')
+    try:
+        if args.chunk is not None:
+            chunk = verify_chunk(args.manifest, args.chunk)
+            print("{} OK ({} sequences)".format(chunk['file'], chunk['n_sequences']))
+        if args.results is not None:
+            problems = verify_results(args.manifest, args.results)
+            for problem in problems:
+                print(problem, file=sys.stderr)
+            if problems:
+                sys.exit(1)
+            print("All BLAST outputs match {}".format(args.manifest))
+    except (OSError, ValueError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
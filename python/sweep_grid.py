@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Parse NAME=V1,V2,... sweep settings into a grid of parameter values
+
+Shared by the filter scripts' threshold sweeps (hgt_sweep.py) and the
+clustering parameter sweeps of find_clusters.py (kmer_intervals.py).
+"""
+
+TYPE_NAMES = {int: 'integers', float: 'numbers'}
+
+
+def parse_grid(specs, defaults, types, aliases=None):
+    """Turn ['max_gap=25,50,100', ...] into {name: [values]}
+
+    Args:
+        specs: NAME=V1,V2,... strings; '-' in names is read as '_'
+        defaults: Value of every parameter not named in specs
+        types: Ordered {name: type} of the accepted parameters; values are
+            converted with the type (e.g. int or float)
+        aliases: Optional {alias: name} of other accepted names
+
+    Raises ValueError with a message naming the bad setting.
+    """
+    aliases = aliases or {}
+    grid = {name: [defaults[name]] for name in types}
+    for spec in specs:
+        name, sep, values = spec.partition('=')
+        name = name.strip().replace('-', '_')
+        name = aliases.get(name, name)
+        if not sep or name not in grid:
+            expected = list(types)
+            for alias, target in aliases.items():
+                expected[expected.index(target)] += ' ({})'.format(alias)
+            raise ValueError("Invalid sweep setting '{}'; expected one of {} as NAME=V1,V2,...".format(
+                spec, ', '.join(expected)))
+        convert = types[name]
+        try:
+            grid[name] = [convert(v) for v in values.split(',') if v.strip()]
+        except ValueError:
+            raise ValueError("Invalid value in sweep setting '{}'; expected {}".format(
+                spec, TYPE_NAMES.get(convert, convert.__name__ + ' values')))
+        if not grid[name]:
+            raise ValueError("No values given for sweep setting '{}'".format(name))
+    return grid
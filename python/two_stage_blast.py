@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Lineage-first two-stage BLAST: only search the donor DB for queries that can still pass
+
+The filter scripts only report a query whose best own-lineage hit is at
+most max_native (max_plant/max_insect, 50% by default) identical. Stage 1
+BLASTs every query against the small lineage-only database (e.g. Populus +
+Arabidopsis). Queries with no lineage hit, or a best lineage hit above the
+cap, can never become candidates, so only the rest are sent to the large
+donor database in stage 2. The two outputs are then merged per query
+(lineage rows, then donor rows) into one table in the format the filters read.
+
+Both stages are run with -dbsize set to the residues of the lineage and
+donor databases together, so E-values and the -evalue cutoff are those of a
+search against the combined database. The merged table still differs from
+a combined search in two ways: -max_target_seqs applies to each stage
+separately, so a query can keep lineage hits that the donor hits would
+have pushed out of a combined search, and queries filtered out in stage 1
+have no donor hits at all. The cap is recorded in <merged>.two_stage.json
+so threshold sweeps warn about max_native values above it.
+
+Each stage is a run_blast.py run, so chunks resume after a failure. With
+--backend slurm every invocation submits the next stage that is due plus a
+follow-up job that re-runs this command once it succeeds.
+
+Usage:
+    two_stage_blast.py input_sequences/Q_virginiana_protein_prefixed.faa \
+        --lineage-db blast_dbs/plant_db --donor-db blast_dbs/bacterial_db \
+        --name oak_bact --merged blast_results/Q_virginiana_vs_bacterial.out [--max-native 50] \
+        [--dbsize 123456789]
+"""
+
+import argparse
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+
+from blast_hits import query_blocks
+from compressed_io import open_file
+from run_blast import (add_run_arguments, load_config, merge_outputs, pending_chunks, prepare_run,
+                       run_local, slurm_options, submit_after, submit_slurm)
+
+
+TWO_STAGE_SUFFIX = '.two_stage.json'
+DB_INFO = re.compile(r'([\d,]+) sequences; ([\d,]+) total (?:residues|bases)')
+
+
+def database_residues(db, blastdbcmd='blastdbcmd'):
+    """Total residues of a BLAST database, from blastdbcmd -info"""
+    try:
+        info = subprocess.run([blastdbcmd, '-db', db, '-info'], check=True,
+                              capture_output=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise ValueError("Could not read the size of {} ({}); pass --dbsize".format(db, e))
+    match = DB_INFO.search(info)
+    if match is None:
+        raise ValueError("No residue count in blastdbcmd -info output for {}; pass --dbsize".format(db))
+    return int(match.group(2).replace(',', ''))
+
+
+def native_cap(blast_files):
+    """Lowest --max-native of the two-stage runs that wrote blast_files, or None"""
+    caps = []
+    for blast_file in blast_files:
+        try:
+            with open(blast_file + TWO_STAGE_SUFFIX, 'r') as f:
+                caps.append(json.load(f)['max_native'])
+        except (OSError, ValueError, KeyError):
+            continue
+    return min(caps) if caps else None
+
+
+def stage_blast_args(args):
+    """--blast-args plus -dbsize of the combined lineage and donor databases"""
+    blast_args = shlex.split(args.blast_args)
+    if '-dbsize' in blast_args:
+        return blast_args
+    dbsize = args.dbsize
+    if dbsize is None:
+        dbsize = (database_residues(args.lineage_db, args.blastdbcmd) +
+                  database_residues(args.donor_db, args.blastdbcmd))
+    return blast_args + ['-dbsize', str(dbsize)]
+
+
+def best_identities(blast_file, min_fields=3):
+    """Best percent identity per query in a BLAST tabular file"""
+    best = {}
+    with open_file(blast_file, 'r') as f:
+        for line in f:
+            fields = line.split('\t', 3)
+            if len(fields) < min_fields:
+                continue
+            identity = float(fields[2])
+            if identity > best.get(fields[0], -1.0):
+                best[fields[0]] = identity
+    return best
+
+
+def write_survivors(fasta_file, survivors, output_file):
+    """Write the records of fasta_file whose ID is in survivors, in input order
+
+    The file is only replaced if its content changes, so an unchanged
+    survivor set keeps the stage 2 split (and its finished chunks) valid.
+    """
+    records = []
+    keep = False
+    with open_file(fasta_file, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                fields = line[1:].split(None, 1)
+                keep = bool(fields) and fields[0] in survivors
+            if keep:
+                records.append(line)
+    content = ''.join(records)
+    if os.path.exists(output_file):
+        with open(output_file, 'r') as f:
+            if f.read() == content:
+                return
+    tmp_file = '{}.tmp{}'.format(output_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.write(content)
+    os.replace(tmp_file, output_file)
+
+
+def merge_stages(lineage_file, donor_file, merged_file):
+    """Interleave donor rows after each query's lineage rows, keeping queries grouped
+
+    Only the donor file's per-query offsets are held in memory; rows are
+    copied with seeks.
+    """
+    donor_blocks = query_blocks(donor_file)
+    tmp_file = '{}.tmp{}'.format(merged_file, os.getpid())
+    with open(lineage_file, 'rb') as lineage, open(donor_file, 'rb') as donor, open(tmp_file, 'wb') as out:
+        def flush(query_id):
+            block = donor_blocks.pop(query_id, None)
+            if block is not None:
+                donor.seek(block[0])
+                out.write(donor.read(block[1]))
+
+        current = None
+        for line in lineage:
+            query_id = line.split(b'\t', 1)[0]
+            if query_id != current:
+                flush(current)
+                current = query_id
+            out.write(line)
+        flush(current)
+        # Donor-only queries cannot happen with a lineage-first split, but never drop hits
+        for start, length in sorted(donor_blocks.values()):
+            donor.seek(start)
+            out.write(donor.read(length))
+    os.replace(tmp_file, merged_file)
+
+
+def _stage(args, query, db, name, blast_args):
+    config_file = prepare_run(query, db, name, args.chunks, None, args.results_dir, args.evalue,
+                              args.outfmt, blast_args, args.blastp, args.collapse_queries)
+    return load_config(config_file)
+
+
+def _run_stage(args, config):
+    """Run a stage to completion (local) or submit it (Slurm); True if its outputs are complete"""
+    if not pending_chunks(config):
+        return True
+    if args.backend == 'local':
+        failed = run_local(config, args.workers, args.threads)
+        if failed:
+            raise ValueError("{} chunks of {} failed ({}); re-run the same command to retry them".format(
+                len(failed), config['name'], ', '.join(str(i) for i in failed)))
+        return True
+    job_id = submit_slurm(config, dry_run=args.dry_run, **slurm_options(args))
+    if job_id is not None:
+        command = ' '.join(shlex.quote(arg) for arg in [sys.executable, os.path.abspath(__file__)] + sys.argv[1:])
+        submit_after(job_id, 'next_{}'.format(args.name), command, args.partition)
+    return False
+
+
+def run_two_stage(args):
+    results_dir = os.path.abspath(args.results_dir)
+    blast_args = stage_blast_args(args)
+    lineage = _stage(args, args.query, args.lineage_db, args.name + '_lineage', blast_args)
+    if not _run_stage(args, lineage):
+        return
+    lineage_file = os.path.join(results_dir, '{}_lineage.out'.format(args.name))
+    merge_outputs(lineage, lineage_file)
+
+    best = best_identities(lineage_file)
+    survivors = {query_id for query_id, identity in best.items() if identity <= args.max_native}
+    print("{} queries have a lineage hit; {} are at or below {}% and go on to the donor search".format(
+        len(best), len(survivors), args.max_native))
+    survivor_fasta = os.path.join(lineage['work_dir'], 'survivors.faa')
+    write_survivors(args.query, survivors, survivor_fasta)
+
+    donor = _stage(args, survivor_fasta, args.donor_db, args.name + '_donor', blast_args)
+    if not _run_stage(args, donor):
+        return
+    donor_file = os.path.join(results_dir, '{}_donor.out'.format(args.name))
+    merge_outputs(donor, donor_file)
+
+    merge_stages(lineage_file, donor_file, args.merged)
+    with open(args.merged + TWO_STAGE_SUFFIX, 'w') as f:
+        json.dump({'max_native': args.max_native,
+                   'dbsize': int(blast_args[blast_args.index('-dbsize') + 1])}, f, indent=1)
+    print("Merged lineage and donor hits into {}".format(args.merged))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lineage-first two-stage BLAST for HGT screening')
+    parser.add_argument('query', help='Query protein FASTA')
+    parser.add_argument('--lineage-db', required=True,
+                        help='BLAST DB of the query lineage only (e.g. Populus + Arabidopsis)')
+    parser.add_argument('--donor-db', required=True, help='BLAST DB of the donor proteins (bacterial/fungal)')
+    parser.add_argument('--name', required=True, help='Run name; stages are <name>_lineage and <name>_donor')
+    parser.add_argument('--merged', required=True, help='Merged BLAST table for the filter scripts')
+    parser.add_argument('--max-native', type=float, default=50,
+                        help='Native identity cap used by the filters (max_plant/max_insect, default: 50)')
+    parser.add_argument('--dbsize', type=int,
+                        help='blastp -dbsize for both stages (default: residues of the lineage and donor '
+                             'databases together, from blastdbcmd -info)')
+    parser.add_argument('--blastdbcmd', default='blastdbcmd', help='blastdbcmd executable')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        run_two_stage(args)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
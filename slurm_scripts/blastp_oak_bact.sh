@@ -30,23 +30,28 @@ if [ $SLURM_ARRAY_TASK_ID -eq 0 ]; then
     makeblastdb -in oak_plant_reference.faa -dbtype prot -out blast_dbs/oak_bact_db
 
     # Split query file
-    if [ ! -f temp/oak_query_chunks/chunk_0.faa ]; then
+    if [ ! -f temp/oak_query_chunks/manifest.json ]; then
         echo "Splitting query file at $(date)"
-        awk 'BEGIN {n=0;c=0} /^>/ {n++; if(n%1000==1){c++; file="temp/oak_query_chunks/chunk_" int((n-1)/1000) ".faa"}} {print > file}' input_sequences/Q_virginiana_protein_prefixed.faa
+        # Residue-balanced chunks, one per array task, plus manifest.json with IDs and checksums
+        python scripts/split_queries.py split input_sequences/Q_virginiana_protein_prefixed.faa --chunks 10 --output-dir temp/oak_query_chunks
     fi
 fi
 
 # Process chunk
 chunk="temp/oak_query_chunks/chunk_${SLURM_ARRAY_TASK_ID}.faa"
 if [ -f "$chunk" ]; then
+    python scripts/split_queries.py verify temp/oak_query_chunks/manifest.json --chunk ${SLURM_ARRAY_TASK_ID} || exit 1
     echo "Starting BLAST for chunk ${SLURM_ARRAY_TASK_ID} at $(date)"
     
+    # The .done marker tells the filter scripts' --watch mode the chunk is complete
+    rm -f blast_results/results_oak_bact_${SLURM_ARRAY_TASK_ID}.out.done
     blastp -query $chunk \
            -db blast_dbs/oak_bact_db \
            -out blast_results/results_oak_bact_${SLURM_ARRAY_TASK_ID}.out \
            -outfmt 6 \
            -evalue 1e-5 \
-           -num_threads $SLURM_CPUS_PER_TASK
+           -num_threads $SLURM_CPUS_PER_TASK || exit 1
+    touch blast_results/results_oak_bact_${SLURM_ARRAY_TASK_ID}.out.done
     
     echo "BLAST complete for chunk ${SLURM_ARRAY_TASK_ID} at $(date)"
 else
@@ -59,6 +64,7 @@ if [ $SLURM_ARRAY_TASK_ID -eq 0 ]; then
     echo "Submitting cleanup job"
     echo '#!/bin/bash
     cd /export/martinsons/adam
+    python scripts/split_queries.py verify temp/oak_query_chunks/manifest.json --results "blast_results/results_oak_bact_{}.out" || exit 1
     cat blast_results/results_oak_bact_*.out > blast_results/Q_virginiana_vs_bacterial.out
     rm -r temp/oak_query_chunks
     rm oak_plant_reference.faa
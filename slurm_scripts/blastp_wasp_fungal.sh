@@ -25,9 +25,10 @@ mkdir -p logs
 
 # Split query file if not already done and if this is the first array task
 if [ $SLURM_ARRAY_TASK_ID -eq 0 ]; then
-    if [ ! -f temp/wasp_query_chunks/chunk_0.faa ]; then
+    if [ ! -f temp/wasp_query_chunks/manifest.json ]; then
         echo "Splitting query file at $(date)"
-        awk 'BEGIN {n=0;c=0} /^>/ {n++; if(n%1000==1){c++; file="temp/wasp_query_chunks/chunk_" int((n-1)/1000) ".fa$
+        # Residue-balanced chunks, one per array task, plus manifest.json with IDs and checksums
+        python scripts/split_queries.py split input_sequences/B_kinseyi_protein_prefixed.faa --chunks 10 --output-dir temp/wasp_query_chunks
     fi
 fi
 
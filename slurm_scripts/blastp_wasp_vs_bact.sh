@@ -23,12 +23,15 @@ if [ -f "$chunk" ]; then
     echo "Starting BLAST for chunk ${SLURM_ARRAY_TASK_ID} at $(date)"
     echo "Chunk file size: $(ls -lh $chunk)"
 
+    # The .done marker tells the filter scripts' --watch mode the chunk is complete
+    rm -f blast_results/results_wasp_bact_${SLURM_ARRAY_TASK_ID}.out.done
     blastp -query $chunk \
            -db blast_dbs/bacterial_db \
            -out blast_results/results_wasp_bact_${SLURM_ARRAY_TASK_ID}.out \
            -outfmt 6 \
            -evalue 1e-5 \
-           -num_threads $SLURM_CPUS_PER_TASK
+           -num_threads $SLURM_CPUS_PER_TASK || exit 1
+    touch blast_results/results_wasp_bact_${SLURM_ARRAY_TASK_ID}.out.done
 
     echo "BLAST complete for chunk ${SLURM_ARRAY_TASK_ID} at $(date)"
 else
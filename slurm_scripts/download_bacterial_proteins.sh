@@ -20,3 +20,8 @@ gunzip bacteria..protein.faa.gz
 cat bacteria..protein.faa > bacterial_proteins.faa
 # Optionally, remove individual files to save space
 rm bacteria..protein.faa
+# Collapse identical proteins (the same sequence across strains) before makeblastdb;
+# the members table lets the filter scripts list every accession behind a best hit
+python scripts/dedup_sequences.py collapse bacterial_proteins.faa \
+    --output bacterial_proteins.dedup.faa --members bacterial_proteins.members.tsv.gz
+mv bacterial_proteins.dedup.faa bacterial_proteins.faa
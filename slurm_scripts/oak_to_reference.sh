@@ -21,15 +21,17 @@ mkdir -p blast_results
 
 # Split query file if not already done
 if [ $SLURM_ARRAY_TASK_ID -eq 0 ]; then
-   if [ ! -f temp/oak_query_chunks/chunk_0.faa ]; then
+   if [ ! -f temp/oak_query_chunks/manifest.json ]; then
        echo "Splitting query file at $(date)"
-       awk 'BEGIN {n=0;c=0} /^>/ {n++; if(n%1000==1){c++; file="temp/oak_query_chunks/chunk_" int((n-1)/1000) ".faa"}} {print > file}' input_sequences/Q_virginiana_protein_prefixed.faa
+       # Residue-balanced chunks, one per array task, plus manifest.json with IDs and checksums
+       python scripts/split_queries.py split input_sequences/Q_virginiana_protein_prefixed.faa --chunks 10 --output-dir temp/oak_query_chunks
    fi
 fi
 
 # Process chunk
 chunk="temp/oak_query_chunks/chunk_${SLURM_ARRAY_TASK_ID}.faa"
 if [ -f "$chunk" ]; then
+   python scripts/split_queries.py verify temp/oak_query_chunks/manifest.json --chunk ${SLURM_ARRAY_TASK_ID} || exit 1
    echo "Starting BLAST for chunk ${SLURM_ARRAY_TASK_ID} at $(date)"
    
    blastp -query $chunk \
@@ -50,6 +52,7 @@ if [ $SLURM_ARRAY_TASK_ID -eq 0 ]; then
    echo "Submitting cleanup job"
    echo '#!/bin/bash
    cd /export/martinsons/adam
+   python scripts/split_queries.py verify temp/oak_query_chunks/manifest.json --results "blast_results/results_oak_ref_{}.out" || exit 1
    cat blast_results/results_oak_ref_*.out > blast_results/Q_virginiana_vs_wasp_plant.out
    rm -r temp/oak_query_chunks' > cleanup_oak_ref.sh
    
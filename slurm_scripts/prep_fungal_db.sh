@@ -35,6 +35,12 @@ cat fungi.*.protein.faa > combined_fungal.faa
 
 echo "Files combined at $(date)"
 
+# Collapse identical proteins before the plant references are added, so a
+# sequence shared with a plant is never merged into a fungal representative
+python ../scripts/dedup_sequences.py collapse combined_fungal.faa \
+    --output combined_fungal.dedup.faa --members ../combined_fungal.members.tsv.gz
+mv combined_fungal.dedup.faa combined_fungal.faa
+
 # Add plant references
 cat combined_fungal.faa \
     ../input_sequences/GCF_000001735.4_TAIR10.1_protein.faa \
@@ -0,0 +1,119 @@
+"""The stream and columnar filter engines agree on grouped, ungrouped and split BLAST output"""
+
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import filter_oak_bact_hgt as oak
+
+PYTHON_DIR = os.path.dirname(oak.__file__)
+
+
+def blast_rows(seed=1, n_queries=60):
+    rng = random.Random(seed)
+    rows = []
+    for q in range(n_queries):
+        for _ in range(rng.randint(1, 6)):
+            if rng.random() < 0.5:
+                subject = 'At_|p{}'.format(rng.randint(0, 3))
+                identity = rng.choice([30, 40, 45, 50, 60])
+            else:
+                subject = 'WP_{}.1'.format(rng.randint(0, 3))
+                identity = rng.choice([75, 80, 85, 90, 95])
+            rows.append('Q{}\t{}\t{:.3f}\t'.format(q, subject, identity) + '\t'.join(['1'] * 9))
+    return rows
+
+
+def write_files(tmp_path, rows, n_files):
+    paths = []
+    size = -(-len(rows) // n_files)
+    for i in range(n_files):
+        path = tmp_path / 'results_{}.out'.format(i)
+        path.write_text(''.join(row + '\n' for row in rows[i * size:(i + 1) * size]))
+        paths.append(str(path))
+    return paths
+
+
+def reference_candidates(rows):
+    """The original parser: every hit in a dict of lists, then max() per category"""
+    hits = {}
+    for row in rows:
+        fields = row.split('\t')
+        category = oak.categorize_subject(fields[1])
+        hits.setdefault(fields[0], {}).setdefault(category, []).append(
+            {'subject': fields[1], 'identity': float(fields[2])})
+    candidates = []
+    for query_id, categories in hits.items():
+        if 'bacterial' not in categories or 'plant' not in categories:
+            continue
+        bacterial = max(categories['bacterial'], key=lambda x: x['identity'])
+        plant = max(categories['plant'], key=lambda x: x['identity'])
+        difference = bacterial['identity'] - plant['identity']
+        if difference >= 20 and 75 <= bacterial['identity'] <= 90 and plant['identity'] <= 50:
+            candidates.append((query_id, bacterial['subject'], plant['subject'], difference))
+    return candidates
+
+
+def summarize(candidates):
+    return [(c['query'], c['bacterial_hit'], c['plant_hit'], c['difference']) for c in candidates]
+
+
+@pytest.mark.parametrize('layout', ['grouped', 'ungrouped', 'split'])
+def test_engines_match_reference(tmp_path, layout):
+    rows = blast_rows()
+    if layout != 'grouped':
+        random.Random(2).shuffle(rows)
+    blast_files = write_files(tmp_path, rows, 3 if layout == 'split' else 1)
+
+    expected = reference_candidates(rows)
+    assert expected
+    stream = oak.find_hgt_candidates(oak.parse_blast_results(blast_files, workers=2))
+    columnar = oak.find_hgt_candidates_columnar(blast_files, cache=False, workers=2)
+    assert summarize(stream) == expected
+    assert summarize(columnar) == expected
+
+
+def test_columnar_cache_matches(tmp_path):
+    rows = blast_rows(seed=3)
+    random.Random(4).shuffle(rows)
+    blast_files = write_files(tmp_path, rows, 2)
+
+    first = oak.find_hgt_candidates_columnar(blast_files, workers=2)
+    cached = oak.find_hgt_candidates_columnar(blast_files, workers=2)
+    assert summarize(first) == summarize(cached) == reference_candidates(rows)
+
+
+FILTER_SCRIPTS = ['filter_oak_bact_hgt.py', 'filter_fungal_hgt.py', 'filter_wasp_hgt.py',
+                  'filter_wasp_fungal_hgt.py', 'filter_bkins_vs_oak.py', 'filter_qvirg_v_bkins.py']
+SUBJECT_PREFIXES = ['At_|p', 'Pt_|p', 'Am_|i', 'Nv_|i', 'Oak_x', 'Bk_x', 'Dq_x', 'WP_']
+
+
+def mixed_rows(seed=7, n_queries=300):
+    """Shuffled rows with subjects of every script's categories and many tied identities"""
+    rng = random.Random(seed)
+    rows = []
+    for q in range(n_queries):
+        for _ in range(rng.randint(1, 8)):
+            subject = rng.choice(SUBJECT_PREFIXES) + str(rng.randint(0, 5))
+            identity = rng.choice([30, 40, 45, 50, 70, 75, 80, 85, 90, 95])
+            rows.append('Q{}\t{}\t{:.3f}\t'.format(q, subject, identity) + '\t'.join(['1'] * 9))
+    rng.shuffle(rows)
+    return rows
+
+
+@pytest.mark.parametrize('script', FILTER_SCRIPTS)
+def test_filter_scripts_engines_agree(tmp_path, script):
+    blast_files = write_files(tmp_path, mixed_rows(), 3)
+    outputs = {}
+    for engine in ('stream', 'columnar'):
+        result = subprocess.run(
+            [sys.executable, os.path.join(PYTHON_DIR, script)] + blast_files +
+            ['--engine', engine, '--workers', '2', '--no-cache'],
+            check=True, capture_output=True, text=True)
+        # The first line names the engine's loading step
+        outputs[engine] = result.stdout.splitlines()[1:]
+    assert outputs['stream'] == outputs['columnar']
+    assert any('\t' in line for line in outputs['stream'])
@@ -0,0 +1,57 @@
+"""check_fasta_format's byte engine reports what the line-by-line engine reports"""
+
+import gzip
+import random
+
+import pytest
+
+from check_fasta_format import check_fasta
+
+
+def random_fasta(seed, crlf=False, non_ascii=False):
+    """FASTA with junk before the first header, blank lines, ragged lines, mixed case and odd characters"""
+    rng = random.Random(seed)
+    lines = ['ACGTX']
+    for i in range(rng.randint(5, 20)):
+        tag = rng.choice('ab#' + ('é' if non_ascii else ''))
+        lines.append('>seq{} some desc|x=1,y:{}'.format(i, tag))
+        for _ in range(rng.randint(0, 6)):
+            length = rng.choice([0, 5, 60, 60, 60, rng.randint(1, 80)])
+            lines.append(''.join(rng.choice('ACGTacgtNnRYKM-* \t') for _ in range(length)))
+    text = ('\r\n' if crlf else '\n').join(lines)
+    if rng.random() < 0.5:
+        text += '\n'
+    return text.encode()
+
+
+def run_engine(capsys, path, engine, workers=1):
+    stats = check_fasta(str(path), workers, engine)
+    output = capsys.readouterr().out
+    stats = dict(stats)
+    stats['unusual_chars'] = list(stats['unusual_chars'].items())
+    return stats, output
+
+
+@pytest.mark.parametrize('seed', range(8))
+@pytest.mark.parametrize('workers', [1, 4])
+def test_bytes_engine_matches_lines(tmp_path, capsys, seed, workers):
+    path = tmp_path / 'genome.fa'
+    path.write_bytes(random_fasta(seed))
+    assert run_engine(capsys, path, 'bytes', workers) == run_engine(capsys, path, 'lines')
+
+
+@pytest.mark.parametrize('variant', ['crlf', 'non_ascii', 'gzip', 'empty', 'blank_lines'])
+def test_bytes_engine_edge_cases(tmp_path, capsys, variant):
+    path = tmp_path / 'genome.fa'
+    if variant == 'crlf':
+        path.write_bytes(random_fasta(1, crlf=True))
+    elif variant == 'non_ascii':
+        path.write_bytes(random_fasta(2, non_ascii=True))
+    elif variant == 'gzip':
+        path = tmp_path / 'genome.fa.gz'
+        path.write_bytes(gzip.compress(random_fasta(3)))
+    elif variant == 'empty':
+        path.write_bytes(b'\n')
+    else:
+        path.write_bytes(b'\n\n>x\nAC\n\nGT\n')
+    assert run_engine(capsys, path, 'bytes', 2) == run_engine(capsys, path, 'lines')
@@ -0,0 +1,90 @@
+"""clean_genome writes the cleaned records and a .fai that matches samtools faidx"""
+
+import gzip
+import random
+import shutil
+
+import pytest
+
+from clean_genome import clean_header, iter_fasta_blocks, process_genome
+
+pysam = pytest.importorskip('pysam')
+
+
+def random_genome(seed):
+    """Headers with descriptions and odd characters, ragged lowercase lines, blank lines and an empty record"""
+    rng = random.Random(seed)
+    lines = ['junk before the first header']
+    for i in range(rng.randint(3, 12)):
+        lines.append('>ctg{},a=1;b:2 desc here'.format(i))
+        if i == 1:
+            continue
+        for _ in range(rng.randint(1, 20)):
+            length = rng.choice([60, 60, 80, rng.randint(1, 120)])
+            lines.append(''.join(rng.choice('ACGTNacgtnRYKM \t') for _ in range(length)))
+        if rng.random() < 0.2:
+            lines.append('')
+    return '\n'.join(lines) + '\n'
+
+
+def expected_records(text):
+    """(name, sequence) pairs: first header word cleaned, sequence uppercase without whitespace"""
+    records = []
+    name = None
+    parts = []
+    for line in text.splitlines():
+        if line.startswith('>'):
+            if name is not None:
+                records.append((name, ''.join(parts)))
+            name = clean_header(line[1:].split(None, 1)[0])
+            parts = []
+        elif name is not None:
+            parts.append(''.join(line.split()).upper())
+    if name is not None:
+        records.append((name, ''.join(parts)))
+    # Empty records cannot be indexed by faidx and are not written
+    return [(name, sequence) for name, sequence in records if sequence]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('line_length', [60, 80])
+def test_output_and_index_match_faidx(tmp_path, seed, line_length):
+    text = random_genome(seed)
+    input_file = tmp_path / 'genome.fa'
+    input_file.write_text(text)
+    output_file = tmp_path / 'genome.cleaned.fa'
+    expected = expected_records(text)
+
+    total_seqs, total_bases = process_genome(input_file, output_file, line_length)
+    assert total_bases == sum(len(sequence) for _, sequence in expected)
+
+    # samtools faidx on a copy of the output must produce the same index
+    reference = tmp_path / 'reference.fa'
+    shutil.copy(output_file, reference)
+    pysam.faidx(str(reference))
+    assert (tmp_path / 'genome.cleaned.fa.fai').read_text() == (tmp_path / 'reference.fa.fai').read_text()
+
+    with pysam.FastaFile(str(output_file)) as fasta:
+        assert list(fasta.references) == [name for name, _ in expected]
+        for name, sequence in expected:
+            assert fasta.fetch(name) == sequence
+    for line in output_file.read_text().splitlines():
+        assert line.startswith('>') or 0 < len(line) <= line_length
+
+
+def test_small_blocks_match_one_block(tmp_path):
+    text = random_genome(9).encode()
+    input_file = tmp_path / 'genome.fa.gz'
+    input_file.write_bytes(gzip.compress(text))
+
+    def records(block_bytes):
+        with gzip.open(input_file, 'rb') as f:
+            items = []
+            for header, bases in iter_fasta_blocks(f, block_bytes):
+                if header is not None:
+                    items.append([header, b''])
+                else:
+                    items[-1][1] += bases
+            return items
+
+    assert records(7) == records(1 << 20)
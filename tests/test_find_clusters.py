@@ -0,0 +1,84 @@
+"""find_clusters.py gives the same clusters serially, with --workers and from the interval cache"""
+
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+pysam = pytest.importorskip('pysam')
+
+import find_clusters
+
+SCRIPT = find_clusters.__file__
+OUTPUTS = ('.bed', '.detailed.txt', '.stats.txt')
+
+
+def write_kmer_bam(path, seed=11, n_contigs=6, kmer=31):
+    """Sorted, indexed BAM of k-mer alignments in dense patches with sparse ones between them"""
+    rng = random.Random(seed)
+    lengths = [rng.randint(5000, 40000) for _ in range(n_contigs)]
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'ctg{}'.format(i), 'LN': length} for i, length in enumerate(lengths)]}
+    unsorted = str(path) + '.unsorted.bam'
+    n = 0
+    with pysam.AlignmentFile(unsorted, 'wb', header=header) as bam:
+        # One contig is left without alignments
+        for ref_id, length in enumerate(lengths[:-1]):
+            positions = []
+            for _ in range(rng.randint(5, 40)):
+                start = rng.randint(0, length - 500)
+                step = rng.choice([3, 10, 40, 80])
+                positions.extend(range(start, min(length - kmer, start + rng.randint(50, 600)), step))
+            for pos in positions:
+                read = pysam.AlignedSegment()
+                read.query_name = 'kmer{}'.format(n)
+                read.query_sequence = 'A' * kmer
+                read.flag = 0
+                read.reference_id = ref_id
+                read.reference_start = pos
+                read.mapping_quality = 60
+                read.cigartuples = [(0, kmer)]
+                bam.write(read)
+                n += 1
+    pysam.sort('-o', str(path), unsorted)
+    os.remove(unsorted)
+    pysam.index(str(path))
+
+
+def run_find_clusters(bam_file, output_prefix, *options):
+    subprocess.run([sys.executable, SCRIPT, str(bam_file), str(output_prefix)] + list(options),
+                   check=True, capture_output=True, text=True)
+    return {suffix: open(str(output_prefix) + suffix).read() for suffix in OUTPUTS}
+
+
+@pytest.mark.parametrize('parameters', [[], ['--max-gap', '100', '--min-density', '0.2', '--min-kmers', '5']])
+def test_serial_workers_and_cache_agree(tmp_path, parameters):
+    bam_file = tmp_path / 'kmers.bam'
+    write_kmer_bam(bam_file)
+
+    serial = run_find_clusters(bam_file, tmp_path / 'serial', '--workers', '1', *parameters)
+    assert serial['.bed'].count('\n') > 0
+    assert run_find_clusters(bam_file, tmp_path / 'workers', '--workers', '3', *parameters) == serial
+    # First run builds <bam>.kmers, the second reads it
+    assert run_find_clusters(bam_file, tmp_path / 'cache', '--cache', *parameters) == serial
+    assert (tmp_path / 'kmers.bam.kmers').is_dir()
+    assert run_find_clusters(bam_file, tmp_path / 'cached', '--cache', *parameters) == serial
+    assert run_find_clusters(tmp_path / 'kmers.bam.kmers', tmp_path / 'dir', *parameters) == serial
+
+
+def test_sweep_counts_match_single_runs(tmp_path):
+    bam_file = tmp_path / 'kmers.bam'
+    write_kmer_bam(bam_file, seed=12)
+    subprocess.run([sys.executable, SCRIPT, str(bam_file), str(tmp_path / 'sweep'),
+                    '--sweep', 'max_gap=25,100', 'min_density=0.1,0.3'],
+                   check=True, capture_output=True, text=True)
+    with open(tmp_path / 'sweep.sweep.tsv') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        rows = [dict(zip(header, line.rstrip('\n').split('\t'))) for line in f]
+    assert len(rows) == 4
+    for row in rows:
+        single = run_find_clusters(bam_file, tmp_path / 'single', '--max-gap', row['max_gap'],
+                                   '--min-density', row['min_density'])
+        assert single['.bed'].count('\n') == int(row['n_clusters'])